@@ -1,3 +1,5 @@
+import logging
+
 from torchvision import transforms
 from datasets import video_transforms
 from .col_datasets import Colonoscopic
@@ -7,8 +9,14 @@ from .endoslam_image_datasets import EndoslamImages
 from .kva_datasets import Kvasir_Capsule
 from .cho_image_datasets import CholecT45Images
 from .kva_image_datasets import Kvasir_CapsuleImages
+from .latent_datasets import LatentVideos
+from .latent_datasets import MaskLatents
+
+logger = logging.getLogger(__name__)
 
 def get_dataset(args):
+    if getattr(args, 'dino_cache_path', None):
+        assert getattr(args, 'latent_cache_path', None), "dino_cache_path requires latent_cache_path"
     temporal_sample = video_transforms.TemporalRandomCrop(args.num_frames * args.frame_interval)
 
     if args.dataset == "col":
@@ -18,6 +26,12 @@ def get_dataset(args):
                     # video_transforms.RandomHorizontalFlipVideo(),
                     transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
             ])
+        if getattr(args, 'gpu_transforms', False):
+            transform_col = transforms.Compose([])  # uint8 clips, transformed on the device by get_batch_transform()
+        if getattr(args, 'latent_cache_path', None):
+            # pixels are only needed when the DINO priors are not cached
+            return LatentVideos(args, transform=None if getattr(args, 'dino_cache_path', None) else transform_col,
+                                temporal_sample=temporal_sample)
         return Colonoscopic(args, transform=transform_col, temporal_sample=temporal_sample)
     elif args.dataset == 'col_img':
         transform_col = transforms.Compose([
@@ -62,6 +76,12 @@ def get_dataset(args):
                     # video_transforms.RandomHorizontalFlipVideo(),
                     transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
             ])
+        if getattr(args, 'gpu_transforms', False):
+            transform_kva = transforms.Compose([])  # uint8 clips, transformed on the device by get_batch_transform()
+        if getattr(args, 'latent_cache_path', None):
+            # pixels are only needed when the DINO priors are not cached
+            return LatentVideos(args, transform=None if getattr(args, 'dino_cache_path', None) else transform_kva,
+                                temporal_sample=temporal_sample)
         return Kvasir_Capsule(args, transform=transform_kva, temporal_sample=temporal_sample)
     elif args.dataset == 'kva_img':
         transform_kva = transforms.Compose([
@@ -82,3 +102,27 @@ def get_dataset(args):
     
     else:
         raise NotImplementedError(args.dataset)
+
+
+GPU_TRANSFORM_DATASETS = ["col", "kva"]
+
+
+def get_batch_transform(args):
+    """
+    On-device transform of a whole batch, used with ``gpu_transforms: True``.
+    The datasets then return uint8 clips and the loader needs collate_fn=get_collate_fn(args).
+    Other datasets than col/kva keep their per-sample transforms (with a warning).
+    """
+    if not getattr(args, 'gpu_transforms', False):
+        return None
+    if args.dataset in GPU_TRANSFORM_DATASETS:
+        return video_transforms.BatchedVideoTransform(args.image_size, crop_mode="center_crop_resize")
+    logger.warning('gpu_transforms is only supported for the {} datasets, {} keeps its per-sample '
+                   'transforms in the data loader'.format('/'.join(GPU_TRANSFORM_DATASETS), args.dataset))
+    return None
+
+
+def get_collate_fn(args):
+    if getattr(args, 'gpu_transforms', False) and args.dataset in GPU_TRANSFORM_DATASETS:
+        return video_transforms.collate_uint8_videos
+    return None
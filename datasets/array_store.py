@@ -0,0 +1,210 @@
+import os
+import json
+import numpy as np
+
+
+def scale_name(shard_name):
+    return shard_name[:-len('.bin')] + '.scale.bin'
+
+
+def quantize_uint8(frames):
+    """uint8 codes of ``frames`` and the float32 (offset, scale) of each row and leading channel."""
+    frames = np.asarray(frames, dtype=np.float32)
+    low, high = frames.min(axis=(-2, -1)), frames.max(axis=(-2, -1))
+    scale = np.where(high > low, (high - low) / 255., 1.).astype(np.float32)
+    codes = np.rint((frames - low[..., None, None]) / scale[..., None, None])
+    return np.clip(codes, 0, 255).astype(np.uint8), np.stack([low, scale], axis=-1)
+
+
+def dequantize_uint8(codes, scales):
+    """float32 rows from the codes and (offset, scale) pairs of ``quantize_uint8``."""
+    return codes.astype(np.float32) * scales[..., 1, None, None] + scales[..., 0, None, None]
+
+
+class ArrayStoreWriter(object):
+    """Append per-frame arrays of a fixed shape to sharded raw binary files.
+
+    Every entry (e.g. one video) is written as ``num_frames`` consecutive rows
+    of ``frame_shape`` into the current shard. A shard is closed once it holds
+    ``shard_frames`` rows and a new one is started; entries never straddle
+    shards. ``close()`` writes ``index.json`` which maps every key to its
+    shard, row offset and number of frames.
+
+    With ``quantize`` the rows are stored as uint8 codes with a float32
+    (offset, scale) per row and per leading channel, i.e. over the last two
+    (spatial) axes, in a ``.scale.bin`` file next to each shard; ArrayStore
+    dequantizes them to float32.
+
+    Args:
+        root (str): output directory.
+        frame_shape (tuple): shape of a single frame row.
+        dtype (str): numpy dtype used on disk (uint8 with ``quantize``).
+        shard_frames (int): maximum number of rows per shard.
+        meta (dict): extra information stored in the index.
+        quantize (bool): store uint8 codes with per-channel scales.
+    """
+
+    def __init__(self, root, frame_shape, dtype='float32', shard_frames=65536, meta=None, quantize=False):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.frame_shape = tuple(int(s) for s in frame_shape)
+        self.quantize = quantize
+        self.dtype = np.dtype('uint8' if quantize else dtype)
+        assert not quantize or len(self.frame_shape) >= 2, 'Quantization needs rows with 2 spatial axes'
+        self.shard_frames = shard_frames
+        self.meta = meta or {}
+        self.entries = {}
+        self.shards = []
+        self._file = None
+        self._scale_file = None
+        self._rows = 0
+
+    def _shard_name(self, shard_id):
+        return 'shard_%05d.bin' % shard_id
+
+    def _close_shard(self):
+        self._file.close()
+        if self._scale_file is not None:
+            self._scale_file.close()
+        self.shards[-1] = self._rows
+
+    def _open_shard(self):
+        if self._file is not None:
+            self._close_shard()
+        self.shards.append(0)
+        name = self._shard_name(len(self.shards) - 1)
+        self._file = open(os.path.join(self.root, name), 'wb')
+        if self.quantize:
+            self._scale_file = open(os.path.join(self.root, scale_name(name)), 'wb')
+        self._rows = 0
+
+    def add(self, key, frames):
+        """Append ``frames`` (num_frames, *frame_shape) under ``key``."""
+        scales = None
+        if self.quantize:
+            frames, scales = quantize_uint8(frames)
+        frames = np.ascontiguousarray(frames, dtype=self.dtype)
+        assert frames.shape[1:] == self.frame_shape, \
+            'Expected frames of shape {}, got {}'.format(self.frame_shape, frames.shape[1:])
+        assert key not in self.entries, 'Duplicated key {}'.format(key)
+        if self._file is None or (self._rows > 0 and self._rows + len(frames) > self.shard_frames):
+            self._open_shard()
+        self.entries[key] = {'shard': len(self.shards) - 1, 'offset': self._rows, 'num_frames': len(frames)}
+        self._file.write(frames.tobytes())
+        if scales is not None:
+            self._scale_file.write(scales.tobytes())
+        self._rows += len(frames)
+
+    def close(self):
+        if self._file is not None:
+            self._close_shard()
+            self._file = self._scale_file = None
+        index = {
+            'frame_shape': list(self.frame_shape),
+            'dtype': self.dtype.str,
+            'quantized': self.quantize,
+            'shards': [{'file': self._shard_name(i), 'num_frames': n} for i, n in enumerate(self.shards)],
+            'entries': self.entries,
+            'meta': self.meta,
+        }
+        with open(os.path.join(self.root, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArrayStore(object):
+    """Read-only view of a store written by ``ArrayStoreWriter``.
+
+    Shards are memory mapped lazily, so the store can be created in the main
+    process and shared by forked dataloader workers without copying data.
+    Rows of a quantized store are returned as float32.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.frame_shape = tuple(index['frame_shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.quantized = index.get('quantized', False)
+        self.shard_info = index['shards']
+        self.entries = index['entries']
+        self.meta = index.get('meta', {})
+        self.keys = sorted(self.entries.keys())
+        self._shards = {}
+        self._scales = {}
+
+    def _shard(self, shard_id):
+        shard = self._shards.get(shard_id)
+        if shard is None:
+            info = self.shard_info[shard_id]
+            shard = np.memmap(os.path.join(self.root, info['file']), dtype=self.dtype, mode='r',
+                              shape=(info['num_frames'],) + self.frame_shape)
+            self._shards[shard_id] = shard
+        return shard
+
+    def _scale(self, shard_id):
+        scale = self._scales.get(shard_id)
+        if scale is None:
+            info = self.shard_info[shard_id]
+            scale = np.memmap(os.path.join(self.root, scale_name(info['file'])), dtype=np.float32, mode='r',
+                              shape=(info['num_frames'],) + self.frame_shape[:-2] + (2,))
+            self._scales[shard_id] = scale
+        return scale
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.keys)
+
+    def num_frames(self, key):
+        return self.entries[key]['num_frames']
+
+    def get(self, key, frame_indice=None):
+        """Return the rows of ``key`` selected by ``frame_indice`` (all rows if None)."""
+        entry = self.entries[key]
+        shard = self._shard(entry['shard'])
+        start = entry['offset']
+        if frame_indice is None:
+            rows = slice(start, start + entry['num_frames'])
+        else:
+            frame_indice = np.asarray(frame_indice)
+            assert frame_indice.max() < entry['num_frames']
+            rows = start + frame_indice
+        if self.quantized:
+            return dequantize_uint8(shard[rows], self._scale(entry['shard'])[rows])
+        return np.array(shard[rows])
+
+
+if __name__ == '__main__':
+    # Size and round-trip error of a uint8 store against float16, on posterior-like rows
+    # with the layout of extract_mask_latents.py. Run with `python -m datasets.array_store`.
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    num_frames, frame_shape = 256, (2, 2, 4, 32, 32)  # 256x256 masks
+    frames = rng.normal(size=(num_frames,) + frame_shape).astype(np.float32)
+    frames[:, :, 1] = np.exp(frames[:, :, 1] - 4)  # std moments are small and positive
+
+    sizes, outputs = {}, {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, kwargs in [('float16', {'dtype': 'float16'}), ('uint8', {'quantize': True})]:
+            root = os.path.join(tmp_dir, name)
+            with ArrayStoreWriter(root, frame_shape, **kwargs) as writer:
+                for i in range(0, num_frames, 16):
+                    writer.add('video_%03d' % i, frames[i:i + 16])
+            sizes[name] = sum(os.path.getsize(os.path.join(root, f)) for f in os.listdir(root) if f.endswith('.bin'))
+            store = ArrayStore(root)
+            outputs[name] = np.concatenate([store.get(key) for key in store.keys])
+
+    for name in sizes:
+        err = np.abs(outputs[name].astype(np.float32) - frames)
+        print(f'{name:>8}: {sizes[name] / 2 ** 20:.2f} MiB, max abs err mean {err[:, :, 0].max():.4f} '
+              f'std {err[:, :, 1].max():.6f}')
+    print(f'uint8 / float16 size: {sizes["uint8"] / sizes["float16"]:.3f}')
@@ -13,21 +13,13 @@ from typing import Dict, List, Tuple
 from torchvision import transforms
 import traceback
 
+from .video_index import get_filelist, load_video_index
+from .frame_shards import FrameShardReader, MissingFrameError, open_frame
+
 class_labels_map = None
 cls_sample_cnt = None
 
 
-def get_filelist(file_path):
-    Filelist = []
-    for home, dirs, files in os.walk(file_path):
-        for filename in files:
-            # 文件名列表，包含完整路径
-            Filelist.append(os.path.join(home, filename))
-            # # 文件名列表，只包含文件名
-            # Filelist.append( filename)
-    return Filelist
-
-
 
 
 class DecordInit(object):
@@ -71,7 +63,10 @@ class CholecT45Images(torch.utils.data.Dataset):
                  temporal_sample=None):
         self.configs = configs
         self.data_path = configs.data_path
-        self.video_lists = get_filelist(configs.data_path)
+        self.video_infos = load_video_index(configs.data_path, getattr(configs, 'video_index_path', None),
+                                            min_frames=configs.num_frames,
+                                            validate=getattr(configs, 'video_index_validate', True))
+        self.video_lists = [info['path'] for info in self.video_infos]
         self.transform = transform
         self.temporal_sample = temporal_sample
         self.target_video_len = self.configs.num_frames
@@ -82,6 +77,8 @@ class CholecT45Images(torch.utils.data.Dataset):
         self.video_frame_path = configs.frame_data_path
         self.video_frame_txt = configs.frame_data_txt
         self.video_frame_files = [frame_file.strip() for frame_file in open(self.video_frame_txt)]
+        # packed frames written by process_data.py --packed
+        self.frame_shards = FrameShardReader(configs.frame_shard_path) if getattr(configs, 'frame_shard_path', None) else None
         random.shuffle(self.video_frame_files)
         self.use_image_num = configs.use_image_num
         self.image_tranform = transforms.Compose([
@@ -92,14 +89,16 @@ class CholecT45Images(torch.utils.data.Dataset):
     def __getitem__(self, index):
         video_index = index % self.video_length
         path = self.video_lists[video_index]
-        vframes, aframes, info = torchvision.io.read_video(filename=path, pts_unit='sec', output_format='TCHW')
-        total_frames = len(vframes)
+        v_reader = self.v_decoder(path)
+        total_frames = self.video_infos[video_index]['num_frames']
         
         # Sampling video frames
         start_frame_ind, end_frame_ind = self.temporal_sample(total_frames)
         assert end_frame_ind - start_frame_ind >= self.target_video_len
         frame_indice = np.linspace(start_frame_ind, end_frame_ind-1, self.target_video_len, dtype=int)
-        video = vframes[frame_indice]
+        # only the requested frames are decoded
+        video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        del v_reader
         # videotransformer data proprecess
         video = self.transform(video) # T C H W
 
@@ -108,10 +107,12 @@ class CholecT45Images(torch.utils.data.Dataset):
         for i in range(self.use_image_num):
             while True:
                 try:      
-                    image = Image.open(os.path.join(self.video_frame_path, self.video_frame_files[index+i])).convert("RGB")
+                    image = open_frame(self.frame_shards, self.video_frame_path, self.video_frame_files[index+i]).convert("RGB")
                     image = self.image_tranform(image).unsqueeze(0)
                     images.append(image)
                     break
+                except MissingFrameError:
+                    raise  # the frame list does not match the shards, retrying would not help
                 except Exception as e:
                     traceback.print_exc()
                     index = random.randint(0, len(self.video_frame_files) - self.use_image_num)
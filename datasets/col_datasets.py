@@ -11,19 +11,12 @@ from PIL import Image
 from einops import rearrange
 from typing import Dict, List, Tuple
 
+from .video_index import get_filelist, load_video_index
+
 class_labels_map = None
 cls_sample_cnt = None
 
 
-def get_filelist(file_path):
-    Filelist = []
-    for home, dirs, files in os.walk(file_path):
-        for filename in files:
-            Filelist.append(os.path.join(home, filename))
-            # Filelist.append( filename)
-    return Filelist
-
-
 class DecordInit(object):
     """Using Decord(https://github.com/dmlc/decord) to initialize the video_reader."""
 
@@ -65,7 +58,10 @@ class Colonoscopic(torch.utils.data.Dataset):
                  temporal_sample=None):
         self.configs = configs
         self.data_path = configs.data_path
-        self.video_lists = get_filelist(configs.data_path)
+        self.video_infos = load_video_index(configs.data_path, getattr(configs, 'video_index_path', None),
+                                            min_frames=configs.num_frames,
+                                            validate=getattr(configs, 'video_index_validate', True))
+        self.video_lists = [info['path'] for info in self.video_infos]
         self.transform = transform
         self.temporal_sample = temporal_sample
         self.target_video_len = self.configs.num_frames
@@ -73,14 +69,16 @@ class Colonoscopic(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         path = self.video_lists[index]
-        vframes, aframes, info = torchvision.io.read_video(filename=path, pts_unit='sec', output_format='TCHW')
-        total_frames = len(vframes)
+        v_reader = self.v_decoder(path)
+        total_frames = self.video_infos[index]['num_frames']
         
         # Sampling video frames
         start_frame_ind, end_frame_ind = self.temporal_sample(total_frames)
         assert end_frame_ind - start_frame_ind >= self.target_video_len
         frame_indice = np.linspace(start_frame_ind, end_frame_ind-1, self.target_video_len, dtype=int)
-        video = vframes[frame_indice]
+        # only the requested frames are decoded
+        video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        del v_reader
         # videotransformer data proprecess
         video = self.transform(video) # T C H W
         return {'video': video, 'video_name': 1}
@@ -89,5 +87,63 @@ class Colonoscopic(torch.utils.data.Dataset):
         return len(self.video_lists)
 
 
+def _benchmark_decode(path, mode, num_frames, frame_interval, repeats, queue):
+    """Sample ``repeats`` clips from ``path`` with the old (read_video) or new (decord) path."""
+    import time
+    import resource
+    from .video_transforms import TemporalRandomCrop
+
+    temporal_sample = TemporalRandomCrop(num_frames * frame_interval)
+    v_decoder = DecordInit()
+    start = time.time()
+    for _ in range(repeats):
+        if mode == 'read_video':
+            vframes, aframes, info = torchvision.io.read_video(filename=path, pts_unit='sec', output_format='TCHW')
+            total_frames = len(vframes)
+        else:
+            v_reader = v_decoder(path)
+            total_frames = len(v_reader)
+        start_frame_ind, end_frame_ind = temporal_sample(total_frames)
+        frame_indice = np.linspace(start_frame_ind, end_frame_ind-1, num_frames, dtype=int)
+        if mode == 'read_video':
+            video = vframes[frame_indice]
+        else:
+            video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+            del v_reader
+    queue.put(((time.time() - start) / repeats, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    # Microbenchmark: decode a 16-frame clip from a synthetic long mp4 with both paths.
+    # Run with `python -m datasets.col_datasets`.
+    import argparse
+    import tempfile
+    import multiprocessing as mp
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video-frames", type=int, default=3000)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--num-frames", type=int, default=16)
+    parser.add_argument("--frame-interval", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'synthetic.mp4')
+        grid = torch.arange(args.image_size, dtype=torch.float32)
+        frames = []
+        for i in range(args.video_frames):
+            frame = (grid[None, :] + grid[:, None] + 4 * i) % 256
+            frames.append(torch.stack([frame, frame.flip(0), frame.flip(1)], dim=-1).to(torch.uint8))
+        torchvision.io.write_video(path, torch.stack(frames), fps=25)
+        del frames
+
+        for mode in ['read_video', 'decord']:
+            # one process per path so that the peak RSS of each is measured separately
+            queue = mp.Queue()
+            proc = mp.Process(target=_benchmark_decode,
+                              args=(path, mode, args.num_frames, args.frame_interval, args.repeats, queue))
+            proc.start()
+            sec_per_sample, max_rss = queue.get()
+            proc.join()
+            print(f'{mode:>10}: {sec_per_sample * 1000:.1f} ms/sample, peak RSS {max_rss:.0f} MB')
\ No newline at end of file
@@ -13,21 +13,14 @@ from typing import Dict, List, Tuple
 from torchvision import transforms
 import traceback
 
+from .video_index import get_filelist, load_video_index
+from .frame_shards import FrameShardReader, MissingFrameError, open_frame
+from .latent_datasets import MaskLatents
+
 class_labels_map = None
 cls_sample_cnt = None
 
 
-def get_filelist(file_path):
-    Filelist = []
-    for home, dirs, files in os.walk(file_path):
-        for filename in files:
-            # 文件名列表，包含完整路径
-            Filelist.append(os.path.join(home, filename))
-            # # 文件名列表，只包含文件名
-            # Filelist.append( filename)
-    return Filelist
-
-
 
 
 class DecordInit(object):
@@ -71,7 +64,10 @@ class ColonoscopicImages(torch.utils.data.Dataset):
                  temporal_sample=None):
         self.configs = configs
         self.data_path = configs.data_path
-        self.video_lists = get_filelist(configs.data_path)
+        self.video_infos = load_video_index(configs.data_path, getattr(configs, 'video_index_path', None),
+                                            min_frames=configs.num_frames,
+                                            validate=getattr(configs, 'video_index_validate', True))
+        self.video_lists = [info['path'] for info in self.video_infos]
         self.transform = transform
         self.temporal_sample = temporal_sample
         self.target_video_len = self.configs.num_frames
@@ -82,6 +78,8 @@ class ColonoscopicImages(torch.utils.data.Dataset):
         self.video_frame_path = configs.frame_data_path
         self.video_frame_txt = configs.frame_data_txt
         self.video_frame_files = [frame_file.strip() for frame_file in open(self.video_frame_txt)]
+        # packed frames written by process_data.py --packed
+        self.frame_shards = FrameShardReader(configs.frame_shard_path) if getattr(configs, 'frame_shard_path', None) else None
         random.shuffle(self.video_frame_files)
         self.use_image_num = configs.use_image_num
         self.image_tranform = transforms.Compose([
@@ -92,14 +90,16 @@ class ColonoscopicImages(torch.utils.data.Dataset):
     def __getitem__(self, index):
         video_index = index % self.video_length
         path = self.video_lists[video_index]
-        vframes, aframes, info = torchvision.io.read_video(filename=path, pts_unit='sec', output_format='TCHW')
-        total_frames = len(vframes)
+        v_reader = self.v_decoder(path)
+        total_frames = self.video_infos[video_index]['num_frames']
         
         # Sampling video frames
         start_frame_ind, end_frame_ind = self.temporal_sample(total_frames)
         assert end_frame_ind - start_frame_ind >= self.target_video_len
         frame_indice = np.linspace(start_frame_ind, end_frame_ind-1, self.target_video_len, dtype=int)
-        video = vframes[frame_indice]
+        # only the requested frames are decoded
+        video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        del v_reader
         # videotransformer data proprecess
         video = self.transform(video) # T C H W
 
@@ -108,10 +108,12 @@ class ColonoscopicImages(torch.utils.data.Dataset):
         for i in range(self.use_image_num):
             while True:
                 try:      
-                    image = Image.open(os.path.join(self.video_frame_path, self.video_frame_files[index+i])).convert("RGB")
+                    image = open_frame(self.frame_shards, self.video_frame_path, self.video_frame_files[index+i]).convert("RGB")
                     image = self.image_tranform(image).unsqueeze(0)
                     images.append(image)
                     break
+                except MissingFrameError:
+                    raise  # the frame list does not match the shards, retrying would not help
                 except Exception as e:
                     # traceback.print_exc()
                     index = random.randint(0, len(self.video_frame_files) - self.use_image_num)
@@ -141,8 +143,14 @@ class ColonoscopicImageMaskPairs(torch.utils.data.Dataset):
                  transform=None,
                  temporal_sample=None):
         self.configs = configs
-        self.video_lists = get_filelist(configs.data_path)
-        self.mask_video_lists = get_filelist(configs.mask_data_path)
+        # videos and masks are paired by their sorted position in the two indexes
+        self.video_infos = load_video_index(configs.data_path, getattr(configs, 'video_index_path', None),
+                                            validate=getattr(configs, 'video_index_validate', True))
+        self.video_lists = [info['path'] for info in self.video_infos]
+        self.mask_video_lists = [info['path'] for info in load_video_index(
+            configs.mask_data_path, getattr(configs, 'mask_video_index_path', None),
+            validate=getattr(configs, 'video_index_validate', True))]
+        assert len(self.video_lists) == len(self.mask_video_lists)
         self.transform = transform
         self.temporal_sample = temporal_sample
         self.target_video_len = self.configs.num_frames
@@ -153,11 +161,18 @@ class ColonoscopicImageMaskPairs(torch.utils.data.Dataset):
         self.video_frame_path = configs.frame_data_path
         self.video_frame_txt = configs.frame_data_txt
         self.video_frame_files = [frame_file.strip() for frame_file in open(self.video_frame_txt)]
+        # packed frames written by process_data.py --packed
+        self.frame_shards = FrameShardReader(configs.frame_shard_path) if getattr(configs, 'frame_shard_path', None) else None
 
         # ffs video mask frames`
         self.video_mask_path = configs.mask_frame_data_path
         self.video_mask_txt = configs.mask_data_txt
         self.video_mask_files = [mask_file.strip() for mask_file in open(self.video_mask_txt)]
+        self.mask_frame_shards = FrameShardReader(configs.mask_frame_shard_path) \
+            if getattr(configs, 'mask_frame_shard_path', None) else None
+        # precomputed mask latents written by extract_mask_latents.py
+        self.mask_latents = MaskLatents(configs.mask_latent_cache_path) \
+            if getattr(configs, 'mask_latent_cache_path', None) else None
 
         self.use_image_num = configs.use_image_num
         self.image_tranform = transforms.Compose([
@@ -169,23 +184,30 @@ class ColonoscopicImageMaskPairs(torch.utils.data.Dataset):
         video_index = index % self.video_length
         path = self.video_lists[video_index]
         mask_path = self.mask_video_lists[video_index]
-        vframes, aframes, info = torchvision.io.read_video(filename=path, pts_unit='sec', output_format='TCHW')
-        vframes_m, aframes_m, info_m = torchvision.io.read_video(filename=mask_path, pts_unit='sec', output_format='TCHW')
-        total_frames = len(vframes)
+        v_reader = self.v_decoder(path)
+        total_frames = self.video_infos[video_index]['num_frames']
 
         start_frame_ind, end_frame_ind = self.temporal_sample(total_frames)
         assert end_frame_ind - start_frame_ind >= self.target_video_len
         frame_indice = np.linspace(start_frame_ind, end_frame_ind - 1, self.target_video_len, dtype=int)
 
-        # Sampling image video frames
-        video = vframes[frame_indice]
+        # Sampling image video frames, only the requested frames are decoded
+        video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        del v_reader
         # videotransformer data proprecess
         video = self.transform(video)  # T C H W
 
         # Sampling mask video frames
-        video_m = vframes_m[frame_indice]
-        # videotransformer data proprecess
-        video_m = self.transform(video_m)  # T C H W
+        if self.mask_latents is not None:
+            # the random flip of the transform, applied to the cached posteriors
+            video_m = self.mask_latents.video(os.path.relpath(mask_path, self.configs.mask_data_path),
+                                              frame_indice, flip=random.random() < 0.5)
+        else:
+            v_reader_m = self.v_decoder(mask_path)
+            video_m = torch.from_numpy(v_reader_m.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+            del v_reader_m
+            # videotransformer data proprecess
+            video_m = self.transform(video_m)  # T C H W
 
         # get video frames
         images = []
@@ -193,15 +215,20 @@ class ColonoscopicImageMaskPairs(torch.utils.data.Dataset):
         for i in range(self.use_image_num):
             while True:
                 try:
-                    image = Image.open(os.path.join(self.video_frame_path, self.video_frame_files[index + i])).convert(
+                    image = open_frame(self.frame_shards, self.video_frame_path, self.video_frame_files[index + i]).convert(
                         "RGB")
                     image = self.image_tranform(image).unsqueeze(0)
+                    if self.mask_latents is not None:
+                        mask = self.mask_latents.frame(self.video_mask_files[index + i])
+                    else:
+                        mask = open_frame(self.mask_frame_shards, self.video_mask_path, self.video_mask_files[index + i]).convert(
+                            "RGB")
+                        mask = self.image_tranform(mask).unsqueeze(0)
                     images.append(image)
-                    mask = Image.open(os.path.join(self.video_mask_path, self.video_mask_files[index + i])).convert(
-                        "RGB")
-                    mask = self.image_tranform(mask).unsqueeze(0)
                     masks.append(mask)
                     break
+                except MissingFrameError:
+                    raise  # the frame list does not match the shards, retrying would not help
                 except Exception as e:
                     # traceback.print_exc()
                     index = random.randint(0, len(self.video_frame_files) - self.use_image_num)
@@ -214,6 +241,8 @@ class ColonoscopicImageMaskPairs(torch.utils.data.Dataset):
         video_cat = torch.cat([video, images], dim=0)
         video_cat_m = torch.cat([video_m, masks], dim=0)
 
+        if self.mask_latents is not None:
+            return {'video': video_cat, 'mask_latent': video_cat_m, 'video_name': 1}
         return {'video': video_cat, 'video_mask': video_cat_m, 'video_name': 1}
 
     def __len__(self):
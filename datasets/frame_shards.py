@@ -0,0 +1,118 @@
+import io
+import os
+import mmap
+import numpy as np
+
+from PIL import Image
+
+
+class MissingFrameError(KeyError):
+    """A frame name that is not in the packed shards: a mismatch between the frame list and
+    the shards, raised instead of being skipped like an unreadable file."""
+
+
+class FrameShardWriter(object):
+    """Append encoded frames (e.g. JPEG bytes) to sharded, append-only record files.
+
+    Records are written back to back into ``shard_%05d.bin``; a new shard is
+    started once the current one exceeds ``shard_size`` bytes. The offset index
+    is kept in ``index.npy`` ((N, 3) int64: shard, offset, length) and the
+    record names, one per line, in ``keys.txt``. Opening an existing directory
+    appends to it.
+
+    Args:
+        root (str): output directory.
+        shard_size (int): approximate maximum size of a shard in bytes.
+    """
+
+    def __init__(self, root, shard_size=1 << 30):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.shard_size = shard_size
+        self.keys, self.index = [], []
+        if os.path.exists(os.path.join(root, 'index.npy')):
+            self.index = np.load(os.path.join(root, 'index.npy')).tolist()
+            with open(os.path.join(root, 'keys.txt'), 'r') as f:
+                self.keys = [line.rstrip('\n') for line in f]
+        self.shard_id = self.index[-1][0] if self.index else 0
+        self._file = open(os.path.join(root, 'shard_%05d.bin' % self.shard_id), 'ab')
+
+    def append(self, key, data):
+        if self._file.tell() > 0 and self._file.tell() + len(data) > self.shard_size:
+            self._file.close()
+            self.shard_id += 1
+            self._file = open(os.path.join(self.root, 'shard_%05d.bin' % self.shard_id), 'ab')
+        self.index.append([self.shard_id, self._file.tell(), len(data)])
+        self.keys.append(key)
+        self._file.write(data)
+
+    def flush(self):
+        """Make the records written so far visible to readers."""
+        self._file.flush()
+        np.save(os.path.join(self.root, 'index.npy'), np.asarray(self.index, dtype=np.int64).reshape(-1, 3))
+        with open(os.path.join(self.root, 'keys.txt'), 'w') as f:
+            f.writelines(key + '\n' for key in self.keys)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameShardReader(object):
+    """Random access to the records of a ``FrameShardWriter`` directory.
+
+    Shards are memory mapped lazily (after the dataloader workers are forked),
+    so reading a frame is a single slice of an mmap: no per-file open or stat.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index = np.load(os.path.join(root, 'index.npy'))
+        with open(os.path.join(root, 'keys.txt'), 'r') as f:
+            self.keys = [line.rstrip('\n') for line in f]
+        self.key_to_row = {key: row for row, key in enumerate(self.keys)}
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_to_row
+
+    def _shard(self, shard_id):
+        shard = self._shards.get(shard_id)
+        if shard is None:
+            with open(os.path.join(self.root, 'shard_%05d.bin' % shard_id), 'rb') as f:
+                shard = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._shards[shard_id] = shard
+        return shard
+
+    def read(self, key):
+        row = self.key_to_row.get(key)
+        if row is None:
+            raise MissingFrameError(f'{key!r} is not in the frame shards of {self.root}')
+        shard_id, offset, length = self.index[row]
+        return self._shard(int(shard_id))[offset:offset + length]
+
+    def open_image(self, key):
+        return Image.open(io.BytesIO(self.read(key)))
+
+
+def open_frame(frame_shards, frame_path, name):
+    """Open ``name`` from the packed shards if there are any, else from ``frame_path`` on disk.
+
+    The shards are keyed by the path relative to ``frame_path`` (see process_data.py --packed);
+    absolute names, as in the frame lists written by older versions of process_list.py, are
+    made relative to ``frame_path``.
+    """
+    if frame_shards is not None:
+        if os.path.isabs(name) and frame_path:
+            name = os.path.relpath(name, frame_path)
+        return frame_shards.open_image(name)
+    return Image.open(os.path.join(frame_path, name))
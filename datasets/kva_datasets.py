@@ -11,19 +11,12 @@ from PIL import Image
 from einops import rearrange
 from typing import Dict, List, Tuple
 
+from .video_index import get_filelist, load_video_index
+
 class_labels_map = None
 cls_sample_cnt = None
 
 
-def get_filelist(file_path):
-    Filelist = []
-    for home, dirs, files in os.walk(file_path):
-        for filename in files:
-            Filelist.append(os.path.join(home, filename))
-            # Filelist.append( filename)
-    return Filelist
-
-
 class DecordInit(object):
     """Using Decord(https://github.com/dmlc/decord) to initialize the video_reader."""
 
@@ -65,7 +58,10 @@ class Kvasir_Capsule(torch.utils.data.Dataset):
                  temporal_sample=None):
         self.configs = configs
         self.data_path = configs.data_path
-        self.video_lists = get_filelist(configs.data_path)
+        self.video_infos = load_video_index(configs.data_path, getattr(configs, 'video_index_path', None),
+                                            min_frames=configs.num_frames,
+                                            validate=getattr(configs, 'video_index_validate', True))
+        self.video_lists = [info['path'] for info in self.video_infos]
         self.transform = transform
         self.temporal_sample = temporal_sample
         self.target_video_len = self.configs.num_frames
@@ -73,14 +69,16 @@ class Kvasir_Capsule(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         path = self.video_lists[index]
-        vframes, aframes, info = torchvision.io.read_video(filename=path, pts_unit='sec', output_format='TCHW')
-        total_frames = len(vframes)
+        v_reader = self.v_decoder(path)
+        total_frames = self.video_infos[index]['num_frames']
         
         # Sampling video frames
         start_frame_ind, end_frame_ind = self.temporal_sample(total_frames)
         assert end_frame_ind - start_frame_ind >= self.target_video_len
         frame_indice = np.linspace(start_frame_ind, end_frame_ind-1, self.target_video_len, dtype=int)
-        video = vframes[frame_indice]
+        # only the requested frames are decoded
+        video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        del v_reader
         # videotransformer data proprecess
         video = self.transform(video) # T C H W
         return {'video': video, 'video_name': 1}
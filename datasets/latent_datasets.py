@@ -0,0 +1,228 @@
+import os
+import torch
+
+import numpy as np
+
+from .array_store import ArrayStore
+from .col_datasets import DecordInit
+
+
+def sample_latents(moments, scale_factor=0.18215):
+    """Draw a latent from stored VAE posterior moments.
+
+    Args:
+        moments (Tensor): (T, 2, C, H, W), mean and std of the posterior.
+    Returns:
+        (T, C, H, W) latents, distributed as ``vae.encode(x).latent_dist.sample() * scale_factor``.
+    """
+    mean, std = moments.float().unbind(1)
+    return (mean + std * torch.randn_like(mean)).mul_(scale_factor)
+
+
+class LatentVideos(torch.utils.data.Dataset):
+    """Load precomputed VAE latents of video clips (see extract_latents.py)
+
+    The clip frames are sampled exactly like the pixel datasets; the latent of
+    each frame is drawn from its stored posterior, so training does not need
+    to run the VAE. If ``dino_cache_path`` is set, the DINO prior features of
+    the same frames are returned under ``'attentions'`` (T, L, N, D).
+
+    Args:
+        configs: needs ``latent_cache_path``, ``data_path`` and ``num_frames``.
+        transform (callable): pixel transform; if given, the decoded frames
+            are returned too under ``'video'`` (needed for live DINO priors).
+        temporal_sample (callable): Sample the target length of a video.
+    """
+
+    def __init__(self,
+                 configs,
+                 transform=None,
+                 temporal_sample=None):
+        self.configs = configs
+        self.data_path = configs.data_path
+        self.store = ArrayStore(configs.latent_cache_path)
+        self.dino_store = None
+        if getattr(configs, 'dino_cache_path', None):
+            self.dino_store = ArrayStore(configs.dino_cache_path)
+        self.video_lists = self.store.keys
+        self.transform = transform
+        self.temporal_sample = temporal_sample
+        self.target_video_len = self.configs.num_frames
+        self.v_decoder = DecordInit()
+
+    def __getitem__(self, index):
+        key = self.video_lists[index]
+        total_frames = self.store.num_frames(key)
+
+        # Sampling video frames
+        start_frame_ind, end_frame_ind = self.temporal_sample(total_frames)
+        assert end_frame_ind - start_frame_ind >= self.target_video_len
+        frame_indice = np.linspace(start_frame_ind, end_frame_ind-1, self.target_video_len, dtype=int)
+        moments = torch.from_numpy(self.store.get(key, frame_indice))
+        sample = {'latent': sample_latents(moments), 'video_name': 1}
+        if self.dino_store is not None:
+            sample['attentions'] = torch.from_numpy(self.dino_store.get(key, frame_indice))
+
+        if self.transform is not None:
+            path = os.path.join(self.data_path, key)
+            v_reader = self.v_decoder(path)
+            video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+            del v_reader
+            sample['video'] = self.transform(video) # T C H W
+        return sample
+
+    def __len__(self):
+        return len(self.video_lists)
+
+
+class MaskLatents(object):
+    """Precomputed VAE posteriors of the mask videos and mask frames (see extract_mask_latents.py)
+
+    Every frame is stored unflipped and horizontally flipped, so the random flip
+    of the mask pipelines is kept without running the VAE: ``flip`` selects the
+    flipped posterior. Latents are drawn like ``sample_latents``; uint8 stores
+    are dequantized by ArrayStore.
+
+    Args:
+        root (str): output directory of extract_mask_latents.py.
+    """
+
+    def __init__(self, root):
+        self.store = ArrayStore(root)
+        self.data_path = self.store.meta.get('mask_data_path')
+        self.video_keys = [key[len('videos/'):] for key in self.store.keys if key.startswith('videos/')]
+
+    def __contains__(self, key):
+        return 'videos/' + key in self.store
+
+    def num_frames(self, key):
+        return self.store.num_frames('videos/' + key)
+
+    def video(self, key, frame_indice, flip=False):
+        """(T, C, H, W) latents of the ``frame_indice`` frames of the mask video ``key``."""
+        moments = self.store.get('videos/' + key, frame_indice)[:, int(flip)]
+        return sample_latents(torch.from_numpy(moments))
+
+    def frame(self, name, flip=False):
+        """(1, C, H, W) latent of the mask frame ``name`` (a line of mask_data_txt)."""
+        if 'frames/' + name not in self.store:
+            raise KeyError(name)
+        moments = self.store.get('frames/' + name)[:, int(flip)]
+        return sample_latents(torch.from_numpy(moments))
+
+
+if __name__ == '__main__':
+    # Compare the pixel loader + vae.encode of the trainers (old) with LatentVideos (new) on
+    # synthetic mp4s and a small random AutoencoderKL: same latents for the same clips, and
+    # training-loader steps/sec of both paths (pass --vae to time a real VAE, e.g. sd-vae-ft-mse).
+    # Run with `python -m datasets.latent_datasets`.
+    import time
+    import random
+    import argparse
+    import tempfile
+    import torchvision
+
+    from omegaconf import OmegaConf
+    from torchvision import transforms
+    from diffusers.models import AutoencoderKL
+
+    from . import video_transforms
+    from .col_datasets import Colonoscopic
+    from .array_store import ArrayStoreWriter
+    from extract_latents import iter_frame_chunks, encode_moments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vae", type=str, default=None)
+    parser.add_argument("--videos", type=int, default=8)
+    parser.add_argument("--video-frames", type=int, default=96)
+    parser.add_argument("--image-size", type=int, default=128)
+    parser.add_argument("--num-frames", type=int, default=16)
+    parser.add_argument("--frame-interval", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=8)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    if args.vae:
+        vae = AutoencoderKL.from_pretrained(args.vae)
+    else:
+        vae = AutoencoderKL(
+            in_channels=3, out_channels=3, latent_channels=4,
+            down_block_types=("DownEncoderBlock2D",) * 4, up_block_types=("UpDecoderBlock2D",) * 4,
+            block_out_channels=(32, 32, 64, 64), layers_per_block=1, norm_num_groups=32,
+            sample_size=args.image_size,
+        )
+    vae = vae.to(device).eval().requires_grad_(False)
+    transform = transforms.Compose([
+        video_transforms.ToTensorVideo(),
+        video_transforms.CenterCropResizeVideo(args.image_size),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
+    ])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path, cache_path = os.path.join(tmp_dir, 'videos'), os.path.join(tmp_dir, 'latents')
+        os.makedirs(data_path)
+        grid = torch.arange(args.image_size + 32, dtype=torch.float32)
+        for v in range(args.videos):
+            frames = [(grid[None, :args.image_size] + grid[:, None] + 4 * i + 16 * v) % 256
+                      for i in range(args.video_frames)]
+            frames = torch.stack([torch.stack([f, f.flip(0), f.flip(1)], dim=-1) for f in frames]).to(torch.uint8)
+            torchvision.io.write_video(os.path.join(data_path, '%03d.mp4' % v), frames, fps=25)
+
+        configs = OmegaConf.create({'data_path': data_path, 'latent_cache_path': cache_path,
+                                    'num_frames': args.num_frames, 'image_size': args.image_size})
+        temporal_sample = video_transforms.TemporalRandomCrop(args.num_frames * args.frame_interval)
+        old = Colonoscopic(configs, transform=transform, temporal_sample=temporal_sample)
+
+        latent_size = args.image_size // 8
+        with ArrayStoreWriter(cache_path, frame_shape=(2, 4, latent_size, latent_size)) as writer:  # extract_latents.py
+            for path in old.video_lists:
+                writer.add(os.path.relpath(path, data_path),
+                           encode_moments(vae, iter_frame_chunks(DecordInit(), path, transform, 32), device).numpy())
+        new = LatentVideos(configs, transform=None, temporal_sample=temporal_sample)
+
+        # same clip and same noise: the cached latent is the posterior sample of vae.encode
+        max_err = 0.
+        for index, path in enumerate(old.video_lists):
+            random.seed(index)
+            video = old[index]['video']
+            random.seed(index)
+            torch.manual_seed(index)
+            latent = new[new.video_lists.index(os.path.relpath(path, data_path))]['latent']
+            with torch.no_grad():
+                latent_dist = vae.encode(video.to(device)).latent_dist
+            torch.manual_seed(index)
+            noise = torch.randn(latent_dist.mean.shape)
+            reference = (latent_dist.mean.cpu() + latent_dist.std.cpu() * noise) * 0.18215
+            max_err = max(max_err, (latent - reference).abs().max().item())
+        assert max_err < 1e-3, max_err
+        print(f'LatentVideos returns the latents of the pixel loader + vae.encode (max abs err {max_err:.2e})')
+
+        def steps_per_sec(dataset, encode):
+            loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True, drop_last=True,
+                                                 num_workers=args.num_workers, persistent_workers=args.num_workers > 0)
+            steps, start = 0, None
+            while steps < args.steps + 1:
+                for batch in loader:
+                    if encode:
+                        x = batch['video'].to(device)
+                        b = x.shape[0]
+                        with torch.no_grad():
+                            x = vae.encode(x.flatten(0, 1)).latent_dist.sample().mul_(0.18215)
+                        x = x.view(b, -1, *x.shape[1:])
+                    else:
+                        x = batch['latent'].to(device)
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    steps += 1
+                    if start is None:  # the first step includes the worker start-up
+                        start = time.time()
+                    if steps == args.steps + 1:
+                        break
+            return args.steps / (time.time() - start)
+
+        before, after = steps_per_sec(old, True), steps_per_sec(new, False)
+        print(f'pixels + vae.encode: {before:.2f} steps/sec, LatentVideos: {after:.2f} steps/sec '
+              f'({after / before:.1f}x, batch size {args.batch_size}, {device.type})')
@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import decord
+import torch.distributed as dist
+
+from tqdm import tqdm
+
+
+INDEX_VERSION = 1
+
+
+def get_filelist(file_path):
+    Filelist = []
+    for home, dirs, files in os.walk(file_path):
+        for filename in files:
+            Filelist.append(os.path.join(home, filename))
+            # Filelist.append( filename)
+    return Filelist
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """Fast content fingerprint: sha1 of the file size, its first and its last ``chunk_size`` bytes."""
+    size = os.path.getsize(path)
+    sha1 = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        sha1.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            sha1.update(f.read(chunk_size))
+    return sha1.hexdigest()
+
+
+def index_video(path):
+    """Return the index entry of a single video, or None if it cannot be decoded."""
+    stat = os.stat(path)
+    try:
+        reader = decord.VideoReader(path, ctx=decord.cpu(0), num_threads=1)
+        num_frames = len(reader)
+        height, width = reader[0].shape[:2] if num_frames > 0 else (0, 0)
+        entry = {
+            'num_frames': num_frames,
+            'fps': float(reader.get_avg_fps()),
+            'height': int(height),
+            'width': int(width),
+            'keyframes': [int(k) for k in reader.get_key_indices()],
+        }
+        del reader
+    except Exception as e:
+        print(f'Coudnt index video: {path} ({e})')
+        return None
+    entry.update({'mtime': stat.st_mtime, 'size': stat.st_size, 'checksum': file_checksum(path)})
+    return entry
+
+
+def default_index_path(data_path):
+    return os.path.normpath(data_path) + '.index.json'
+
+
+def _validate(entry, data_path, rel_path):
+    """Return ``entry`` if it still describes the file, None if the file must be re-indexed.
+
+    A file whose mtime changed but whose size and checksum did not (touched,
+    copied or restored from a backup) keeps its entry, returned as a copy with
+    the new mtime.
+    """
+    path = os.path.join(data_path, rel_path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if entry is None or stat.st_size != entry['size']:
+        return None
+    if stat.st_mtime == entry['mtime']:
+        return entry
+    if entry.get('checksum') != file_checksum(path):
+        return None
+    return dict(entry, mtime=stat.st_mtime)
+
+
+def build_video_index(data_path, index_path=None, rescan=True, validate=True):
+    """Create or refresh the index of every video under ``data_path``.
+
+    Entries whose file size or checksum changed are re-indexed (the checksum
+    is only computed when the mtime changed), deleted files are dropped. With ``rescan`` the directory is walked again to pick up new
+    files; otherwise only the files already in the index are checked, which
+    avoids the ``os.walk`` over the whole corpus. Without ``validate`` an
+    existing index is trusted as is (no ``os.stat`` per file).
+
+    Returns:
+        dict mapping the path relative to ``data_path`` to its entry.
+    """
+    index_path = index_path or default_index_path(data_path)
+    entries = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            entries = index['videos']
+    if entries and not (rescan or validate):
+        return entries
+
+    if rescan or not entries:
+        rel_paths = sorted(os.path.relpath(p, data_path) for p in get_filelist(data_path))
+    else:
+        rel_paths = sorted(entries.keys())
+
+    videos, changed = {}, len(rel_paths) != len(entries)
+    for rel_path in tqdm(rel_paths, desc='Indexing {}'.format(data_path), disable=len(rel_paths) < 1000):
+        entry = _validate(entries.get(rel_path), data_path, rel_path)
+        if entry is None:
+            if not os.path.exists(os.path.join(data_path, rel_path)):
+                changed = True
+                continue
+            entry = index_video(os.path.join(data_path, rel_path))
+            changed = True
+        elif entry is not entries[rel_path]:  # new mtime only
+            changed = True
+        if entry is not None:
+            videos[rel_path] = entry
+
+    if changed:
+        tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'videos': videos}, f, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+    return videos
+
+
+def load_video_index(data_path, index_path=None, min_frames=0, validate=True):
+    """Load (building or refreshing it if needed) the index of ``data_path``.
+
+    Returns a list of entries sorted by path, each with an absolute ``'path'``,
+    keeping only the videos with at least ``min_frames`` frames. In a
+    distributed run rank 0 builds the index while the other ranks wait at a
+    barrier and then read it.
+    """
+    if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+        if dist.get_rank() == 0:
+            videos = build_video_index(data_path, index_path, rescan=False, validate=validate)
+        dist.barrier()
+        if dist.get_rank() != 0:
+            videos = build_video_index(data_path, index_path, rescan=False, validate=False)
+    else:
+        videos = build_video_index(data_path, index_path, rescan=False, validate=validate)
+    video_index = []
+    for rel_path, entry in sorted(videos.items()):
+        if entry['num_frames'] >= min_frames:
+            video_index.append(dict(entry, path=os.path.join(data_path, rel_path)))
+    return video_index
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the video index of a dataset directory')
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--index-path", type=str, default=None)
+    args = parser.parse_args()
+
+    videos = build_video_index(args.data_path, args.index_path, rescan=True)
+    print(f'Indexed {len(videos)} videos to {args.index_path or default_index_path(args.data_path)}')
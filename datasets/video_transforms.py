@@ -2,6 +2,7 @@ import torch
 import random
 import numbers
 from torchvision.transforms import RandomCrop, RandomResizedCrop
+from torch.utils.data.dataloader import default_collate
 
 def _is_tensor_video_clip(clip):
     if not torch.is_tensor(clip):
@@ -407,6 +408,97 @@ class RandomHorizontalFlipVideo:
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(p={self.p})"
     
+#  ------------------------------------------------------------
+#  ------------------  Batched (on device)  -------------------
+#  ------------------------------------------------------------
+class BatchedVideoTransform:
+    '''
+    Batched counterpart of the per-sample pipelines
+    Compose([ToTensorVideo(), RandomHorizontalFlipVideo(), CenterCropResizeVideo / UCFCenterCropVideo, Normalize]).
+    Takes the uint8 clips of a whole batch, (B, T, C, H, W), moves them to the
+    training device and runs flip, crop, resize and normalize once for the
+    batch. The flip is drawn per sample; the crops are center crops, so the
+    result of each sample matches the per-sample pipeline with the same flip.
+    Clips of different resolutions can be passed as a list, they are grouped
+    by shape.
+    '''
+    def __init__(
+        self,
+        size,
+        crop_mode="center_crop_resize",
+        flip_p=0.,
+        mean=(0.5, 0.5, 0.5),
+        std=(0.5, 0.5, 0.5),
+        interpolation_mode="bilinear",
+    ):
+        if isinstance(size, tuple):
+            if len(size) != 2:
+                raise ValueError(f"size should be tuple (height, width), instead got {size}")
+            self.size = size
+        else:
+            self.size = (size, size)
+        if crop_mode not in ["center_crop_resize", "ucf_center_crop"]:
+            raise ValueError(f"unknown crop_mode {crop_mode}")
+        self.crop_mode = crop_mode
+        self.flip_p = flip_p
+        self.mean = mean
+        self.std = std
+        self.interpolation_mode = interpolation_mode
+
+    def _transform(self, videos, generator=None):
+        B, T, C, H, W = videos.shape
+        clip = to_tensor(videos.reshape(B * T, C, H, W))
+        if self.flip_p > 0:
+            flip = torch.rand(B, generator=generator, device=clip.device) < self.flip_p
+            flip = flip.repeat_interleave(T)[:, None, None, None]
+            clip = torch.where(flip, hflip(clip), clip)
+        if self.crop_mode == "center_crop_resize":
+            clip = resize(center_crop_using_short_edge(clip), target_size=self.size, interpolation_mode=self.interpolation_mode)
+        else:
+            clip = center_crop(resize_scale(clip, target_size=self.size, interpolation_mode=self.interpolation_mode), self.size)
+        # same as transforms.Normalize on (..., C, H, W)
+        mean = torch.as_tensor(self.mean, dtype=clip.dtype, device=clip.device)[:, None, None]
+        std = torch.as_tensor(self.std, dtype=clip.dtype, device=clip.device)[:, None, None]
+        clip = clip.sub_(mean).div_(std)
+        return clip.reshape(B, T, *clip.shape[1:])
+
+    def __call__(self, videos, device=None, generator=None):
+        """
+        Args:
+            videos (torch.tensor or list, dtype=torch.uint8): Size is (B, T, C, H, W), or a list of (T, C, H, W)
+            device: device on which the transforms run
+        Return:
+            torch.tensor, dtype=torch.float: Size is (B, T, C, size, size)
+        """
+        if torch.is_tensor(videos):
+            return self._transform(videos.to(device, non_blocking=True), generator)
+        outputs = [None] * len(videos)
+        shapes = {}
+        for i, video in enumerate(videos):
+            shapes.setdefault(tuple(video.shape), []).append(i)
+        for indices in shapes.values():
+            group = torch.stack([videos[i] for i in indices]).to(device, non_blocking=True)
+            for i, video in zip(indices, self._transform(group, generator)):
+                outputs[i] = video
+        return torch.stack(outputs)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(size={self.size}, crop_mode={self.crop_mode}, flip_p={self.flip_p}, interpolation_mode={self.interpolation_mode})"
+
+
+def collate_uint8_videos(batch):
+    """
+    DataLoader collate_fn for BatchedVideoTransform: clips of different
+    resolutions cannot be stacked by the workers and are kept as a list.
+    """
+    videos = [sample['video'] for sample in batch]
+    if all(video.shape == videos[0].shape for video in videos):
+        return default_collate(batch)
+    collated = default_collate([{k: v for k, v in sample.items() if k != 'video'} for sample in batch])
+    collated['video'] = videos
+    return collated
+
+    
 #  ------------------------------------------------------------
 #  ---------------------  Sampling  ---------------------------
 #  ------------------------------------------------------------
@@ -427,6 +519,38 @@ class TemporalRandomCrop(object):
 		return begin_index, end_index
     
 
+def check_batched_transform(batch_size=6, num_frames=4, size=64):
+    """
+    CPU parity check of BatchedVideoTransform and the per-sample Compose pipelines,
+    with the same per-sample flips and clips of two resolutions.
+    """
+    from torchvision import transforms
+
+    torch.manual_seed(0)
+    videos = [torch.randint(0, 256, (num_frames, 3) + shape, dtype=torch.uint8)
+              for shape in [(96, 128), (80, 80)] * (batch_size // 2)]
+    for crop_mode, crop in [("center_crop_resize", CenterCropResizeVideo(size)),
+                            ("ucf_center_crop", UCFCenterCropVideo(size))]:
+        batched = BatchedVideoTransform(size, crop_mode=crop_mode, flip_p=0.5)
+        outputs = batched(videos, generator=torch.Generator().manual_seed(1))
+        # the flips drawn by the batched transform: one draw of torch.rand per resolution group
+        generator = torch.Generator().manual_seed(1)
+        flips = {}
+        for shape in dict.fromkeys(tuple(video.shape) for video in videos):
+            indices = [i for i, video in enumerate(videos) if tuple(video.shape) == shape]
+            flips.update(zip(indices, (torch.rand(len(indices), generator=generator) < 0.5).tolist()))
+        for i, video in enumerate(videos):
+            reference = transforms.Compose([
+                ToTensorVideo(),
+                RandomHorizontalFlipVideo(p=1. if flips[i] else 0.),
+                crop,
+                transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
+            ])(video)
+            assert torch.allclose(outputs[i], reference, atol=1e-5), (crop_mode, i, (outputs[i] - reference).abs().max())
+        print(f"BatchedVideoTransform({crop_mode}) matches the per-sample pipeline on {batch_size} clips "
+              f"({sum(flips.values())} flipped)")
+
+
 if __name__ == '__main__':
     from torchvision import transforms
     import torchvision.io as io
@@ -434,6 +558,8 @@ if __name__ == '__main__':
     from torchvision.utils import save_image
     import os
 
+    check_batched_transform()
+
     vframes, aframes, info = io.read_video(
     filename='./v_Archery_g01_c03.avi',
     pts_unit='sec',
@@ -16,7 +16,9 @@ def create_diffusion(
     learn_sigma=True,
     # learn_sigma=False,
     rescale_learned_sigmas=False,
-    diffusion_steps=1000
+    diffusion_steps=1000,
+    prr_reduction="global",
+    prr_layer_weights=None
 ):
     betas = gd.get_named_beta_schedule(noise_schedule, diffusion_steps)
     if use_kl:
@@ -42,6 +44,8 @@ def create_diffusion(
             if not learn_sigma
             else gd.ModelVarType.LEARNED_RANGE
         ),
-        loss_type=loss_type
+        loss_type=loss_type,
+        prr_reduction=prr_reduction,
+        prr_layer_weights=prr_layer_weights
         # rescale_timesteps=rescale_timesteps,
     )
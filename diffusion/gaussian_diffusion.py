@@ -13,7 +13,7 @@ import enum
 from einops import rearrange
 
 from .diffusion_utils import discretized_gaussian_log_likelihood, normal_kl
-from torchmetrics.functional.regression import pearson_corrcoef
+from .prr_loss import PRRLoss
 
 def mean_flat(tensor):
     """
@@ -22,6 +22,16 @@ def mean_flat(tensor):
     return tensor.mean(dim=list(range(1, len(tensor.shape))))
 
 
+def masked_mean_flat(tensor, mask=None):
+    """
+    Take the mean over all non-batch dimensions of the elements where the
+    (broadcastable) mask is 1, or over all of them without a mask.
+    """
+    if mask is None:
+        return mean_flat(tensor)
+    return mean_flat(tensor * mask) / mean_flat(mask.expand_as(tensor))
+
+
 class ModelMeanType(enum.Enum):
     """
     Which type of output the model predicts.
@@ -143,6 +153,31 @@ def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     return np.array(betas)
 
 
+def get_sampling_timesteps(alphas_cumprod, num_steps, skip_type="time_uniform"):
+    """
+    Select the timesteps visited by a few-step sampler, from T-1 down to 0.
+    :param alphas_cumprod: the 1-D alpha_bar array of the diffusion process.
+    :param num_steps: the number of timesteps (model evaluations) to select.
+    :param skip_type: "time_uniform" (uniform in t), "time_quadratic" (denser
+                      near t = 0) or "logSNR" (uniform in the half log-SNR
+                      lambda = log(alpha / sigma), recommended for DPM-Solver).
+    :return: a strictly decreasing numpy array of integer timesteps; it may be
+             shorter than num_steps if rounding merges neighbouring steps.
+    """
+    num_timesteps = len(alphas_cumprod)
+    if skip_type == "time_uniform":
+        timesteps = np.linspace(num_timesteps - 1, 0, num_steps)
+    elif skip_type == "time_quadratic":
+        timesteps = np.linspace(np.sqrt(num_timesteps - 1), 0, num_steps) ** 2
+    elif skip_type == "logSNR":
+        lambdas = 0.5 * np.log(alphas_cumprod / (1.0 - alphas_cumprod))  # decreasing in t
+        grid = np.linspace(lambdas[-1], lambdas[0], num_steps)
+        timesteps = np.interp(grid, lambdas[::-1], np.arange(num_timesteps)[::-1])
+    else:
+        raise NotImplementedError(f"unknown skip type: {skip_type}")
+    return np.unique(np.round(timesteps).astype(np.int64))[::-1]
+
+
 class GaussianDiffusion:
     """
     Utilities for training and sampling diffusion models.
@@ -158,12 +193,15 @@ class GaussianDiffusion:
         betas,
         model_mean_type,
         model_var_type,
-        loss_type
+        loss_type,
+        prr_reduction="global",
+        prr_layer_weights=None
     ):
 
         self.model_mean_type = model_mean_type
         self.model_var_type = model_var_type
         self.loss_type = loss_type
+        self.prr_loss = PRRLoss(prr_reduction, prr_layer_weights)
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -202,6 +240,58 @@ class GaussianDiffusion:
             (1.0 - self.alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - self.alphas_cumprod)
         )
 
+        # derived tables indexed by p_mean_variance / q_mean_variance
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        self.log_betas = np.log(betas)
+        # for fixedlarge, we set the initial (log-)variance like so
+        # to get a better decoder log likelihood.
+        self.fixed_large_variance = np.append(
+            self.posterior_variance[1], betas[1:]
+        ) if len(self.posterior_variance) > 1 else np.array([])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+
+        # device copies of the tables above, see _extract()
+        self._schedule_tensors = {}
+
+    def _schedule_tensor(self, name, device, dtype=th.float32):
+        """
+        Get the schedule array self.<name> as a tensor, copied once per device and dtype.
+        """
+        key = (name, th.device(device), dtype)
+        tensor = self._schedule_tensors.get(key)
+        if tensor is None:
+            tensor = th.from_numpy(getattr(self, name)).to(dtype=dtype).to(device)
+            self._schedule_tensors[key] = tensor
+        return tensor
+
+    def _model_timestep(self, index):
+        """
+        The timestep the model sees for step ``index`` of this process (see SpacedDiffusion).
+        """
+        return index
+
+    def _step_kwargs(self, model_kwargs, index):
+        """
+        model_kwargs of the sampling step ``index``. Guided samplers (a "guidance_interval"
+        in model_kwargs, see models.utils.GuidanceMixin) also get the model timestep as a
+        python int, ``t_host``, so they can skip the unconditional pass without reading
+        ``t`` back from the device.
+        """
+        if model_kwargs is None or "guidance_interval" not in model_kwargs:
+            return model_kwargs
+        return dict(model_kwargs, t_host=int(self._model_timestep(index)))
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Same as _extract_into_tensor() for the schedule array self.<name>, but
+        indexes a cached device copy and returns a broadcast view instead of a
+        materialized tensor of broadcast_shape. The view shares one value per
+        sample over the broadcast dims, so it must not be modified in place
+        (call .contiguous() first).
+        """
+        res = self._schedule_tensor(name, timesteps.device)[timesteps]
+        return res.view(-1, *([1] * (len(broadcast_shape) - 1))).expand(broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -209,9 +299,9 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(self.log_one_minus_alphas_cumprod, t, x_start.shape)
+        mean = self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract("log_one_minus_alphas_cumprod", t, x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -227,8 +317,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape) * noise
         )
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
@@ -238,12 +328,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -291,27 +381,19 @@ class GaussianDiffusion:
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, F, C * 2, *x.shape[3:])
             model_output, model_var_values = th.split(model_output, C, dim=2)
-            min_log = _extract_into_tensor(self.posterior_log_variance_clipped, t, x.shape)
-            max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+            min_log = self._extract("posterior_log_variance_clipped", t, x.shape)
+            max_log = self._extract("log_betas", t, x.shape)
             # The model_var_values is [-1, 1] for [min_var, max_var].
             frac = (model_var_values + 1) / 2
             model_log_variance = frac * max_log + (1 - frac) * min_log
             model_variance = th.exp(model_log_variance)
         else:
             model_variance, model_log_variance = {
-                # for fixedlarge, we set the initial (log-)variance like so
-                # to get a better decoder log likelihood.
-                ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
-                ),
-                ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
-                ),
+                ModelVarType.FIXED_LARGE: ("fixed_large_variance", "fixed_large_log_variance"),
+                ModelVarType.FIXED_SMALL: ("posterior_variance", "posterior_log_variance_clipped"),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -340,14 +422,14 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t - pred_xstart
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def condition_mean(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
         """
@@ -369,7 +451,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(x, t, **model_kwargs)
@@ -511,7 +593,7 @@ class GaussianDiffusion:
                     clip_denoised=clip_denoised,
                     denoised_fn=denoised_fn,
                     cond_fn=cond_fn,
-                    model_kwargs=model_kwargs,
+                    model_kwargs=self._step_kwargs(model_kwargs, i),
                 )
                 yield out
                 img = out["sample"]
@@ -546,8 +628,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -593,10 +675,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = out["pred_xstart"] * th.sqrt(alpha_bar_next) + th.sqrt(1 - alpha_bar_next) * eps
@@ -679,19 +761,136 @@ class GaussianDiffusion:
                     clip_denoised=clip_denoised,
                     denoised_fn=denoised_fn,
                     cond_fn=cond_fn,
-                    model_kwargs=model_kwargs,
+                    model_kwargs=self._step_kwargs(model_kwargs, i),
                     eta=eta,
                 )
                 yield out
                 img = out["sample"]
 
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        num_steps=20,
+        order=2,
+        skip_type="time_uniform",
+        lower_order_final=True,
+    ):
+        """
+        Generate samples from the model with the multistep DPM-Solver++
+        (Lu et al., 2022), a high-order solver of the probability flow ODE.
+        Same usage as p_sample_loop(), plus:
+        :param num_steps: the number of model evaluations, typically 15-25.
+        :param order: the solver order, 1 (equivalent to DDIM), 2 or 3.
+        :param skip_type: the timestep selection, see get_sampling_timesteps().
+        :param lower_order_final: use lower orders for the last steps, which
+                                  stabilizes sampling with few steps.
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            num_steps=num_steps,
+            order=order,
+            skip_type=skip_type,
+            lower_order_final=lower_order_final,
+        ):
+            final = sample
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        num_steps=20,
+        order=2,
+        skip_type="time_uniform",
+        lower_order_final=True,
+    ):
+        """
+        Use DPM-Solver++ to sample from the model and yield the intermediate
+        samples, dicts with "sample" (x at the next timestep, the final x_0
+        estimate at the end) and "pred_xstart".
+        The model is queried through p_mean_variance(), so epsilon, x_start and
+        learned-sigma outputs are all supported; the solver works on the x_0
+        predictions (data prediction), which also makes clip_denoised and
+        denoised_fn apply as in the other samplers.
+        Sample with the full (un-respaced) process, e.g. create_diffusion(""),
+        so that the timesteps can be chosen freely.
+        """
+        assert order in (1, 2, 3), "DPM-Solver++ is implemented for orders 1, 2 and 3"
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        timesteps = get_sampling_timesteps(self.alphas_cumprod, num_steps, skip_type)
+        # python floats, so that the solver coefficients are scalars and not device tensors
+        alphas = np.sqrt(self.alphas_cumprod[timesteps]).tolist()
+        sigmas = np.sqrt(1.0 - self.alphas_cumprod[timesteps]).tolist()
+        lambdas = [math.log(alpha / sigma) for alpha, sigma in zip(alphas, sigmas)]
+        indices = list(range(len(timesteps)))
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        model_prev = []  # x_0 predictions at the previous timesteps, most recent last
+        for i in indices:
+            t = th.tensor([timesteps[i]] * shape[0], device=device)
+            with th.no_grad():
+                out = self.p_mean_variance(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=self._step_kwargs(model_kwargs, timesteps[i]),
+                )
+                model_prev = (model_prev + [out["pred_xstart"]])[-order:]
+                if i == len(timesteps) - 1:
+                    # last evaluation at t = 0: return the x_0 prediction, as DDIM does
+                    yield {"sample": out["pred_xstart"], "pred_xstart": out["pred_xstart"]}
+                    break
+                step_order = min(order, i + 1)
+                if lower_order_final:
+                    step_order = min(step_order, len(timesteps) - 1 - i)
+                img = _dpm_solver_pp_update(
+                    img, model_prev[-step_order:], alphas, sigmas, lambdas, i, i + 1
+                )
+                yield {"sample": img, "pred_xstart": out["pred_xstart"]}
+
     def _vb_terms_bpd(
-            self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
+            self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None, loss_mask=None
     ):
         """
         Get a term for the variational lower-bound.
         The resulting units are bits (rather than nats, as one might expect).
         This allows for comparison to other papers.
+        :param loss_mask: if not None, a tensor broadcastable to x_start, the terms
+                          are averaged over the elements where it is 1.
         :return: a dict with the following keys:
                  - 'output': a shape [N] tensor of NLLs or KLs.
                  - 'pred_xstart': the x_0 predictions.
@@ -705,13 +904,13 @@ class GaussianDiffusion:
         kl = normal_kl(
             true_mean, true_log_variance_clipped, out["mean"], out["log_variance"]
         )
-        kl = mean_flat(kl) / np.log(2.0)
+        kl = masked_mean_flat(kl, loss_mask) / np.log(2.0)
 
         decoder_nll = -discretized_gaussian_log_likelihood(
             x_start, means=out["mean"], log_scales=0.5 * out["log_variance"]
         )
         assert decoder_nll.shape == x_start.shape
-        decoder_nll = mean_flat(decoder_nll) / np.log(2.0)
+        decoder_nll = masked_mean_flat(decoder_nll, loss_mask) / np.log(2.0)
 
         # At the first timestep return the decoder NLL,
         # otherwise return KL(q(x_{t-1}|x_t,x_0) || p(x_{t-1}|x_t))
@@ -729,9 +928,15 @@ class GaussianDiffusion:
         :param noise: if specified, the specific Gaussian noise to try to remove.
         :return: a dict with the key "loss" containing a tensor of shape [N].
                  Some mean or variance settings may also have other keys.
+        A "loss_mask" in model_kwargs (not passed to the model) restricts the MSE/VB
+        terms to the elements where it is 1, e.g. the tokens kept by token masking.
+        When the model also returns priors and features, "prr" holds the [N] PRR
+        loss (see prr_loss.py); the key is absent otherwise.
         """
         if model_kwargs is None:
             model_kwargs = {}
+        model_kwargs = dict(model_kwargs)
+        loss_mask = model_kwargs.pop("loss_mask", None)
         if noise is None:
             noise = th.randn_like(x_start)
         x_t = self.q_sample(x_start, t, noise=noise)
@@ -746,27 +951,21 @@ class GaussianDiffusion:
                 t=t,
                 clip_denoised=False,
                 model_kwargs=model_kwargs,
+                loss_mask=loss_mask,
             )["output"]
             if self.loss_type == LossType.RESCALED_KL:
                 terms["loss"] *= self.num_timesteps
         elif self.loss_type == LossType.MSE or self.loss_type == LossType.RESCALED_MSE:
-            model_output, attentions, features = model(x_t, t, **model_kwargs)
+            model_output = model(x_t, t, **model_kwargs)
             # try:
             #     model_output = model(x_t, t, **model_kwargs).sample # for tav unet
             # except:
             #     model_output = model(x_t, t, **model_kwargs)
-            
-            attentions, features = torch.mean(attentions, dim=-1), torch.mean(features, dim=-1)
-            Layer_norm = nn.LayerNorm(attentions.shape[-1], elementwise_affine=False, eps=1e-6)
-            attentions, features = Layer_norm(attentions), Layer_norm(features)
-            # attentions = rearrange(attentions, '(b f) c  -> b f c ', b=1).contiguous()
-            # features = rearrange(features, '(b f) c  -> b f c ', b=1).contiguous()
-            L_prr = 0
-            # per1 = (1 - pearson_corrcoef(attentions.permute(1, 0), features.permute(1, 0)))
-            # per1 = (1 - pearson_corrcoef(attentions.permute(0, 2, 1), features.permute(0, 2, 1)))
-            per1 = (1 - pearson_corrcoef(attentions.view(-1), features.view(-1)))
-            L_prr = torch.mean(per1)
-            # print(attentions is not None)
+            if isinstance(model_output, tuple):  # (output, priors, features) when priors are given
+                model_output, attentions, features = model_output
+                if attentions is not None:
+                    terms["prr"] = self.prr_loss(attentions, features, x_start.shape[0],
+                                                 len(model_kwargs.get("special_list") or [None]))
             if self.model_var_type in [
                 ModelVarType.LEARNED,
                 ModelVarType.LEARNED_RANGE,
@@ -783,6 +982,7 @@ class GaussianDiffusion:
                     x_t=x_t,
                     t=t,
                     clip_denoised=False,
+                    loss_mask=loss_mask,
                 )["output"]
                 if self.loss_type == LossType.RESCALED_MSE:
                     # Divide by 1000 for equivalence with initial implementation.
@@ -797,15 +997,11 @@ class GaussianDiffusion:
                 ModelMeanType.EPSILON: noise,
             }[self.model_mean_type]
             assert model_output.shape == target.shape == x_start.shape
-            terms["mse"] = mean_flat((target - model_output) ** 2)
+            terms["mse"] = masked_mean_flat((target - model_output) ** 2, loss_mask)
             if "vb" in terms:
                 terms["loss"] = terms["mse"] + terms["vb"]
             else:
                 terms["loss"] = terms["mse"]
-            # print(terms["mse"], L_prr)
-            if attentions is None:
-                L_prr = -1
-            terms["prr"] = L_prr
             
             # if DINO_model is not None:
             #     b, f, c, h, w = model_output.shape
@@ -833,13 +1029,12 @@ class GaussianDiffusion:
 
         terms = {}
 
-        model_output, attentions, features = model(x_t, t, x_prev, init_s, **model_kwargs)
-
-        attentions, features = torch.mean(attentions, dim=-1), torch.mean(features, dim=-1)
-        Layer_norm = nn.LayerNorm(attentions.shape[-1], elementwise_affine=False, eps=1e-6)
-        attentions, features = Layer_norm(attentions), Layer_norm(features)
-        per1 = (1 - pearson_corrcoef(attentions.view(-1), features.view(-1)))
-        L_prr = torch.mean(per1)
+        model_output = model(x_t, t, x_prev, init_s, **model_kwargs)
+        if isinstance(model_output, tuple):  # (output, priors, features) when priors are given
+            model_output, attentions, features = model_output
+            if attentions is not None:
+                terms["prr"] = self.prr_loss(attentions, features, x_start.shape[0],
+                                             len(model_kwargs.get("special_list") or [None]))
         if self.model_var_type in [
             ModelVarType.LEARNED,
             ModelVarType.LEARNED_RANGE,
@@ -875,9 +1070,6 @@ class GaussianDiffusion:
                 terms["loss"] = terms["mse"] + terms["vb"]
             else:
                 terms["loss"] = terms["mse"]
-            if attentions is None:
-                L_prr = -1
-            terms["prr"] = L_prr
 
         else:
             raise NotImplementedError(self.loss_type)
@@ -956,6 +1148,32 @@ class GaussianDiffusion:
         }
 
 
+def _dpm_solver_pp_update(x, model_prev, alphas, sigmas, lambdas, s, t):
+    """
+    One multistep DPM-Solver++ update of x from timestep index s to index t.
+    :param model_prev: the x_0 predictions at indices s - k + 1, ..., s (the
+                       order k of the update is their number, 1 to 3).
+    :param alphas, sigmas, lambdas: per-index alpha_t, sigma_t and
+                                    lambda_t = log(alpha_t / sigma_t).
+    """
+    h = lambdas[t] - lambdas[s]
+    phi_1 = math.expm1(-h)
+    x_t = (sigmas[t] / sigmas[s]) * x - (alphas[t] * phi_1) * model_prev[-1]
+    if len(model_prev) == 1:
+        return x_t
+    r0 = (lambdas[s] - lambdas[s - 1]) / h
+    D1_0 = (1.0 / r0) * (model_prev[-1] - model_prev[-2])
+    if len(model_prev) == 2:
+        return x_t - (0.5 * alphas[t] * phi_1) * D1_0
+    r1 = (lambdas[s - 1] - lambdas[s - 2]) / h
+    D1_1 = (1.0 / r1) * (model_prev[-2] - model_prev[-3])
+    D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+    D2 = (1.0 / (r0 + r1)) * (D1_0 - D1_1)
+    phi_2 = phi_1 / h + 1.0
+    phi_3 = phi_2 / h - 0.5
+    return x_t + (alphas[t] * phi_2) * D1 - (alphas[t] * phi_3) * D2
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
@@ -963,9 +1181,73 @@ def _extract_into_tensor(arr, timesteps, broadcast_shape):
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
-    :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
+    :return: a tensor of broadcast_shape, an expand() view of the [batch_size]
+             values (stride 0 over the broadcast dims): use it out of place, or
+             call .contiguous() before writing to it in place.
     """
     res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
-    return res + th.zeros(broadcast_shape, device=timesteps.device)
+    return res.expand(broadcast_shape)
+
+
+if __name__ == "__main__":
+    # Convergence check of the DPM-Solver++ sampler on a Gaussian toy
+    # distribution x_0 ~ N(mu, s^2), for which both the optimal denoiser and
+    # the probability flow ODE solution are known in closed form.
+    # Run with: python -m diffusion.gaussian_diffusion
+    from . import create_diffusion
+
+    mu, s = 0.5, 0.3
+    diffusion = create_diffusion("")
+    alphas_cumprod = th.from_numpy(diffusion.alphas_cumprod).float()
+
+    class GaussianToyModel(th.nn.Module):
+        def forward(self, x, t, **kwargs):
+            alpha_bar = alphas_cumprod.to(x.device)[t].view(-1, *([1] * (x.dim() - 1)))
+            alpha, sigma = alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+            x0 = mu + alpha * s ** 2 * (x - alpha * mu) / (alpha_bar * s ** 2 + sigma ** 2)  # E[x_0 | x_t]
+            return th.cat([(x - alpha * x0) / sigma, th.zeros_like(x)], dim=2)  # eps, learned-range variance
+
+    def exact_sample(x_T):
+        # the ODE is linear: x_t - alpha_t mu scales with sqrt(alpha_t^2 s^2 + sigma_t^2)
+        def std(alpha_bar):
+            return math.sqrt(alpha_bar * s ** 2 + 1 - alpha_bar)
+        a_T, a_0 = diffusion.alphas_cumprod[-1], diffusion.alphas_cumprod[0]
+        x_0 = math.sqrt(a_0) * mu + std(a_0) / std(a_T) * (x_T - math.sqrt(a_T) * mu)
+        return mu + math.sqrt(a_0) * s ** 2 * (x_0 - math.sqrt(a_0) * mu) / std(a_0) ** 2
+
+    th.manual_seed(0)
+    shape = (64, 1, 1, 4, 4)
+    x_T = th.randn(*shape, dtype=th.float64)
+    reference = exact_sample(x_T)
+    model = GaussianToyModel()
+    # Below `floor` the low-step error of the higher orders can change sign and
+    # briefly cancel (logSNR order 2 at 10 steps), so only require shrinking
+    # above it; the observed rate from 20 to 40 steps then checks the order.
+    floor, tolerance = 2e-2, 0.15
+    min_rate = {1: 1.5, 2: 3.0, 3: 3.0}
+    all_errors = {}
+    for skip_type in ["time_uniform", "logSNR"]:
+        for order in [1, 2, 3]:
+            errors = []
+            for num_steps in [5, 10, 20, 40]:
+                sample = diffusion.dpm_solver_sample_loop(
+                    model, shape, noise=x_T.float(), clip_denoised=False, device="cpu",
+                    num_steps=num_steps, order=order, skip_type=skip_type,
+                )
+                errors.append((sample.double() - reference).abs().max().item())
+            print(f"{skip_type:>12} order {order}: max error at 5/10/20/40 steps",
+                  " ".join(f"{e:.2e}" for e in errors))
+            for coarse, fine in zip(errors[:-1], errors[1:]):
+                assert fine < coarse or max(coarse, fine) < floor, (skip_type, order, errors)
+            assert errors[-1] < errors[0] / 5, (skip_type, order, errors)
+            assert errors[2] / errors[3] > min_rate[order], (skip_type, order, errors)
+            all_errors[skip_type, order] = errors
+    for skip_type in ["time_uniform", "logSNR"]:
+        for order in [2, 3]:
+            errors, lower = all_errors[skip_type, order], all_errors[skip_type, order - 1]
+            assert errors[2] < tolerance, (skip_type, order, errors)
+            assert errors[2] < all_errors[skip_type, 1][2], (skip_type, order, errors)
+            assert errors[2] < lower[2] and errors[3] < lower[3], (skip_type, order, errors, lower)
+    print("DPM-Solver++ converges on the Gaussian toy")
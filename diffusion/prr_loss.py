@@ -0,0 +1,142 @@
+import torch
+import torch.nn.functional as F
+
+
+PRR_REDUCTIONS = ("global", "layer", "sample")
+
+
+def pearson(x, y, eps=1e-6):
+    """Pearson correlation of x and y along the last dim, batched over the others."""
+    x = x - x.mean(dim=-1, keepdim=True)
+    y = y - y.mean(dim=-1, keepdim=True)
+    return (x * y).sum(dim=-1) / (x.norm(dim=-1) * y.norm(dim=-1)).clamp_min(eps)
+
+
+def select_layer_weights(layer_weights, mode):
+    """PRR layer weights of a prior mode: a list for every mode or a {mode: list} mapping (None: equal)."""
+    if layer_weights is not None and hasattr(layer_weights, "keys"):
+        return layer_weights.get(mode)
+    return layer_weights
+
+
+class PRRLoss:
+    """
+    Prior regularization (PRR) loss: 1 - Pearson correlation between the DINO
+    priors and the features of the special blocks, as returned by the models
+    (``(L * N, T, D)``, layer-major, N = batch * frames).
+
+    Each token is reduced to its mean over D and every row is standardized over
+    its T tokens (a layer norm without affine parameters), then:
+        global  one correlation over all layers, frames and tokens (the original loss);
+        layer   one correlation per layer, combined with ``layer_weights``;
+        sample  one correlation per layer and sample (over its frames and tokens),
+                combined with ``layer_weights`` into a per-sample loss.
+    All correlations of a call come from one batched reduction and nothing is
+    read back to the host.
+
+    :param reduction: one of PRR_REDUCTIONS.
+    :param layer_weights: weight of each special layer (normalized to sum to 1),
+                          None for equal weights; not used by 'global'.
+    """
+    def __init__(self, reduction="global", layer_weights=None, eps=1e-6):
+        if reduction not in PRR_REDUCTIONS:
+            raise ValueError(f"unknown PRR reduction {reduction!r}, expected one of {PRR_REDUCTIONS}")
+        if reduction == "global" and layer_weights is not None:
+            raise ValueError("layer_weights need the 'layer' or 'sample' PRR reduction")
+        self.reduction = reduction
+        self.layer_weights = None
+        if layer_weights is not None:
+            layer_weights = torch.as_tensor(list(layer_weights), dtype=torch.float32)
+            self.layer_weights = layer_weights / layer_weights.sum()
+        self.eps = eps
+        self._device_weights = {}
+
+    def _weights(self, num_layers, device):
+        if self.layer_weights is None:
+            return torch.full((num_layers,), 1.0 / num_layers, device=device)
+        if len(self.layer_weights) != num_layers:
+            raise ValueError(f"{len(self.layer_weights)} PRR layer weights for {num_layers} layers")
+        if device not in self._device_weights:  # copied once per device
+            self._device_weights[device] = self.layer_weights.to(device)
+        return self._device_weights[device]
+
+    def __call__(self, attentions, features, batch_size, num_layers=1):
+        """
+        :param attentions: (L * N, T, D) priors.
+        :param features: (L * N, T, D) block features.
+        :param batch_size: number of samples (videos) in the batch.
+        :param num_layers: number of special layers L.
+        :return: a [batch_size] tensor, the PRR loss of each sample.
+        """
+        assert attentions.shape == features.shape, (attentions.shape, features.shape)
+        attentions = attentions.float().mean(dim=-1)
+        features = features.float().mean(dim=-1)
+        attentions = F.layer_norm(attentions, attentions.shape[-1:], eps=self.eps)
+        features = F.layer_norm(features, features.shape[-1:], eps=self.eps)
+
+        if self.reduction == "global":
+            loss = 1 - pearson(attentions.reshape(-1), features.reshape(-1))
+            return loss.expand(batch_size)
+
+        if attentions.shape[0] % (num_layers * batch_size) != 0:
+            raise ValueError(f"{attentions.shape[0]} prior rows do not split into {num_layers} layers "
+                             f"of {batch_size} samples")
+        group = (num_layers, -1) if self.reduction == "layer" else (num_layers, batch_size, -1)
+        per_group = 1 - pearson(attentions.reshape(*group), features.reshape(*group))
+        weights = self._weights(num_layers, per_group.device)
+        if self.reduction == "layer":
+            return (weights @ per_group).expand(batch_size)
+        return weights @ per_group
+
+
+if __name__ == "__main__":
+    # The 'global' reduction matches the original per-step nn.LayerNorm + torchmetrics
+    # computation; the other reductions match a loop over layers/samples; timings of the
+    # original and the batched loss.
+    # python -m diffusion.prr_loss
+    import time
+    import torch.nn as nn
+    from torchmetrics.functional.regression import pearson_corrcoef
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    L, B, Fr, T, D = 4, 4, 16, 64, 1152
+    attentions = torch.randn(L * B * Fr, T, D, device=device)
+    features = 0.5 * attentions + torch.randn(L * B * Fr, T, D, device=device)
+
+    def original(attentions, features):
+        attentions, features = torch.mean(attentions, dim=-1), torch.mean(features, dim=-1)
+        Layer_norm = nn.LayerNorm(attentions.shape[-1], elementwise_affine=False, eps=1e-6)
+        attentions, features = Layer_norm(attentions), Layer_norm(features)
+        return torch.mean(1 - pearson_corrcoef(attentions.view(-1), features.view(-1)))
+
+    ref = original(attentions, features)
+    out = PRRLoss()(attentions, features, B, L)
+    print(f"global: {out[0].item():.6f} vs original {ref.item():.6f}")
+    assert out.shape == (B,) and torch.allclose(out, ref.expand(B), atol=1e-5)
+
+    weights = [1., 2., 3., 4.]
+    a = F.layer_norm(attentions.mean(-1), (T,), eps=1e-6).view(L, B, Fr * T)
+    f = F.layer_norm(features.mean(-1), (T,), eps=1e-6).view(L, B, Fr * T)
+    ref = sum(w / sum(weights) * (1 - pearson_corrcoef(a[l].reshape(-1), f[l].reshape(-1)))
+              for l, w in enumerate(weights))
+    out = PRRLoss("layer", weights)(attentions, features, B, L)
+    assert torch.allclose(out, ref.expand(B), atol=1e-5), (out, ref)
+    ref = torch.stack([sum(w / sum(weights) * (1 - pearson_corrcoef(a[l, b], f[l, b])) for l, w in enumerate(weights))
+                       for b in range(B)])
+    out = PRRLoss("sample", weights)(attentions, features, B, L)
+    assert torch.allclose(out, ref, atol=1e-5), (out, ref)
+    print("layer/sample reductions match the per-layer/per-sample loops")
+
+    for name, fn in [("original", original), ("PRRLoss", PRRLoss("sample", weights))]:
+        args = (attentions, features) if name == "original" else (attentions, features, B, L)
+        for _ in range(3):
+            fn(*args)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(20):
+            fn(*args)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        print(f"{name:>8}: {(time.time() - start) / 20 * 1e3:.2f} ms/call")
@@ -85,6 +85,8 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        # device copies of timestep_map, shared by the (per call) model wrappers
+        self._map_tensors = {}
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -113,43 +115,101 @@ class SpacedDiffusion(GaussianDiffusion):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.original_num_steps
+            model, self.timestep_map, self.original_num_steps, self._map_tensors
         )
 
     def _wrap_model_long(self, model):
         if isinstance(model, _WrappedModel_long):
             return model
         return _WrappedModel_long(
-            model, self.timestep_map, self.original_num_steps
+            model, self.timestep_map, self.original_num_steps, self._map_tensors
         )
 
+    def _model_timestep(self, index):
+        return self.timestep_map[index]
+
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
         return t
 
 
+def _map_tensor(wrapper, ts):
+    # the timestep map is copied once per device and dtype, not at every model call
+    key = (ts.device, ts.dtype)
+    map_tensor = wrapper._map_tensors.get(key)
+    if map_tensor is None:
+        map_tensor = th.tensor(wrapper.timestep_map, device=ts.device, dtype=ts.dtype)
+        wrapper._map_tensors[key] = map_tensor
+    return map_tensor
+
+
 class _WrappedModel:
-    def __init__(self, model, timestep_map, original_num_steps):
+    def __init__(self, model, timestep_map, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         # self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self._map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _map_tensor(self, ts)[ts]
         # if self.rescale_timesteps:
         #     new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
 
 class _WrappedModel_long:
-    def __init__(self, model, timestep_map, original_num_steps):
+    def __init__(self, model, timestep_map, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         # self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self._map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, x_p, init_s, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
-        return self.model(x, new_ts, x_p, init_s, **kwargs)
\ No newline at end of file
+        new_ts = _map_tensor(self, ts)[ts]
+        return self.model(x, new_ts, x_p, init_s, **kwargs)
+
+if __name__ == "__main__":
+    # Microbenchmark of a 250-step p_sample_loop on a toy model: cached device
+    # schedule tables vs. the previous per-call numpy -> device copies and
+    # materialized broadcasts. Run with: python -m diffusion.respace
+    import time
+    from . import create_diffusion, respace
+    from . import gaussian_diffusion as gd
+
+    class ToyModel(th.nn.Module):
+        def forward(self, x, t, **kwargs):
+            return th.cat([0.1 * x, th.zeros_like(x)], dim=2)  # eps and learned-range variance
+
+    def legacy_extract(self, name, timesteps, broadcast_shape):
+        res = gd._extract_into_tensor(getattr(self, name), timesteps, broadcast_shape)
+        return res + th.zeros(broadcast_shape, device=timesteps.device)
+
+    def legacy_map_tensor(wrapper, ts):
+        return th.tensor(wrapper.timestep_map, device=ts.device, dtype=ts.dtype)
+
+    device = "cuda" if th.cuda.is_available() else "cpu"
+    shape = (2, 16, 4, 32, 32)
+    noise = th.randn(*shape, device=device)
+    model = ToyModel()
+    cached = (gd.GaussianDiffusion._extract, respace._map_tensor)
+    results = {}
+    for mode in ["legacy", "cached"]:
+        gd.GaussianDiffusion._extract, respace._map_tensor = (
+            (legacy_extract, legacy_map_tensor) if mode == "legacy" else cached
+        )
+        diffusion = create_diffusion("250")
+        diffusion.p_sample_loop(model, shape, noise=noise, device=device)  # warmup
+        if device == "cuda":
+            th.cuda.synchronize()
+            allocs = th.cuda.memory_stats()["allocation.all.allocated"]
+        th.manual_seed(0)
+        start = time.perf_counter()
+        results[mode] = diffusion.p_sample_loop(model, shape, noise=noise, device=device)
+        if device == "cuda":
+            th.cuda.synchronize()
+            allocs = th.cuda.memory_stats()["allocation.all.allocated"] - allocs
+            print(f"{mode}: {time.perf_counter() - start:.3f}s, {allocs} CUDA allocations")
+        else:
+            print(f"{mode}: {time.perf_counter() - start:.3f}s")
+    print("max abs difference:", (results["legacy"] - results["cached"]).abs().max().item())
@@ -58,6 +58,15 @@ class ScheduleSampler(ABC):
         weights = th.from_numpy(weights_np).float().to(device)
         return indices, weights
 
+    def state_dict(self):
+        """
+        State to save in the training checkpoints, empty for fixed distributions.
+        """
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
 
 class UniformSampler(ScheduleSampler):
     def __init__(self, diffusion):
@@ -67,9 +76,14 @@ class UniformSampler(ScheduleSampler):
     def weights(self):
         return self._weights
 
+    def sample(self, batch_size, device):
+        # drawn on the device like the plain th.randint of the trainers, all weights are 1
+        indices = th.randint(0, self.diffusion.num_timesteps, (batch_size,), device=device)
+        return indices, th.ones(batch_size, device=device)
+
 
 class LossAwareSampler(ScheduleSampler):
-    def update_with_local_losses(self, local_ts, local_losses):
+    def update_with_local_losses(self, local_ts, local_losses, same_batch_sizes=False):
         """
         Update the reweighting using losses from a model.
         Call this method from each rank with a batch of timesteps and the
@@ -78,29 +92,29 @@ class LossAwareSampler(ScheduleSampler):
         maintain the exact same reweighting.
         :param local_ts: an integer Tensor of timesteps.
         :param local_losses: a 1D Tensor of losses.
+        :param same_batch_sizes: every rank passes the same number of timesteps
+                                 (e.g. drop_last=True): a single all-gather and no
+                                 host sync.
         """
-        batch_sizes = [
-            th.tensor([0], dtype=th.int32, device=local_ts.device)
-            for _ in range(dist.get_world_size())
-        ]
-        dist.all_gather(
-            batch_sizes,
-            th.tensor([len(local_ts)], dtype=th.int32, device=local_ts.device),
-        )
-
-        # Pad all_gather batches to be the maximum batch size.
-        batch_sizes = [x.item() for x in batch_sizes]
-        max_bs = max(batch_sizes)
-
-        timestep_batches = [th.zeros(max_bs).to(local_ts) for bs in batch_sizes]
-        loss_batches = [th.zeros(max_bs).to(local_losses) for bs in batch_sizes]
-        dist.all_gather(timestep_batches, local_ts)
-        dist.all_gather(loss_batches, local_losses)
-        timesteps = [
-            x.item() for y, bs in zip(timestep_batches, batch_sizes) for x in y[:bs]
-        ]
-        losses = [x.item() for y, bs in zip(loss_batches, batch_sizes) for x in y[:bs]]
-        self.update_with_all_losses(timesteps, losses)
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return self.update_with_all_losses(local_ts, local_losses.detach())
+        # timesteps and losses travel together, timesteps are exact in float32
+        packed = th.stack([local_ts.float(), local_losses.detach().float()], dim=1)
+        if same_batch_sizes:
+            gathered = th.empty(dist.get_world_size() * len(packed), 2, dtype=packed.dtype, device=packed.device)
+            dist.all_gather_into_tensor(gathered, packed)
+        else:
+            batch_sizes = th.empty(dist.get_world_size(), dtype=th.int64, device=packed.device)
+            dist.all_gather_into_tensor(batch_sizes, th.tensor([len(packed)], device=packed.device))
+            # Pad all_gather batches to be the maximum batch size.
+            batch_sizes = batch_sizes.tolist()
+            max_bs = max(batch_sizes)
+            padded = th.zeros(max_bs, 2, dtype=packed.dtype, device=packed.device)
+            padded[:len(packed)] = packed
+            gathered = th.empty(len(batch_sizes), max_bs, 2, dtype=packed.dtype, device=packed.device)
+            dist.all_gather_into_tensor(gathered, padded)
+            gathered = th.cat([x[:bs] for x, bs in zip(gathered, batch_sizes)])
+        self.update_with_all_losses(gathered[:, 0].long(), gathered[:, 1])
 
     @abstractmethod
     def update_with_all_losses(self, ts, losses):
@@ -112,39 +126,189 @@ class LossAwareSampler(ScheduleSampler):
         between workers. It is called by update_with_local_losses from all
         ranks with identical arguments. Thus, it should have deterministic
         behavior to maintain state across workers.
-        :param ts: a list of int timesteps.
-        :param losses: a list of float losses, one per timestep.
+        :param ts: int timesteps (a list or a Tensor).
+        :param losses: float losses, one per timestep (a list or a Tensor).
         """
 
 
 class LossSecondMomentResampler(LossAwareSampler):
+    """
+    The last ``history_per_term`` losses of every timestep are kept in a ring
+    buffer, on the device of the losses. Updates, weights and sampling are
+    tensor ops: the training loop is never synchronized with the host.
+    """
     def __init__(self, diffusion, history_per_term=10, uniform_prob=0.001):
         self.diffusion = diffusion
         self.history_per_term = history_per_term
         self.uniform_prob = uniform_prob
-        self._loss_history = np.zeros(
-            [diffusion.num_timesteps, history_per_term], dtype=np.float64
-        )
-        self._loss_counts = np.zeros([diffusion.num_timesteps], dtype=np.int)
+        self._loss_history = th.zeros([diffusion.num_timesteps, history_per_term], dtype=th.float64)
+        self._loss_counts = th.zeros([diffusion.num_timesteps], dtype=th.int64)
+
+    def _to(self, device):
+        if self._loss_history.device != th.device(device):
+            self._loss_history = self._loss_history.to(device)
+            self._loss_counts = self._loss_counts.to(device)
+
+    def _weights(self):
+        weights = th.sqrt(th.mean(self._loss_history ** 2, dim=-1))
+        weights = weights / th.sum(weights)
+        weights = weights * (1 - self.uniform_prob) + self.uniform_prob / len(weights)
+        # uniform until every timestep has a full history (no branch on a device value)
+        return th.where(self._warmed_up(), weights, th.ones_like(weights))
 
     def weights(self):
-        if not self._warmed_up():
-            return np.ones([self.diffusion.num_timesteps], dtype=np.float64)
-        weights = np.sqrt(np.mean(self._loss_history ** 2, axis=-1))
-        weights /= np.sum(weights)
-        weights *= 1 - self.uniform_prob
-        weights += self.uniform_prob / len(weights)
-        return weights
+        return self._weights().cpu().numpy()
+
+    def sample(self, batch_size, device):
+        self._to(device)
+        w = self._weights()
+        p = w / th.sum(w)
+        indices = th.multinomial(p, batch_size, replacement=True)
+        weights = 1 / (len(p) * p[indices])
+        return indices, weights.float()
 
     def update_with_all_losses(self, ts, losses):
-        for t, loss in zip(ts, losses):
-            if self._loss_counts[t] == self.history_per_term:
-                # Shift out the oldest loss term.
-                self._loss_history[t, :-1] = self._loss_history[t, 1:]
-                self._loss_history[t, -1] = loss
-            else:
-                self._loss_history[t, self._loss_counts[t]] = loss
-                self._loss_counts[t] += 1
+        device = losses.device if th.is_tensor(losses) else self._loss_history.device
+        self._to(device)
+        ts = th.as_tensor(ts, dtype=th.int64, device=device)
+        losses = th.as_tensor(losses, dtype=th.float64, device=device)
+        if len(ts) == 0:
+            return
+        # occurrence of each entry among the entries of the same timestep, in order
+        order = th.sort(ts, stable=True).indices
+        ts, losses = ts[order], losses[order]
+        counts = th.bincount(ts, minlength=len(self._loss_counts))
+        first = th.cumsum(counts, 0) - counts
+        occurrence = th.arange(len(ts), device=device) - first[ts]
+        # only the last history_per_term losses of a timestep survive the update
+        keep = occurrence >= counts[ts] - self.history_per_term
+        ts, losses, occurrence = ts[keep], losses[keep], occurrence[keep]
+        slots = (self._loss_counts[ts] + occurrence) % self.history_per_term
+        self._loss_history[ts, slots] = losses
+        self._loss_counts += counts
 
     def _warmed_up(self):
-        return (self._loss_counts == self.history_per_term).all()
+        return (self._loss_counts >= self.history_per_term).all()
+
+    def state_dict(self):
+        return {"loss_history": self._loss_history.cpu(), "loss_counts": self._loss_counts.cpu()}
+
+    def load_state_dict(self, state_dict):
+        loss_history, loss_counts = state_dict["loss_history"], state_dict["loss_counts"]
+        if loss_history.shape != self._loss_history.shape:
+            raise ValueError(f"loss history of shape {tuple(loss_history.shape)} in the checkpoint, "
+                             f"expected {tuple(self._loss_history.shape)}")
+        device = self._loss_history.device
+        self._loss_history = loss_history.to(device=device, dtype=th.float64)
+        self._loss_counts = loss_counts.to(device=device, dtype=th.int64)
+
+
+if __name__ == "__main__":
+    # Toy benchmark: an MLP learns the noise of a 2-D mixture of Gaussians with uniform and
+    # loss-second-moment timestep sampling; the uniform-timestep objective on a fixed
+    # evaluation set is printed against the step. Also checks the vectorized update
+    # against the original per-loss loop and times both.
+    # python -m diffusion.timestep_sampler
+    import time
+    import math
+    import argparse
+    from diffusion import create_diffusion
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=3000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--eval-every", type=int, default=250)
+    args = parser.parse_args()
+    device = "cuda" if th.cuda.is_available() else "cpu"
+
+    class LoopResampler:
+        """The original update, one loss at a time."""
+        def __init__(self, num_timesteps, history_per_term=10):
+            self.history_per_term = history_per_term
+            self._loss_history = np.zeros([num_timesteps, history_per_term], dtype=np.float64)
+            self._loss_counts = np.zeros([num_timesteps], dtype=np.int64)
+
+        def update_with_all_losses(self, ts, losses):
+            for t, loss in zip(ts, losses):
+                if self._loss_counts[t] == self.history_per_term:
+                    self._loss_history[t, :-1] = self._loss_history[t, 1:]
+                    self._loss_history[t, -1] = loss
+                else:
+                    self._loss_history[t, self._loss_counts[t]] = loss
+                    self._loss_counts[t] += 1
+
+    diffusion = create_diffusion(timestep_respacing="", learn_sigma=False)
+    sampler, reference = LossSecondMomentResampler(diffusion), LoopResampler(diffusion.num_timesteps)
+    rng = np.random.default_rng(0)
+    loop_time = vec_time = 0.
+    for _ in range(200):
+        ts = rng.integers(0, 50, size=args.batch_size)  # many repeated timesteps
+        losses = rng.random(args.batch_size)
+        start = time.time()
+        reference.update_with_all_losses(ts.tolist(), losses.tolist())
+        loop_time += time.time() - start
+        ts_t, losses_t = th.from_numpy(ts).to(device), th.from_numpy(losses).to(device)
+        if device == "cuda":
+            th.cuda.synchronize()
+        start = time.time()
+        sampler.update_with_all_losses(ts_t, losses_t)
+        if device == "cuda":
+            th.cuda.synchronize()
+        vec_time += time.time() - start
+    second_moment = lambda history: np.sqrt(np.mean(history ** 2, axis=-1))
+    assert np.allclose(second_moment(sampler._loss_history.cpu().numpy()), second_moment(reference._loss_history))
+    print(f"update of {args.batch_size} losses: loop {loop_time / 200 * 1e3:.2f} ms, "
+          f"vectorized {vec_time / 200 * 1e3:.2f} ms (same loss history)")
+    restored = LossSecondMomentResampler(diffusion)
+    restored.load_state_dict(sampler.state_dict())  # as in the training checkpoints
+    assert np.array_equal(restored.weights(), sampler.weights())
+
+    def toy_batch(n, generator=None):
+        centers = th.tensor([[math.cos(a), math.sin(a)] for a in np.linspace(0, 2 * np.pi, 8, endpoint=False)])
+        idx = th.randint(0, 8, (n,), generator=generator)
+        x = centers[idx] + 0.05 * th.randn(n, 2, generator=generator)
+        return x.view(n, 1, 2, 1, 1).to(device)  # (b, f, c, h, w) like the videos
+
+    class ToyModel(th.nn.Module):
+        def __init__(self, width=256):
+            super().__init__()
+            self.net = th.nn.Sequential(th.nn.Linear(2 + 32, width), th.nn.SiLU(), th.nn.Linear(width, width),
+                                        th.nn.SiLU(), th.nn.Linear(width, 2))
+
+        def forward(self, x, t):
+            freqs = th.exp(-math.log(10000) * th.arange(16, device=x.device) / 16)
+            emb = t.float()[:, None] * freqs[None]
+            h = th.cat([x.flatten(1), th.cos(emb), th.sin(emb)], dim=1)
+            return self.net(h).view_as(x)
+
+    gen = th.Generator().manual_seed(1)
+    eval_x = toy_batch(4000, gen)
+    eval_t = th.arange(4000, device=device) % diffusion.num_timesteps
+    eval_noise = th.randn(eval_x.shape, generator=gen).to(device)
+
+    curves = {}
+    for name in ["uniform", "loss-second-moment"]:
+        th.manual_seed(0)
+        model = ToyModel().to(device)
+        opt = th.optim.Adam(model.parameters(), lr=1e-3)
+        schedule_sampler = create_named_schedule_sampler(name, diffusion)
+        curves[name] = []
+        start = time.time()
+        for step in range(1, args.steps + 1):
+            x = toy_batch(args.batch_size)
+            t, weights = schedule_sampler.sample(args.batch_size, device)
+            losses = diffusion.training_losses(model, x, t)["loss"]
+            if isinstance(schedule_sampler, LossAwareSampler):
+                schedule_sampler.update_with_local_losses(t, losses.detach(), same_batch_sizes=True)
+            opt.zero_grad()
+            (losses * weights).mean().backward()
+            opt.step()
+            if step % args.eval_every == 0:
+                with th.no_grad():
+                    loss = diffusion.training_losses(model, eval_x, eval_t, noise=eval_noise)["loss"].mean()
+                curves[name].append((step, loss.item()))
+        print(f"{name}: {(time.time() - start) / args.steps * 1e3:.2f} ms/step")
+
+    print(f"{'step':>6} {'uniform':>10} {'loss-second-moment':>20}   (uniform-timestep loss on the eval set)")
+    for (step, a), (_, b) in zip(curves["uniform"], curves["loss-second-moment"]):
+        print(f"{step:>6} {a:>10.5f} {b:>20.5f}")
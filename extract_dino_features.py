@@ -0,0 +1,137 @@
+"""
+Precompute the DINO prior features used by the PRR loss.
+
+Every frame of a video dataset goes through the frozen DINO ViT-S/8 exactly as
+in train_cond.py (``get_special_layers`` on the normalized frames, cls token
+dropped). The features are stored as fp16 memory-mapped shards indexed by
+(video, frame), see datasets/array_store.py. Setting ``dino_cache_path`` (next
+to ``latent_cache_path``) in the training config makes the dataset return the
+features of each sampled clip, so the trainers no longer load DINO.
+
+Use --verify N to recompute N random clips live and compare them with the
+cache within fp16 tolerance.
+"""
+import os
+import argparse
+
+import torch
+import numpy as np
+
+from tqdm import tqdm
+from omegaconf import OmegaConf
+from torchvision import transforms
+
+import models.vision_transformer as vits
+from datasets import video_transforms
+from datasets.col_datasets import DecordInit
+from datasets.video_index import load_video_index
+from datasets.array_store import ArrayStore, ArrayStoreWriter
+from extract_latents import iter_frame_chunks
+
+
+def load_model(device, pretrained_path):
+    model = vits.__dict__["vit_small"](
+        patch_size=8, num_classes=0
+    )
+    for p in model.parameters():
+        p.requires_grad = False
+    model.eval()
+    model.to(device)
+
+    state_dict = torch.load(pretrained_path, map_location="cpu")
+
+    state_dict = {k.replace("module.", ""): v for k, v in state_dict.items()}
+    # remove `backbone.` prefix induced by multicrop wrapper
+    state_dict = {k.replace("backbone.", ""): v for k, v in state_dict.items()}
+    msg = model.load_state_dict(state_dict, strict=False)
+    print(
+        "Pretrained weights found at {} and loaded with msg: {}".format(
+            pretrained_path, msg
+        )
+    )
+
+    return model
+
+
+@torch.no_grad()
+def extract_features(dino, frames, special_list, patch_size=8):
+    """Return the (T, L, N, D) prior features of normalized (T, C, H, W) frames."""
+    w, h = (
+        frames.shape[-2] - frames.shape[-2] % patch_size,
+        frames.shape[-1] - frames.shape[-1] % patch_size,
+    )
+    attentions = dino.get_special_layers(frames[:, :, :w, :h], special_list)
+    return torch.stack([item[:, 1:, :] for item in attentions], dim=1)
+
+
+def verify(store, dino, configs, transform, special_list, num_videos, atol, rtol, device):
+    rng = np.random.default_rng(0)
+    keys = rng.choice(store.keys, size=min(num_videos, len(store)), replace=False)
+    v_decoder = DecordInit()
+    max_err = 0.
+    for key in keys:
+        v_reader = v_decoder(os.path.join(configs.data_path, key))
+        frame_indice = np.sort(rng.choice(len(v_reader), size=min(4, len(v_reader)), replace=False))
+        frames = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        del v_reader
+        live = extract_features(dino, transform(frames).to(device), special_list)
+        cached = torch.from_numpy(store.get(key, frame_indice)).to(device).float()
+        max_err = max(max_err, (cached - live).abs().max().item())
+        assert torch.allclose(cached, live, atol=atol, rtol=rtol), \
+            'Cached features of {} differ from live ones (max abs error {:.2e})'.format(key, max_err)
+    print(f'Verified {len(keys)} videos, max abs error {max_err:.2e}')
+
+
+def main(args):
+    assert torch.cuda.is_available(), "Feature extraction currently requires a GPU."
+    device = torch.device("cuda", 0)
+    configs = OmegaConf.load(args.config)
+    assert configs.dataset in ["col", "kva"], \
+        "Only deterministic video transforms can be cached, got {}".format(configs.dataset)
+    dino = load_model(device=device, pretrained_path=args.pretrained_weights)
+    special_list = args.special_list
+
+    # must match the transform used by get_dataset()
+    transform = transforms.Compose([
+        video_transforms.ToTensorVideo(),
+        video_transforms.CenterCropResizeVideo(configs.image_size),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
+    ])
+
+    if not args.verify_only:
+        num_tokens = (configs.image_size // 8) ** 2
+        video_lists = [info['path'] for info in load_video_index(configs.data_path, getattr(configs, 'video_index_path', None))]
+        v_decoder = DecordInit()
+        writer = ArrayStoreWriter(args.output, frame_shape=(len(special_list), num_tokens, dino.embed_dim),
+                                  dtype='float16', shard_frames=args.shard_frames,
+                                  meta={'data_path': configs.data_path, 'image_size': configs.image_size,
+                                        'special_list': special_list})
+        with writer:
+            for path in tqdm(video_lists):
+                features = [extract_features(dino, frames.to(device), special_list).half().cpu()
+                            for frames in iter_frame_chunks(v_decoder, path, transform, args.frame_batch_size)]
+                if len(features) == 0:
+                    print(f'Skipping empty video: {path}')
+                    continue
+                writer.add(os.path.relpath(path, configs.data_path), torch.cat(features).numpy())
+        print(f'Saved DINO features of {len(writer.entries)} videos to {args.output}')
+
+    if args.verify > 0:
+        verify(ArrayStore(args.output), dino, configs, transform, special_list,
+               args.verify, args.atol, args.rtol, device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument('--pretrained_weights', type=str, default="/path/to/pretrained/dino-model")
+    parser.add_argument("--special-list", dest="special_list", type=int, nargs="+", default=[2, 5, 8, 11])
+    parser.add_argument("--shard-frames", dest="shard_frames", type=int, default=4096)
+    parser.add_argument("--frame-batch-size", dest="frame_batch_size", type=int, default=64)
+    parser.add_argument("--verify", type=int, default=8, help="number of videos checked against live features")
+    parser.add_argument("--verify-only", dest="verify_only", action="store_true")
+    parser.add_argument("--atol", type=float, default=1e-2)
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    args = parser.parse_args()
+    main(args)
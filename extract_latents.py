@@ -0,0 +1,96 @@
+"""
+Precompute the VAE posterior (mean and std) of every frame of a video dataset.
+
+The result is a sharded, memory-mapped store (see datasets/array_store.py).
+Setting ``latent_cache_path`` in the training config to the output directory
+makes get_dataset() return latents drawn from the stored posterior instead of
+pixels, so the trainers skip ``vae.encode``.
+
+Only the deterministic video pipelines ("col", "kva") can be cached: the
+random flips of the *_img datasets change the VAE input on every epoch.
+"""
+import os
+import argparse
+
+import torch
+import numpy as np
+
+from tqdm import tqdm
+from omegaconf import OmegaConf
+from torchvision import transforms
+from diffusers.models import AutoencoderKL
+
+from datasets import video_transforms
+from datasets.col_datasets import DecordInit
+from datasets.video_index import load_video_index
+from datasets.array_store import ArrayStoreWriter
+
+
+def iter_frame_chunks(v_decoder, path, transform, frame_batch_size):
+    """Decode and transform a video ``frame_batch_size`` frames at a time."""
+    v_reader = v_decoder(path)
+    for start in range(0, len(v_reader), frame_batch_size):
+        frame_indice = np.arange(start, min(start + frame_batch_size, len(v_reader)))
+        frames = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        yield transform(frames)
+    del v_reader
+
+
+@torch.no_grad()
+def encode_moments(vae, chunks, device):
+    """Return the (T, 2, C, H, W) posterior mean/std of an iterable of (t, C, H, W) frames."""
+    moments = []
+    for frames in chunks:
+        latent_dist = vae.encode(frames.to(device)).latent_dist
+        moments.append(torch.stack([latent_dist.mean, latent_dist.std], dim=1).cpu())
+    return torch.cat(moments) if moments else None
+
+
+def main(args):
+    assert torch.cuda.is_available(), "Latent extraction currently requires a GPU."
+    device = torch.device("cuda", 0)
+    configs = OmegaConf.load(args.config)
+    assert configs.dataset in ["col", "kva"], \
+        "Only deterministic video transforms can be cached, got {}".format(configs.dataset)
+
+    if configs.extras == 78:
+        vae = AutoencoderKL.from_pretrained(configs.pretrained_model_path, subfolder="vae").to(device)
+    else:
+        vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-mse").to(device)
+    vae.requires_grad_(False)
+    vae.eval()
+
+    # must match the transform used by get_dataset()
+    transform = transforms.Compose([
+        video_transforms.ToTensorVideo(),
+        video_transforms.CenterCropResizeVideo(configs.image_size),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
+    ])
+
+    latent_size = configs.image_size // 8
+    video_lists = [info['path'] for info in load_video_index(configs.data_path, getattr(configs, 'video_index_path', None))]
+    v_decoder = DecordInit()
+    writer = ArrayStoreWriter(args.output, frame_shape=(2, 4, latent_size, latent_size),
+                              dtype=args.dtype, shard_frames=args.shard_frames,
+                              meta={'data_path': configs.data_path, 'image_size': configs.image_size,
+                                    'dataset': configs.dataset})
+    with writer:
+        for path in tqdm(video_lists):
+            moments = encode_moments(vae, iter_frame_chunks(v_decoder, path, transform, args.frame_batch_size), device)
+            if moments is None:
+                print(f'Skipping empty video: {path}')
+                continue
+            writer.add(os.path.relpath(path, configs.data_path), moments.numpy())
+
+    print(f'Saved latents of {len(writer.entries)} videos to {args.output}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"])
+    parser.add_argument("--shard-frames", dest="shard_frames", type=int, default=65536)
+    parser.add_argument("--frame-batch-size", dest="frame_batch_size", type=int, default=32)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,125 @@
+"""
+Precompute the VAE posteriors (mean and std) of the mask videos and mask frames
+used as the ``extras == 3`` condition.
+
+The masks go through the same pipeline as in ColonoscopicImageMaskPairs
+(center crop for the videos, none for the frames), once as they are and once
+horizontally flipped, so the random flip of the dataset can still be applied.
+The result is a sharded, memory-mapped store (see datasets/array_store.py)
+with the keys ``videos/<path relative to mask_data_path>`` and
+``frames/<line of mask_data_txt>``. Setting ``mask_latent_cache_path`` in the
+training config (or the sampling config of sample/sample_cond.py) to the output
+directory makes the mask pipelines return latents, so the condition is no
+longer encoded by the VAE on every step.
+
+The VAE encoders of sd-vae-ft-mse (training) and sd-vae-ft-ema (sampling) are
+the same, so one cache serves both.
+
+By default the posteriors are stored as uint8 codes with a float32 scale per
+frame and channel (``--dtype uint8``), about half the size of float16; see
+``python -m datasets.array_store`` for the size ratio and round-trip error.
+"""
+import os
+import argparse
+
+import torch
+
+import numpy as np
+
+from tqdm import tqdm
+from omegaconf import OmegaConf
+from torchvision import transforms
+from diffusers.models import AutoencoderKL
+
+from datasets import video_transforms
+from datasets.col_datasets import DecordInit
+from datasets.video_index import load_video_index
+from datasets.array_store import ArrayStoreWriter
+from datasets.frame_shards import FrameShardReader, open_frame
+from extract_latents import iter_frame_chunks, encode_moments
+
+
+def encode_flipped_moments(vae, chunks, device):
+    """Return the (T, 2, 2, C, H, W) posterior mean/std of the frames (dim 1: as they are, flipped)."""
+    moments = [torch.stack([encode_moments(vae, [frames], device), encode_moments(vae, [frames.flip(-1)], device)], dim=1)
+               for frames in chunks]
+    return torch.cat(moments) if moments else None
+
+
+def iter_mask_frames(configs, transform, frame_batch_size):
+    """Yield (names, (t, C, H, W) frames) of the mask frames listed in mask_data_txt."""
+    frame_shards = FrameShardReader(configs.mask_frame_shard_path) \
+        if getattr(configs, 'mask_frame_shard_path', None) else None
+    names = [mask_file.strip() for mask_file in open(configs.mask_data_txt)]
+    names = list(dict.fromkeys(name for name in names if name))
+    for start in range(0, len(names), frame_batch_size):
+        batch = names[start:start + frame_batch_size]
+        frames = [transform(open_frame(frame_shards, configs.mask_frame_data_path, name).convert("RGB"))
+                  for name in batch]
+        yield batch, torch.stack(frames)
+
+
+def main(args):
+    assert torch.cuda.is_available(), "Latent extraction currently requires a GPU."
+    device = torch.device("cuda", 0)
+    configs = OmegaConf.load(args.config)
+    assert configs.dataset == 'polypgen_img_mask', \
+        "Mask latents are only used by the polypgen_img_mask dataset, got {}".format(configs.dataset)
+
+    vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-mse").to(device)
+    vae.requires_grad_(False)
+    vae.eval()
+
+    # must match the transforms of ColonoscopicImageMaskPairs, without the random flip
+    transform = transforms.Compose([
+        video_transforms.ToTensorVideo(),  # TCHW
+        video_transforms.UCFCenterCropVideo(configs.image_size),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
+    ])
+    image_tranform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
+    ])
+
+    latent_size = configs.image_size // 8
+    video_lists = [info['path'] for info in load_video_index(configs.mask_data_path,
+                                                             getattr(configs, 'mask_video_index_path', None))]
+    v_decoder = DecordInit()
+    writer = ArrayStoreWriter(args.output, frame_shape=(2, 2, 4, latent_size, latent_size),
+                              dtype=args.dtype, shard_frames=args.shard_frames, quantize=args.dtype == 'uint8',
+                              meta={'mask_data_path': configs.mask_data_path, 'image_size': configs.image_size,
+                                    'dataset': configs.dataset})
+    with writer:
+        for path in tqdm(video_lists, desc='mask videos'):
+            moments = encode_flipped_moments(vae, iter_frame_chunks(v_decoder, path, transform, args.frame_batch_size),
+                                             device)
+            if moments is None:
+                print(f'Skipping empty video: {path}')
+                continue
+            writer.add('videos/' + os.path.relpath(path, configs.mask_data_path), moments.numpy())
+
+        if getattr(configs, 'mask_data_txt', None):
+            for names, frames in tqdm(iter_mask_frames(configs, image_tranform, args.frame_batch_size),
+                                      desc='mask frames'):
+                assert frames.shape[-1] == configs.image_size and frames.shape[-2] == configs.image_size, \
+                    'Mask frames must be {0}x{0}, got {1}'.format(configs.image_size, tuple(frames.shape[-2:]))
+                moments = encode_flipped_moments(vae, [frames], device)
+                for name, frame_moments in zip(names, moments.numpy()):
+                    writer.add('frames/' + name, frame_moments[None])
+
+    size = sum(os.path.getsize(os.path.join(args.output, name)) for name in os.listdir(args.output)
+               if name.endswith('.bin'))
+    fp16_size = sum(writer.shards) * np.prod(writer.frame_shape) * 2
+    print(f'Saved mask latents of {len(writer.entries)} videos/frames to {args.output} ({size / 2 ** 20:.1f} MiB, '
+          f'{size / fp16_size:.3f} of float16)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--dtype", type=str, default="uint8", choices=["float32", "float16", "uint8"])
+    parser.add_argument("--shard-frames", dest="shard_frames", type=int, default=16384)
+    parser.add_argument("--frame-batch-size", dest="frame_batch_size", type=int, default=32)
+    args = parser.parse_args()
+    main(args)
@@ -15,6 +15,8 @@ import numpy as np
 from einops import rearrange, repeat
 from timm.models.vision_transformer import Mlp, PatchEmbed
 
+from .utils import BlockCacheMixin, GuidanceMixin, get_attention_backend
+
 
 # for i in sys.path:
 #     print(i)
@@ -37,13 +39,16 @@ def modulate(x, shift, scale):
 #################################################################################
 
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., use_lora=False, attention_mode='math'):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., use_lora=False, attention_mode='sdpa', chunk_size=1024):
         super().__init__()
         assert dim % num_heads == 0, 'dim should be divisible by num_heads'
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim ** -0.5
         self.attention_mode = attention_mode
+        # see ATTENTION_BACKENDS in models/utils.py; 'chunked' bounds the memory of long sequences
+        self.attention = get_attention_backend(attention_mode)
+        self.chunk_size = chunk_size
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
@@ -54,23 +59,9 @@ class Attention(nn.Module):
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4).contiguous()
         q, k, v = qkv.unbind(0)   # make torchscript happy (cannot use tensor as tuple)
         
-        if self.attention_mode == 'xformers': # cause loss nan while using with amp
-            x = xformers.ops.memory_efficient_attention(q, k, v).reshape(B, N, C)
-
-        elif self.attention_mode == 'flash':
-            # cause loss nan while using with amp
-            # Optionally use the context manager to ensure one of the fused kerenels is run
-            with torch.backends.cuda.sdp_kernel(enable_math=False):
-                x = torch.nn.functional.scaled_dot_product_attention(q, k, v).reshape(B, N, C) # require pytorch 2.0
-
-        elif self.attention_mode == 'math':
-            attn = (q @ k.transpose(-2, -1)) * self.scale
-            attn = attn.softmax(dim=-1)
-            attn = self.attn_drop(attn)
-            x = (attn @ v).transpose(1, 2).reshape(B, N, C)
-
-        else:
-            raise NotImplemented
+        dropout_p = self.attn_drop.p if self.training else 0.
+        x = self.attention(q, k, v, self.scale, dropout_p, chunk_size=self.chunk_size)
+        x = x.transpose(1, 2).reshape(B, N, C)
 
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -175,10 +166,16 @@ class TransformerBlock(nn.Module):
         )
 
     def forward(self, x, c):
+        """
+        x: (N * k, T, D) tokens, sample-major
+        c: (N, D) conditioning of each sample, broadcast over its k rows (k may be 1)
+        """
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
-        x = x + gate_msa.unsqueeze(1) * self.attn(modulate(self.norm1(x), shift_msa, scale_msa))
+        shape = x.shape
+        x = x.reshape(c.shape[0], -1, shape[-1]) # (N, k * T, D)
+        x = x + gate_msa.unsqueeze(1) * self.attn(modulate(self.norm1(x), shift_msa, scale_msa).reshape(shape)).reshape(x.shape)
         x = x + gate_mlp.unsqueeze(1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
-        return x
+        return x.reshape(shape)
 
 
 class FinalLayer(nn.Module):
@@ -196,12 +193,13 @@ class FinalLayer(nn.Module):
 
     def forward(self, x, c):
         shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
-        x = modulate(self.norm_final(x), shift, scale)
+        shape = x.shape
+        x = modulate(self.norm_final(x.reshape(c.shape[0], -1, shape[-1])), shift, scale)
         x = self.linear(x)
-        return x
+        return x.reshape(*shape[:-1], -1)
 
 
-class EnDora(nn.Module):
+class EnDora(BlockCacheMixin, GuidanceMixin, nn.Module):
     """
     Diffusion model with a Transformer backbone.
     """
@@ -219,7 +217,9 @@ class EnDora(nn.Module):
         num_classes=1000,
         learn_sigma=True,
         extras=1,
-        attention_mode='math',
+        attention_mode='sdpa',
+        attention_chunk_size=1024,
+        prior_mode=None,
     ):
         super().__init__()
         self.learn_sigma = learn_sigma
@@ -246,15 +246,22 @@ class EnDora(nn.Module):
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches, hidden_size), requires_grad=False)
         self.temp_embed = nn.Parameter(torch.zeros(1, num_frames, hidden_size), requires_grad=False)
         self.hidden_size =  hidden_size
+        # DINO prior heads: only the one used by ``prior_mode`` is built, so that every
+        # parameter receives a gradient (DDP without find_unused_parameters).
+        # None builds all of them, as in the checkpoints saved before prior_mode existed.
         self.pooling = nn.AdaptiveAvgPool1d(64)
-        self.linear = nn.Linear(in_features=384, out_features=1152)
-        self.linear_2 = nn.Linear(in_features=384*4, out_features=1152)
+        if prior_mode in (None, "type1"):
+            self.linear = nn.Linear(in_features=384, out_features=1152)
+        if prior_mode in (None, "type2"):
+            self.linear_2 = nn.Linear(in_features=384*4, out_features=1152)
         # self.to_hidden_layer = nn.Linear(in_features=256*384, out_features=64*1152)
         self.blocks = nn.ModuleList([
-            TransformerBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio, attention_mode=attention_mode) for _ in range(depth)
+            TransformerBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio, attention_mode=attention_mode,
+                             chunk_size=attention_chunk_size) for _ in range(depth)
         ])
 
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
+        self.block_cache = None  # see enable_block_cache()
         self.initialize_weights()
 
     def initialize_weights(self):
@@ -366,19 +373,27 @@ class EnDora(nn.Module):
         x = rearrange(x, 'b f c h w -> (b f) c h w')
         x = self.x_embedder(x) + self.pos_embed  
         t = self.t_embedder(t, use_fp16=use_fp16)                  
-        timestep_spatial = repeat(t, 'n d -> (n c) d', c=self.temp_embed.shape[1]) 
-        timestep_temp = repeat(t, 'n d -> (n c) d', c=self.pos_embed.shape[1])
+        # conditioning of each sample, broadcast over its frames/tokens in the blocks
+        timestep_spatial = t
+        timestep_temp = t
 
         if self.extras == 2:
             y = self.y_embedder(y, self.training)
-            y_spatial = repeat(y, 'n d -> (n c) d', c=self.temp_embed.shape[1]) 
-            y_temp = repeat(y, 'n d -> (n c) d', c=self.pos_embed.shape[1])
+            y_spatial = y
+            y_temp = y
         elif self.extras == 78:
             text_embedding = self.text_embedding_projection(text_embedding.reshape(batches, -1))
-            text_embedding_spatial = repeat(text_embedding, 'n d -> (n c) d', c=self.temp_embed.shape[1])
-            text_embedding_temp = repeat(text_embedding, 'n d -> (n c) d', c=self.pos_embed.shape[1])
+            text_embedding_spatial = text_embedding
+            text_embedding_temp = text_embedding
 
+        cache = self.block_cache if not self.training else None
+        cache_input = None
         for i in range(0, len(self.blocks), 2):
+            if cache is not None and i // 2 == cache.start_block:
+                if cache.reuse(x):
+                    x = x + cache.residual
+                    break
+                cache_input = x
             spatial_block, temp_block = self.blocks[i:i+2]
             if self.extras == 2:
                 c = timestep_spatial + y_spatial
@@ -414,6 +429,11 @@ class EnDora(nn.Module):
             x = temp_block(x, c)
             x = rearrange(x, '(b t) f d -> (b f) t d', b=batches)
 
+        if cache is not None:
+            if cache_input is not None:
+                cache.update(cache_input, x)
+            cache.step += 1
+
         if self.extras == 2:
             c = timestep_spatial + y_spatial
         else:
@@ -445,7 +465,7 @@ class EnDora(nn.Module):
         return torch.cat([eps, rest], dim=2)
 
 
-class EnDora_var(nn.Module):
+class EnDora_var(GuidanceMixin, nn.Module):
     """
     Diffusion model with a Transformer backbone.
     """
@@ -463,7 +483,9 @@ class EnDora_var(nn.Module):
         num_classes=1000,
         learn_sigma=True,
         extras=1,
-        attention_mode='math',
+        attention_mode='sdpa',
+        attention_chunk_size=1024,
+        prior_mode=None,
     ):
         super().__init__()
         self.learn_sigma = learn_sigma
@@ -490,12 +512,18 @@ class EnDora_var(nn.Module):
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches, hidden_size), requires_grad=False)
         self.temp_embed = nn.Parameter(torch.zeros(1, num_frames, hidden_size), requires_grad=False)
         self.hidden_size =  hidden_size
+        # DINO prior heads: only the one used by ``prior_mode`` is built, so that every
+        # parameter receives a gradient (DDP without find_unused_parameters).
+        # None builds all of them, as in the checkpoints saved before prior_mode existed.
         self.pooling = nn.AdaptiveAvgPool1d(64)
-        self.linear = nn.Linear(in_features=384, out_features=1152)
-        self.linear_2 = nn.Linear(in_features=384*4, out_features=1152)
+        if prior_mode in (None, "type1"):
+            self.linear = nn.Linear(in_features=384, out_features=1152)
+        if prior_mode in (None, "type2"):
+            self.linear_2 = nn.Linear(in_features=384*4, out_features=1152)
         # self.to_hidden_layer = nn.Linear(in_features=256*384, out_features=64*1152)
         self.blocks = nn.ModuleList([
-            TransformerBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio, attention_mode=attention_mode) for _ in range(depth)
+            TransformerBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio, attention_mode=attention_mode,
+                             chunk_size=attention_chunk_size) for _ in range(depth)
         ])
 
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
@@ -610,17 +638,18 @@ class EnDora_var(nn.Module):
         x = rearrange(x, 'b f c h w -> (b f) c h w')
         x = self.x_embedder(x) + self.pos_embed  
         t = self.t_embedder(t, use_fp16=use_fp16)                  
-        timestep_spatial = repeat(t, 'n d -> (n c) d', c=self.temp_embed.shape[1]) 
-        timestep_temp = repeat(t, 'n d -> (n c) d', c=self.pos_embed.shape[1])
+        # conditioning of each sample, broadcast over its frames/tokens in the blocks
+        timestep_spatial = t
+        timestep_temp = t
 
         if self.extras == 2:
             y = self.y_embedder(y, self.training)
-            y_spatial = repeat(y, 'n d -> (n c) d', c=self.temp_embed.shape[1]) 
-            y_temp = repeat(y, 'n d -> (n c) d', c=self.pos_embed.shape[1])
+            y_spatial = y
+            y_temp = y
         elif self.extras == 78:
             text_embedding = self.text_embedding_projection(text_embedding.reshape(batches, -1))
-            text_embedding_spatial = repeat(text_embedding, 'n d -> (n c) d', c=self.temp_embed.shape[1])
-            text_embedding_temp = repeat(text_embedding, 'n d -> (n c) d', c=self.pos_embed.shape[1])
+            text_embedding_spatial = text_embedding
+            text_embedding_temp = text_embedding
 
 
         for i in range(0, len(self.blocks) // 2):
@@ -26,14 +26,22 @@ def get_lr_scheduler(optimizer, name, **kwargs):
     else:
         raise NotImplementedError(name)
     
-def get_models(args):
+def get_models(args, prior_mode=None):
+    """
+    prior_mode: the ``mode`` the DINO priors are trained with ("type0", "type1",
+        "type2", "type_cnn") or "off" without priors; only the prior heads it
+        needs are built. None builds all of them (for loading any checkpoint).
+    """
     if 'EnDoraIMG' in args.model:
         return EnDoraIMG_models[args.model](
                 input_size=args.latent_size,
                 num_classes=args.num_classes,
                 num_frames=args.num_frames,
                 learn_sigma=args.learn_sigma,
-                extras=args.extras
+                extras=args.extras,
+                attention_mode=getattr(args, 'attention_mode', 'sdpa'),
+                attention_chunk_size=getattr(args, 'attention_chunk_size', 1024),
+                prior_mode=prior_mode
             )
 
     elif 'EnDora' in args.model:
@@ -42,8 +50,31 @@ def get_models(args):
                 num_classes=args.num_classes,
                 num_frames=args.num_frames,
                 learn_sigma=args.learn_sigma,
-                extras=args.extras
+                extras=args.extras,
+                attention_mode=getattr(args, 'attention_mode', 'sdpa'),
+                attention_chunk_size=getattr(args, 'attention_chunk_size', 1024),
+                prior_mode=prior_mode
             )
     else:
         raise '{} Model Not Supported!'.format(args.model)
-    
\ No newline at end of file
+    
+
+PRIOR_HEADS = ('pooling.', 'linear.', 'linear_2.', 'cov.')
+
+
+def load_model_state(model, state_dict):
+    """
+    load_state_dict() of a checkpoint that may hold other DINO prior heads than the
+    model: checkpoints saved before prior_mode existed hold all of them, those of
+    another prior mode a different one. The prior-head keys the model did not build
+    are dropped, heads missing from the checkpoint keep their initialization; any
+    other mismatch fails as with strict loading.
+    """
+    own_keys = set(model.state_dict().keys())
+    state_dict = {k: v for k, v in state_dict.items() if k in own_keys or not k.startswith(PRIOR_HEADS)}
+    msg = model.load_state_dict(state_dict, strict=False)
+    mismatched = [k for k in msg.missing_keys if not k.startswith(PRIOR_HEADS)] + list(msg.unexpected_keys)
+    if mismatched:
+        raise RuntimeError(f"Error loading the state dict of {type(model).__name__}, "
+                           f"keys that are not prior heads differ: {mismatched}")
+    return msg
@@ -212,4 +212,263 @@ def count_params(model, verbose=False):
     total_params = sum(p.numel() for p in model.parameters())
     if verbose:
         print(f"{model.__class__.__name__} has {total_params * 1.e-6:.2f} M params.")
-    return total_params
\ No newline at end of file
+    return total_params
+
+class BlockCache:
+    """
+    Reuse of the deep transformer blocks across denoising steps (DeepCache / FORA style).
+    The block pairs from ``start_block`` on are only computed on refresh steps; their
+    residual (output minus input of the cached region) is stored and added to the input
+    of the region on the other steps. One model call is one step.
+    :param start_block: index of the first (spatial, temporal) block pair that is cached;
+                        the shallower pairs run at every step.
+    :param interval: recompute the cached region every ``interval`` steps (1: never reuse).
+    :param full_steps: the first ``full_steps`` steps always run every block.
+    """
+    def __init__(self, start_block, interval, full_steps=0):
+        self.start_block = start_block
+        self.interval = interval
+        self.full_steps = full_steps
+        self.reset()
+
+    def reset(self):
+        """Start a new trajectory."""
+        self.step = 0
+        self.residual = None
+        self.num_reused = 0
+
+    def reuse(self, x):
+        """Whether the cached residual replaces the deep blocks for the input x at this step."""
+        reuse = (
+            self.residual is not None
+            and self.residual.shape == x.shape
+            and self.step >= self.full_steps
+            and (self.step - self.full_steps) % self.interval != 0
+        )
+        self.num_reused += int(reuse)
+        return reuse
+
+    def update(self, x_in, x_out):
+        self.residual = x_out - x_in
+
+
+class BlockCacheMixin:
+    """
+    Block cache switches of the models whose forward reads ``self.block_cache``.
+    """
+    block_cache = None
+
+    def enable_block_cache(self, start_block, interval, full_steps=0):
+        """
+        Inference only: reuse the output of the block pairs from start_block on for
+        interval - 1 steps out of interval (see BlockCache). Call
+        block_cache.reset() before sampling each new batch.
+        """
+        self.block_cache = BlockCache(start_block, interval, full_steps)
+        return self.block_cache
+
+    def disable_block_cache(self):
+        self.block_cache = None
+
+
+class GuidanceMixin:
+    """
+    Classifier-free guidance of the EnDora models on a single trajectory (needs ``forward``).
+    """
+    def forward_with_guidance(self, x, t, y=None, y_null=None, cfg_scale=7.0, guidance_interval=None,
+                              use_fp16=False, t_host=None, **kwargs):
+        """
+        x only holds the conditional samples, the conditional/unconditional batch is
+        built here for the model call; guidance is applied on the eps channels only,
+        as in forward_with_cfg(). With a DDPM sampler the per-step noise is drawn for
+        the n conditional samples instead of the 2n of a doubled trajectory.
+        y_null: the null labels of the unconditional pass.
+        guidance_interval: (t_min, t_max), the timesteps where guidance is applied; on the
+        other steps only the conditional pass runs. None guides every step, which gives
+        the same outputs as forward_with_cfg() on a doubled trajectory.
+        t_host: the timestep of t as a python int, passed by the samplers of diffusion/
+        with a guidance_interval; without it t is read back from the device.
+        Tensor kwargs with a batch dimension (e.g. y_image) are repeated for both passes.
+        """
+        if y is None or y_null is None:
+            raise ValueError("forward_with_guidance needs the labels y and the null labels y_null "
+                             "of the unconditional pass, use forward() to sample without guidance")
+        if guidance_interval is not None:
+            if t_host is None:
+                t_host = t[0].item()
+            if not guidance_interval[0] <= t_host <= guidance_interval[1]:
+                model_out = self.forward(x.to(dtype=torch.float16) if use_fp16 else x, t, y=y,
+                                         use_fp16=use_fp16, **kwargs)
+                return model_out[0] if isinstance(model_out, tuple) else model_out
+        combined = torch.cat([x, x], dim=0)
+        if use_fp16:
+            combined = combined.to(dtype=torch.float16)
+        kwargs = {k: torch.cat([v, v], dim=0) if torch.is_tensor(v) and len(v) == len(x) else v
+                  for k, v in kwargs.items()}
+        model_out = self.forward(combined, torch.cat([t, t], dim=0), y=torch.cat([y, y_null], dim=0),
+                                 use_fp16=use_fp16, **kwargs)
+        if isinstance(model_out, tuple):
+            model_out = model_out[0]
+        eps, rest = model_out[:, :, :4, ...], model_out[:, :, 4:, ...]
+        cond_eps, uncond_eps = torch.split(eps, len(x), dim=0)
+        half_eps = uncond_eps + cfg_scale * (cond_eps - uncond_eps)
+        return torch.cat([half_eps, rest[:len(x)]], dim=2)
+
+
+def random_token_mask(batch_size, grid_size, patch_size, mask_ratio, device=None):
+    """
+    MaskDiT-style token dropping: keep a random (1 - mask_ratio) fraction of the
+    grid_size x grid_size patch tokens of each sample.
+    :return: ids_keep, the (B, K) sorted indices of the kept tokens, and loss_mask, the
+             (B, 1, 1, H, W) latent pixels they cover (1: kept), which broadcasts
+             against (B, F, C, H, W) videos.
+    """
+    num_patches = grid_size ** 2
+    num_keep = max(1, int(round(num_patches * (1 - mask_ratio))))
+    ids_keep = torch.rand(batch_size, num_patches, device=device).argsort(dim=1)[:, :num_keep]
+    ids_keep = ids_keep.sort(dim=1).values
+    mask = torch.zeros(batch_size, num_patches, device=device)
+    mask.scatter_(1, ids_keep, 1.)
+    mask = mask.view(batch_size, grid_size, grid_size)
+    loss_mask = mask.repeat_interleave(patch_size, dim=1).repeat_interleave(patch_size, dim=2)
+    return ids_keep, loss_mask[:, None, None]
+
+
+def gather_tokens(x, ids_keep):
+    """(N, T, D) tokens -> the (N, K, D) tokens at ids_keep (N, K)."""
+    return torch.gather(x, 1, ids_keep.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
+
+def restore_tokens(x, ids_keep, num_tokens):
+    """Inverse of gather_tokens: scatter (N, K, D) back to (N, num_tokens, D), dropped tokens are zero."""
+    out = x.new_zeros(x.shape[0], num_tokens, x.shape[-1])
+    return out.scatter(1, ids_keep.unsqueeze(-1).expand(-1, -1, x.shape[-1]), x)
+
+
+#################################################################################
+#                               Attention Backends                              #
+#################################################################################
+
+ATTENTION_BACKENDS = {}
+
+
+def register_attention_backend(name):
+    def register(fn):
+        ATTENTION_BACKENDS[name] = fn
+        return fn
+    return register
+
+
+@register_attention_backend('math')
+def math_attention(q, k, v, scale, dropout_p=0., **kwargs):
+    """Reference attention; q, k, v are (B, heads, N, head_dim)."""
+    attn = (q @ k.transpose(-2, -1)) * scale
+    attn = attn.softmax(dim=-1)
+    if dropout_p > 0.:
+        attn = torch.nn.functional.dropout(attn, p=dropout_p)
+    return attn @ v
+
+
+@register_attention_backend('sdpa')
+def sdpa_attention(q, k, v, scale, dropout_p=0., **kwargs):
+    """torch.nn.functional.scaled_dot_product_attention, lets torch pick the kernel (also on CPU)."""
+    if not hasattr(torch.nn.functional, 'scaled_dot_product_attention'):  # pytorch < 2.0
+        return math_attention(q, k, v, scale, dropout_p)
+    if q.shape[-1] ** -0.5 == scale:
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+    return torch.nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=scale)
+
+
+@register_attention_backend('chunked')
+def chunked_attention(q, k, v, scale, dropout_p=0., chunk_size=1024, **kwargs):
+    """
+    Memory bounded attention for long sequences (e.g. the temporal blocks of 64+ frame clips):
+    the queries are processed ``chunk_size`` at a time, so at most a (B, heads, chunk_size, N)
+    score matrix is alive instead of (B, heads, N, N). Each chunk goes through sdpa.
+    """
+    if q.shape[-2] <= chunk_size:
+        return sdpa_attention(q, k, v, scale, dropout_p)
+    return torch.cat([
+        sdpa_attention(q_chunk, k, v, scale, dropout_p) for q_chunk in q.split(chunk_size, dim=-2)
+    ], dim=-2)
+
+
+@register_attention_backend('xformers')
+def xformers_attention(q, k, v, scale, dropout_p=0., **kwargs):
+    import xformers.ops
+    # xformers expects (B, N, heads, head_dim)
+    x = xformers.ops.memory_efficient_attention(
+        q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), p=dropout_p, scale=scale)
+    return x.transpose(1, 2)
+
+
+@register_attention_backend('flash')
+def flash_attention(q, k, v, scale, dropout_p=0., **kwargs):
+    # fused kernels only: fails instead of silently falling back to math
+    with torch.backends.cuda.sdp_kernel(enable_math=False):
+        return sdpa_attention(q, k, v, scale, dropout_p)
+
+
+def get_attention_backend(name):
+    """
+    Look up an attention backend, falling back to 'sdpa' (itself falling back to 'math'
+    on pytorch < 2.0) when the requested one cannot run here.
+    """
+    if name not in ATTENTION_BACKENDS:
+        raise NotImplementedError('Unknown attention mode {}, choose from {}'.format(name, sorted(ATTENTION_BACKENDS)))
+    if name == 'xformers':
+        try:
+            import xformers.ops
+        except ImportError:
+            print('xformers is not available, falling back to sdpa attention')
+            name = 'sdpa'
+    elif name == 'flash' and not torch.cuda.is_available():
+        print('flash attention needs a GPU, falling back to sdpa attention')
+        name = 'sdpa'
+    return ATTENTION_BACKENDS[name]
+
+
+def _attention_peak_memory(name, shape, chunk_size, queue):
+    import resource
+    torch.manual_seed(0)
+    q, k, v = torch.randn(3, *shape).unbind(0)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.no_grad():
+        ATTENTION_BACKENDS[name](q, k, v, shape[-1] ** -0.5, chunk_size=chunk_size)
+    # ru_maxrss is in KiB on linux
+    queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024)
+
+
+if __name__ == '__main__':
+    # Numerical check of the attention backends against 'math' and CPU peak memory of each.
+    # python -m models.utils
+    import time
+    import multiprocessing as mp
+
+    torch.manual_seed(0)
+    # spatial blocks: (b*f) x heads x 256 tokens; temporal blocks of a long clip: (b*t) x heads x 128 frames
+    for shape in [(8, 16, 256, 72), (256, 16, 128, 72)]:
+        for dtype, atol in [(torch.float32, 1e-5), (torch.bfloat16, 2e-2)]:
+            q, k, v = torch.randn(3, *shape, dtype=torch.float64).unbind(0)
+            reference = math_attention(q, k, v, shape[-1] ** -0.5)
+            q, k, v = q.to(dtype), k.to(dtype), v.to(dtype)
+            for name in ['math', 'sdpa', 'chunked']:
+                out = ATTENTION_BACKENDS[name](q, k, v, shape[-1] ** -0.5, chunk_size=32)
+                err = (out.double() - reference).abs().max().item()
+                print('{:>8} {:>15} {:<24} max abs error vs fp64 math {:.2e}'.format(
+                    name, str(dtype), str(shape), err))
+                assert err < atol, (name, dtype, err)
+
+    ctx = mp.get_context('spawn')
+    shape = (16, 16, 1024, 72)
+    for name in ['math', 'sdpa', 'chunked']:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_attention_peak_memory, args=(name, shape, 128, queue))
+        proc.start()
+        peak = queue.get()
+        proc.join()
+        q, k, v = torch.randn(3, *shape).unbind(0)
+        start = time.time()
+        with torch.no_grad():
+            ATTENTION_BACKENDS[name](q, k, v, shape[-1] ** -0.5, chunk_size=128)
+        print('{:>8} {}: peak memory +{:.0f} MiB, {:.3f}s'.format(name, shape, peak, time.time() - start))
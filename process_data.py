@@ -3,6 +3,7 @@ Converts a dataset of mp4 videos into a dataset of video frames
 I.e. a directory of mp4 files becomes a directory of directories of frames
 This speeds up loading during training because we do not need
 """
+import io
 import os
 from typing import List
 import argparse
@@ -15,8 +16,11 @@ import torchvision.transforms.functional as TVF
 from moviepy.editor import VideoFileClip
 from tqdm import tqdm
 
+from datasets.frame_shards import FrameShardWriter
 
-def convert_videos_to_frames(source_dir: os.PathLike, target_dir: os.PathLike, num_workers: int, video_ext: str, **process_video_kwargs):
+
+def convert_videos_to_frames(source_dir: os.PathLike, target_dir: os.PathLike, num_workers: int, video_ext: str,
+                             packed: bool=False, shard_size: int=1 << 30, **process_video_kwargs):
     broken_clips_dir = f'{target_dir}_broken_clips'
     os.makedirs(target_dir, exist_ok=True)
     os.makedirs(broken_clips_dir, exist_ok=True)
@@ -27,12 +31,21 @@ def convert_videos_to_frames(source_dir: os.PathLike, target_dir: os.PathLike, n
         clip_path=cp,
         target_dir=target_dir,
         broken_clips_dir=broken_clips_dir,
+        packed=packed,
         **process_video_kwargs,
      ) for cp in clips_paths]
     pool = Pool(processes=num_workers)
 
-    for fps in tqdm(pool.imap_unordered(task_proxy, tasks_kwargs), total=len(clips_paths)):
-        clips_fps.append(fps)
+    if packed:
+        # workers encode the frames, only this process appends them to the shards
+        with FrameShardWriter(target_dir, shard_size=shard_size) as writer:
+            for fps, records in tqdm(pool.imap_unordered(task_proxy, tasks_kwargs), total=len(clips_paths)):
+                for key, data in records:
+                    writer.append(key, data)
+                clips_fps.append(fps)
+    else:
+        for fps in tqdm(pool.imap_unordered(task_proxy, tasks_kwargs), total=len(clips_paths)):
+            clips_fps.append(fps)
 
     print(f'All possible fps: {Counter(clips_fps).most_common()}')
 
@@ -44,7 +57,8 @@ def task_proxy(kwargs):
 
 def process_video(
     clip_path: os.PathLike, target_dir: os.PathLike, force_fps: int=None, target_size: int=None,
-    broken_clips_dir: os.PathLike=None, compute_fps_only: bool=False) -> int:
+    broken_clips_dir: os.PathLike=None, compute_fps_only: bool=False, packed: bool=False):
+    """Returns the clip fps, or (fps, [(frame_name, jpeg_bytes), ...]) if ``packed``."""
 
     clip_name = os.path.basename(clip_path)
     clip_name = clip_name[:clip_name.rfind('.')]
@@ -57,26 +71,34 @@ def process_video(
         print(f'Coudnt process clip: {clip_path}')
         if not broken_clips_dir is None:
             Path(os.path.join(broken_clips_dir, clip_name)).touch()
-        return 0
+        return (0, []) if packed else 0
 
     if compute_fps_only:
-        return clip.fps
+        return (clip.fps, []) if packed else clip.fps
 
     fps = clip.fps if force_fps is None else force_fps
     clip_target_dir = os.path.join(target_dir, clip_name)
     clip_target_dir = clip_target_dir.replace('#', '_')
-    os.makedirs(clip_target_dir, exist_ok=True)
+    if not packed:
+        os.makedirs(clip_target_dir, exist_ok=True)
 
     frame_idx = 0
+    records = []
     for frame in clip.iter_frames(fps=fps):
         frame = Image.fromarray(frame)
         if not target_size is None:
             frame = TVF.resize(frame, size=target_size, interpolation=Image.LANCZOS)
             frame = TVF.center_crop(frame, output_size=(target_size, target_size))
-        frame.save(os.path.join(clip_target_dir, f'{frame_idx:06d}.jpg'), q=95)
+        if packed:
+            # same name as the loose file, relative to target_dir
+            buffer = io.BytesIO()
+            frame.save(buffer, format='JPEG', q=95)
+            records.append((f"{clip_name.replace('#', '_')}/{frame_idx:06d}.jpg", buffer.getvalue()))
+        else:
+            frame.save(os.path.join(clip_target_dir, f'{frame_idx:06d}.jpg'), q=95)
         frame_idx += 1
 
-    return clip.fps
+    return (clip.fps, records) if packed else clip.fps
 
 
 def listdir_full_paths(d) -> List[os.PathLike]:
@@ -92,6 +114,8 @@ if __name__ == "__main__":
     parser.add_argument('--force_fps', type=int, help='What fps should we run videos with?')
     parser.add_argument('--num_workers', type=int, default=8, help='Number of processes to launch')
     parser.add_argument('--compute_fps_only', action='store_true', help='Should we just compute fps?')
+    parser.add_argument('--packed', action='store_true', help='Write packed frame shards instead of loose jpg files')
+    parser.add_argument('--shard_size', type=int, default=1 << 30, help='Maximum size of a packed shard in bytes')
     args = parser.parse_args()
 
     convert_videos_to_frames(
@@ -102,6 +126,8 @@ if __name__ == "__main__":
         num_workers=args.num_workers,
         video_ext=args.video_ext,
         compute_fps_only=args.compute_fps_only,
+        packed=args.packed,
+        shard_size=args.shard_size,
     )
 
 
@@ -26,7 +26,9 @@ if __name__ == "__main__":
     files_list = get_filelist(image_root_path)
 
     for i in tqdm(files_list):
-        relative_path = i.split(image_root_path)[-1]
+        # relative to frames_dir: the names of the loose frames under frame_data_path and
+        # the keys of the packed shards (process_data.py --packed)
+        relative_path = os.path.relpath(i, image_root_path)
         with open(image_txt_path, 'a+') as f:
-            f.writelines(i + "\n")
+            f.writelines(relative_path + "\n")
 
@@ -0,0 +1,286 @@
+"""
+Asynchronous output stage of the sampling scripts.
+
+AsyncSampleWriter takes decoded videos in [-1, 1] straight from the GPU: they
+are quantized on the device, copied into pinned host buffers with
+non-blocking copies (a CUDA event marks the end of each copy) and handed to
+a process pool that encodes them, so the GPU keeps sampling while ffmpeg
+runs. At most ``max_pending`` batches are in flight; submit() blocks on the
+oldest one beyond that.
+
+Outputs (any combination):
+    mp4  <out_dir>/<index>.mp4 (imageio, like the synchronous loop)
+    png  <out_dir>/<index>/<frame>.png
+    npy  uint8 (n, f, h, w, 3) shards <out_dir>/shards/rank<r>_<run>_<k>.npy
+         with the sample indices in the matching .idx.npy; create_npz_from_shards()
+         streams them into the single .npz used by the evaluation tooling.
+
+submit() takes an optional on_complete callback, called (in the main process)
+once every output of the batch is on disk; job_manager.py uses it to mark its
+work units done.
+
+Run this file for a benchmark with a dummy sampler:
+    python sample/async_writer.py
+"""
+import os
+import glob
+import time
+import zipfile
+import collections
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import numpy as np
+
+
+# The outputs are written under a temporary name and renamed, so that an existing
+# output is always complete (a killed job leaves no truncated files behind).
+
+def _write_mp4(path, video, fps, quality):
+    import imageio
+    tmp_path = path[:-len('.mp4')] + '.tmp.mp4'
+    imageio.mimwrite(tmp_path, video, fps=fps, quality=quality)
+    os.replace(tmp_path, path)
+
+
+def _write_png_dir(path, video):
+    import shutil
+    from PIL import Image
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    for i, frame in enumerate(video):
+        Image.fromarray(frame).save(os.path.join(tmp_path, f"{i:04d}.png"))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def _write_npy(path, videos, indices):
+    # the .idx.npy file is written last: create_npz_from_shards only reads shards that have one
+    np.save(path + '.tmp.npy', videos)
+    os.replace(path + '.tmp.npy', path + '.npy')
+    np.save(path + '.idx.tmp.npy', np.asarray(indices, dtype=np.int64))
+    os.replace(path + '.idx.tmp.npy', path + '.idx.npy')
+
+
+def to_uint8(videos):
+    """(b, f, c, h, w) videos in [-1, 1] -> (b, f, h, w, c) uint8, on the same device."""
+    videos = ((videos * 0.5 + 0.5) * 255).add_(0.5).clamp_(0, 255).to(dtype=torch.uint8)
+    return videos.permute(0, 1, 3, 4, 2).contiguous()
+
+
+class AsyncSampleWriter:
+    """
+    :param out_dir: output directory.
+    :param formats: subset of ('mp4', 'png', 'npy').
+    :param num_workers: encoding processes.
+    :param max_pending: batches copied/encoded at the same time.
+    :param shard_size: videos per .npy shard.
+    :param rank: process rank, used in the shard names.
+    """
+    def __init__(self, out_dir, formats=('mp4',), num_workers=4, max_pending=4, fps=8, quality=9,
+                 shard_size=256, rank=0):
+        assert set(formats) <= {'mp4', 'png', 'npy'}, formats
+        self.out_dir = out_dir
+        self.formats = tuple(formats)
+        self.fps = fps
+        self.quality = quality
+        self.shard_size = shard_size
+        self.rank = rank
+        self.max_pending = max_pending
+        os.makedirs(out_dir, exist_ok=True)
+        if 'npy' in self.formats:
+            os.makedirs(os.path.join(out_dir, 'shards'), exist_ok=True)
+        # spawn: the workers never touch CUDA and the parent has CUDA state and threads
+        self.pool = ProcessPoolExecutor(num_workers, mp_context=mp.get_context('spawn'))
+        self._copies = collections.deque()   # (event, pinned buffer, indices, names, batch)
+        self._futures = collections.deque()
+        self._buffers = {}                   # free pinned buffers by shape
+        self._batches = []                   # [on_complete, futures, waiting for its shard]
+        self._shard, self._shard_indices, self._shard_batches, self._num_shards = [], [], [], 0
+        self._run_id = '%x' % int(time.time() * 1000)  # restarted jobs never overwrite older shards
+
+    def submit(self, videos, indices, on_complete=None, names=None):
+        """
+        Queue (b, f, c, h, w) videos in [-1, 1]; indices are their global sample indices.
+        names: file names (without extension) of the mp4/png outputs, by default the indices.
+        """
+        videos = to_uint8(videos.detach())
+        if videos.is_cuda:
+            free = self._buffers.setdefault(tuple(videos.shape), [])
+            host = free.pop() if free else torch.empty(videos.shape, dtype=torch.uint8, pin_memory=True)
+            host.copy_(videos, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host, event = videos, None
+        batch = [on_complete, [], 'npy' in self.formats]
+        self._batches.append(batch)
+        names = list(names) if names is not None else [f"{index:04d}" for index in indices]
+        self._copies.append((event, host, list(indices), names, batch))
+        self._dispatch(block=False)
+        while len(self._copies) + len(self._futures) > self.max_pending:
+            if self._copies:
+                self._dispatch(block=True)
+            else:
+                self._futures.popleft().result()
+        while self._futures and self._futures[0].done():
+            self._futures.popleft().result()  # re-raises errors of the workers
+        self._complete_batches()
+
+    def _complete_batches(self):
+        pending = []
+        for batch in self._batches:
+            on_complete, futures, waiting = batch
+            if waiting or not all(future.done() for future in futures):
+                pending.append(batch)
+                continue
+            for future in futures:
+                future.result()
+            if on_complete is not None:
+                on_complete()
+        self._batches = pending
+
+    def _dispatch(self, block):
+        """Hand the batches whose device->host copy is complete to the pool (in order)."""
+        while self._copies:
+            event, host, indices, names, batch = self._copies[0]
+            if event is not None:
+                if block:
+                    event.synchronize()
+                    block = False
+                elif not event.query():
+                    return
+            self._copies.popleft()
+            videos = host.numpy().copy()  # the pool pickles lazily: the pinned buffer is reused right away
+            if event is not None:
+                self._buffers[tuple(host.shape)].append(host)
+            for video, name in zip(videos, names):
+                if 'mp4' in self.formats:
+                    batch[1].append(self.pool.submit(
+                        _write_mp4, os.path.join(self.out_dir, f"{name}.mp4"), video, self.fps, self.quality))
+                if 'png' in self.formats:
+                    batch[1].append(self.pool.submit(
+                        _write_png_dir, os.path.join(self.out_dir, name), video))
+            self._futures.extend(batch[1])
+            if 'npy' in self.formats:
+                self._shard.append(videos)
+                self._shard_indices.extend(indices)
+                self._shard_batches.append(batch)
+                if len(self._shard_indices) >= self.shard_size:
+                    self._flush_shard()
+
+    def _flush_shard(self):
+        if not self._shard_indices:
+            return
+        path = os.path.join(self.out_dir, 'shards', f"rank{self.rank:03d}_{self._run_id}_{self._num_shards:05d}")
+        future = self.pool.submit(_write_npy, path, np.concatenate(self._shard), self._shard_indices)
+        self._futures.append(future)
+        for batch in self._shard_batches:
+            batch[1].append(future)
+            batch[2] = False
+        self._shard, self._shard_indices, self._shard_batches = [], [], []
+        self._num_shards += 1
+
+    def close(self):
+        """Wait for every queued video to be written."""
+        while self._copies:
+            self._dispatch(block=True)
+        self._flush_shard()
+        while self._futures:
+            self._futures.popleft().result()
+        self._complete_batches()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def create_npz_from_shards(out_dir, num, npz_path=None):
+    """
+    Streaming counterpart of create_npz_from_sample_folder: writes the first
+    ``num`` samples (by index) of the .npy shards of ``out_dir`` into an .npz
+    with a single ``arr_0`` (num, f, h, w, 3) uint8 array, one sample at a
+    time, so the whole set never has to fit in memory.
+    """
+    npz_path = npz_path or f"{out_dir}.npz"
+    location = {}
+    shards = []
+    for path in sorted(glob.glob(os.path.join(out_dir, 'shards', '*.idx.npy'))):
+        shards.append(np.load(path[:-len('.idx.npy')] + '.npy', mmap_mode='r'))
+        for row, index in enumerate(np.load(path)):
+            location[int(index)] = (len(shards) - 1, row)
+    missing = [i for i in range(num) if i not in location]
+    assert not missing, f"{len(missing)} samples missing from the shards, e.g. {missing[:5]}"
+    sample_shape = shards[0].shape[1:]
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+              'fortran_order': False, 'shape': (num, *sample_shape)}
+    with zipfile.ZipFile(npz_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        with zf.open('arr_0.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array_header_2_0(f, header)
+            for i in range(num):
+                shard, row = location[i]
+                f.write(np.ascontiguousarray(shards[shard][row]).tobytes())
+    print(f"Saved .npz file to {npz_path} [shape={header['shape']}].")
+    return npz_path
+
+
+if __name__ == '__main__':
+    # Dummy sampler: each batch keeps the "GPU" busy for --sample-time seconds, then the
+    # videos are written synchronously (like the old sample_ddp loop) or through the writer.
+    # The utilization is the fraction of the wall time spent sampling.
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--sample-time", type=float, default=1.0)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--formats", type=str, nargs="+", default=['mp4', 'npy'])
+    args = parser.parse_args()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def dummy_sample():
+        start = time.time()
+        videos = torch.rand(args.batch_size, args.frames, 3, args.size, args.size, device=device) * 2 - 1
+        if device == "cuda":
+            a = torch.randn(4096, 4096, device=device)
+            while time.time() - start < args.sample_time:
+                a = a @ a
+                a = a / a.norm()
+                torch.cuda.synchronize()
+        else:
+            time.sleep(max(0., args.sample_time - (time.time() - start)))
+        return videos
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.time()
+        for b in range(args.batches):
+            videos = to_uint8(dummy_sample()).cpu().numpy()
+            for i, video in enumerate(videos):
+                index = b * args.batch_size + i
+                if 'mp4' in args.formats:
+                    _write_mp4(os.path.join(tmp, f"sync_{index:04d}.mp4"), video, 8, 9)
+                if 'png' in args.formats:
+                    _write_png_dir(os.path.join(tmp, f"sync_{index:04d}"), video)
+            if 'npy' in args.formats:
+                _write_npy(os.path.join(tmp, f"sync_{b:05d}"), videos, range(b * args.batch_size, (b + 1) * args.batch_size))
+        sync_time = time.time() - start
+
+        start = time.time()
+        with AsyncSampleWriter(os.path.join(tmp, 'async'), args.formats, num_workers=args.num_workers) as writer:
+            for b in range(args.batches):
+                writer.submit(dummy_sample(), range(b * args.batch_size, (b + 1) * args.batch_size))
+        async_time = time.time() - start
+        if 'npy' in args.formats:
+            create_npz_from_shards(os.path.join(tmp, 'async'), args.batches * args.batch_size)
+
+    busy = args.batches * args.sample_time
+    print(f"synchronous writes: {sync_time:.1f}s, sampler utilization {100 * busy / sync_time:.0f}%")
+    print(f"async writer:       {async_time:.1f}s, sampler utilization {100 * busy / async_time:.0f}%")
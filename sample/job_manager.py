@@ -0,0 +1,325 @@
+"""
+Resumable, sharded sampling jobs (FVD evaluation sweeps).
+
+A job samples ``num_samples`` videos split into work units of ``unit_size``
+consecutive sample indices. Each unit has its own seed, derived from the base
+seed and the unit id only, so a unit gives the same videos whichever worker
+runs it and however often the job is restarted.
+
+Workers share nothing but the output directory:
+    manifest.json        seeds and index ranges of every unit, checkpoint
+                         path/size/sha256 and sampler config; a restart with a
+                         different checkpoint or config is refused.
+    units/<id>.lease     claim of a unit by a worker (O_EXCL create), stamped with
+                         the run id. A background thread touches the leases of a
+                         live worker every ``lease_timeout / 4`` seconds, so a
+                         lease that was not touched for ``lease_timeout`` seconds
+                         belongs to a dead worker and is taken over. Leases of
+                         another run are taken over at once: a job directory is
+                         served by one run (all its workers share the run id) at
+                         a time, and a restarted job redoes the units its
+                         predecessor left unfinished right away.
+    units/<id>.lock      serializes the take-over of a stale lease (flock).
+    units/<id>.done      written once every output of the unit is on disk.
+
+Workers claim the next free unit whenever they are ready, so faster GPUs do
+more units. On restart, done units are skipped. Several processes on one CPU
+box can stand in for a cluster:
+    python sample/job_manager.py --workers 3
+"""
+import os
+import json
+import time
+import fcntl
+import socket
+import hashlib
+import threading
+
+import numpy as np
+
+
+def file_sha256(path, chunk_size=1 << 24):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def unit_seed(base_seed, unit_id):
+    """Seed of a work unit: depends on the base seed and the unit id only."""
+    return int(np.random.SeedSequence([int(base_seed), int(unit_id)]).generate_state(1)[0])
+
+
+# config keys that do not change the samples (paths, ports, output stage)
+VOLATILE_KEYS = {'ckpt', 'port', 'save_video_path', 'save_ceph', 'output_formats', 'writer_workers',
+                 'writer_max_pending', 'save_npz', 'job_lease_timeout'}
+
+
+def new_run_id():
+    return '%x-%x' % (int(time.time() * 1000), os.getpid())
+
+
+class WorkUnit:
+    def __init__(self, unit_id, seed, start, stop):
+        self.unit_id = unit_id
+        self.seed = seed
+        self.indices = list(range(start, stop))
+
+    def __repr__(self):
+        return f"WorkUnit({self.unit_id}, seed={self.seed}, indices={self.indices[0]}..{self.indices[-1]})"
+
+
+class SamplingJob:
+    """
+    :param out_dir: output directory of the samples, shared by all the workers.
+    :param num_samples: number of videos.
+    :param unit_size: videos per work unit (one sampling batch).
+    :param base_seed: seed the unit seeds are derived from.
+    :param ckpt_path: checkpoint, hashed into the manifest (None for none).
+    :param config: dict of the sampler config.
+    :param lease_timeout: seconds after which the unit of a silent worker is re-assigned.
+    :param run_id: id shared by the workers of one run (new_run_id()); the leases of
+                   other runs are stale. None for a fresh id (a single-worker run).
+    """
+    def __init__(self, out_dir, num_samples, unit_size, base_seed=0, ckpt_path=None, config=None,
+                 lease_timeout=300, run_id=None):
+        self.out_dir = out_dir
+        self.unit_dir = os.path.join(out_dir, 'units')
+        self.lease_timeout = lease_timeout
+        self.run_id = run_id or new_run_id()
+        self._held = set()  # leases of this worker, touched by the heartbeat thread
+        self._held_lock = threading.Lock()
+        self._heartbeat = None
+        os.makedirs(self.unit_dir, exist_ok=True)
+        self.manifest = self._load_or_create_manifest(num_samples, unit_size, base_seed, ckpt_path, config or {})
+        self.units = [WorkUnit(u['unit'], u['seed'], u['start'], u['stop']) for u in self.manifest['units']]
+
+    def _load_or_create_manifest(self, num_samples, unit_size, base_seed, ckpt_path, config):
+        path = os.path.join(self.out_dir, 'manifest.json')
+        # as read back from json (tuples become lists)
+        config = json.loads(json.dumps({k: v for k, v in config.items() if k not in VOLATILE_KEYS}))
+        manifest = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+        ckpt = None
+        if ckpt_path is not None:
+            stat = os.stat(ckpt_path)
+            ckpt = {'path': os.path.abspath(ckpt_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+            known = manifest and manifest.get('ckpt')
+            if known and known['size'] == ckpt['size'] and known['mtime'] == ckpt['mtime']:
+                ckpt['sha256'] = known['sha256']  # same file, skip hashing several GB again
+            else:
+                ckpt['sha256'] = file_sha256(ckpt_path)
+
+        if manifest is not None:
+            expected = {'num_samples': num_samples, 'unit_size': unit_size, 'base_seed': base_seed, 'config': config}
+            for key, value in expected.items():
+                if manifest[key] != value:
+                    raise ValueError(f"{path} was written with {key}={manifest[key]!r}, got {value!r}; "
+                                     "use a new output directory for a different job")
+            if (manifest['ckpt'] or {}).get('sha256') != (ckpt or {}).get('sha256'):
+                raise ValueError(f"{path} was written for another checkpoint: {manifest['ckpt']}")
+            return manifest
+
+        num_units = -(-num_samples // unit_size)
+        manifest = {
+            'num_samples': num_samples,
+            'unit_size': unit_size,
+            'base_seed': base_seed,
+            'ckpt': ckpt,
+            'config': config,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'units': [{'unit': k, 'seed': unit_seed(base_seed, k), 'start': k * unit_size,
+                       'stop': min((k + 1) * unit_size, num_samples)} for k in range(num_units)],
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        try:
+            os.link(tmp_path, path)  # first writer wins, the others load its manifest
+        except FileExistsError:
+            os.remove(tmp_path)
+            return self._load_or_create_manifest(num_samples, unit_size, base_seed, ckpt_path, config)
+        os.remove(tmp_path)
+        return manifest
+
+    def _path(self, unit, kind):
+        return os.path.join(self.unit_dir, f"{unit.unit_id:06d}.{kind}")
+
+    def is_done(self, unit):
+        return os.path.exists(self._path(unit, 'done'))
+
+    def _read_lease(self, lease):
+        try:
+            with open(lease, 'r') as f:
+                return json.load(f), os.path.getmtime(lease)
+        except (OSError, ValueError):
+            return None, None  # gone, or being written
+
+    def _is_stale(self, info, mtime, worker):
+        if info is None:
+            return False
+        if info.get('run') != self.run_id:
+            return True  # left behind by an earlier run
+        if info.get('worker') == worker:
+            return True  # our own lease, e.g. of a unit re-claimed after a failed attempt
+        return time.time() - mtime >= self.lease_timeout  # no heartbeat: dead worker
+
+    def _try_claim(self, unit, worker):
+        lease = self._path(unit, 'lease')
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            info, mtime = self._read_lease(lease)
+            if not self._is_stale(info, mtime, worker):
+                return False
+            # stale lease: removed under the unit lock after checking that it is still the same
+            # lease, so a fresh lease created by another worker in the meantime is never lost
+            with open(self._path(unit, 'lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    current, mtime = self._read_lease(lease)
+                    if current != info or not self._is_stale(current, mtime, worker):
+                        return False
+                    os.remove(lease)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False  # another worker claimed it first
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': worker, 'run': self.run_id, 'time': time.time()}, f)
+        if self.is_done(unit):  # finished between the check and the claim
+            os.remove(lease)
+            return False
+        with self._held_lock:
+            self._held.add(lease)
+        self._start_heartbeat()
+        return True
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._touch_leases, daemon=True)
+            self._heartbeat.start()
+
+    def _touch_leases(self):
+        while True:
+            time.sleep(self.lease_timeout / 4)
+            with self._held_lock:
+                held = list(self._held)
+            for lease in held:
+                try:
+                    os.utime(lease)
+                except FileNotFoundError:
+                    pass
+
+    def claim_units(self, worker=None, start=0):
+        """
+        Yield the units this worker claims, until every unit is done or leased to a
+        live worker of this run. ``start`` spreads the workers over the units to limit
+        contention.
+        """
+        worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        order = self.units[start % len(self.units):] + self.units[:start % len(self.units)]
+        for unit in order:
+            if not self.is_done(unit) and self._try_claim(unit, worker):
+                yield unit
+
+    def complete(self, unit, **info):
+        """Mark a unit done (its outputs are on disk) and release its lease."""
+        with open(self._path(unit, 'done'), 'w') as f:
+            json.dump(dict(info, seed=unit.seed, time=time.time()), f)
+        with self._held_lock:
+            self._held.discard(self._path(unit, 'lease'))
+        try:
+            os.remove(self._path(unit, 'lease'))
+        except FileNotFoundError:
+            pass
+
+    def num_done(self):
+        return sum(self.is_done(unit) for unit in self.units)
+
+    def is_complete(self):
+        return self.num_done() == len(self.units)
+
+    def missing_units(self):
+        return [unit for unit in self.units if not self.is_done(unit)]
+
+
+def _demo_worker(out_dir, run_id, worker_id, num_samples, unit_size, sample_time, fail_after, result_queue):
+    import torch
+    from functools import partial
+    from async_writer import AsyncSampleWriter
+
+    # short leases, and units only done once their shard of 4 units is written: the
+    # heartbeat has to keep the pending units leased
+    job = SamplingJob(out_dir, num_samples, unit_size, base_seed=7, config={'model': 'dummy'}, lease_timeout=0.5,
+                      run_id=run_id)
+    done = []
+    with AsyncSampleWriter(out_dir, ['npy'], num_workers=1, shard_size=4 * unit_size, rank=worker_id) as writer:
+        for unit in job.claim_units(f"worker{worker_id}", start=worker_id):
+            if fail_after is not None and len(done) == fail_after:
+                os._exit(1)  # simulated crash, leaves its lease behind
+            torch.manual_seed(unit.seed)
+            time.sleep(sample_time)
+            videos = torch.rand(len(unit.indices), 2, 3, 8, 8) * 2 - 1
+            writer.submit(videos, unit.indices, on_complete=partial(job.complete, unit, worker=worker_id))
+            done.append(unit.unit_id)
+    result_queue.put((worker_id, done))
+
+
+if __name__ == '__main__':
+    # Workers of different speeds share one job; the first one crashes. The restarted run
+    # takes over the leases of the dead worker right away and finishes the job without
+    # sampling any unit twice, and the seeded outputs are compared with a single worker run.
+    import argparse
+    import tempfile
+    import multiprocessing as mp
+    from async_writer import create_npz_from_shards
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--num-samples", type=int, default=60)
+    parser.add_argument("--unit-size", type=int, default=4)
+    args = parser.parse_args()
+    ctx = mp.get_context('spawn')
+
+    def run(out_dir, speeds, fail_after=None):
+        queue = ctx.Queue()
+        run_id = new_run_id()
+        procs = [ctx.Process(target=_demo_worker, args=(out_dir, run_id, i, args.num_samples, args.unit_size, speed,
+                                                        fail_after if i == 0 else None, queue))
+                 for i, speed in enumerate(speeds)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        sampled = []
+        while not queue.empty():
+            worker_id, units = queue.get()
+            sampled.extend(units)
+            print(f"  worker{worker_id} ({speeds[worker_id]:.2f}s/unit): {len(units)} units")
+        assert len(sampled) == len(set(sampled)), "units sampled twice"
+        return sampled
+
+    with tempfile.TemporaryDirectory() as tmp:
+        speeds = [0.05 * (i + 1) for i in range(args.workers)]
+        print("first run, worker0 crashes after 2 units:")
+        run(os.path.join(tmp, 'job'), speeds, fail_after=2)
+        job = SamplingJob(os.path.join(tmp, 'job'), args.num_samples, args.unit_size, base_seed=7,
+                          config={'model': 'dummy'})
+        missing = [unit.unit_id for unit in job.missing_units()]
+        print(f"  {job.num_done()}/{len(job.units)} units done")
+        print("restart:")
+        sampled = run(os.path.join(tmp, 'job'), speeds)
+        assert job.is_complete(), f"{job.num_done()}/{len(job.units)} units done"
+        assert sorted(sampled) == sorted(missing), "the restart sampled other units than the missing ones"
+        print("reference, single worker:")
+        run(os.path.join(tmp, 'ref'), [0.])
+        a = np.load(create_npz_from_shards(os.path.join(tmp, 'job'), args.num_samples))['arr_0']
+        b = np.load(create_npz_from_shards(os.path.join(tmp, 'ref'), args.num_samples))['arr_0']
+        assert (a == b).all(), "restarted job differs from the single worker run"
+        print("restarted job matches the single worker run")
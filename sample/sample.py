@@ -29,6 +29,7 @@ from einops import rearrange
 from models import get_models
 from torchvision.utils import save_image
 from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
 from models.clip import TextEmbedder
 import imageio
 from omegaconf import OmegaConf
@@ -65,9 +66,17 @@ def main(args):
     model.load_state_dict(state_dict, strict=False)
 
     model.eval()  # important!
-    diffusion = create_diffusion(str(args.num_sampling_steps))
+    if getattr(args, 'block_cache_interval', 1) > 1:  # reuse the deep blocks across steps, see sample_cache_sweep.py
+        if not hasattr(model, 'enable_block_cache'):
+            raise ValueError(f"block_cache_interval > 1 needs a model with a block cache (EnDora), "
+                             f"{type(model).__name__} of model {args.model} has none")
+        model.enable_block_cache(args.block_cache_start, args.block_cache_interval,
+                                 getattr(args, 'block_cache_full_steps', 0))
+    # DPM-Solver++ selects its num_sampling_steps timesteps from the full 1000-step process
+    diffusion = create_diffusion("" if args.sample_method == 'dpm-solver++' else str(args.num_sampling_steps))
     # vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-{args.vae}").to(device)
     vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-ema").to(device)
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
     # vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae").to(device)
     # text_encoder = TextEmbedder().to(device)
 
@@ -89,16 +98,19 @@ def main(args):
         # Setup classifier-free guidance:
         # z = torch.cat([z, z], 0)
         if using_cfg:
-            z = torch.cat([z, z], 0)
             y = torch.randint(0, args.num_classes, (1,), device=device)
             y_null = torch.tensor([101] * 1, device=device)
-            y = torch.cat([y, y_null], dim=0)
-            model_kwargs = dict(y=y, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16)
-            sample_fn = model.forward_with_cfg
+            # only the conditional trajectory is sampled, the null-class batch is built in the model call
+            model_kwargs = dict(y=y, y_null=y_null, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16,
+                                guidance_interval=getattr(args, 'guidance_interval', None))
+            sample_fn = model.forward_with_guidance
         else:
             sample_fn = model.forward
             model_kwargs = dict(y=None, use_fp16=args.use_fp16)
 
+        if getattr(model, 'block_cache', None) is not None:
+            model.block_cache.reset()  # new trajectory
+
         # Sample images:
         if args.sample_method == 'ddim':
             samples = diffusion.ddim_sample_loop(
@@ -108,13 +120,19 @@ def main(args):
             samples = diffusion.p_sample_loop(
                 sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True, device=device
             )
+        elif args.sample_method == 'dpm-solver++':
+            samples = diffusion.dpm_solver_sample_loop(
+                sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True, device=device,
+                num_steps=args.num_sampling_steps, order=getattr(args, 'solver_order', 2),
+                skip_type=getattr(args, 'skip_type', 'time_uniform')
+            )
 
         print(samples.shape)
         if args.use_fp16:
             samples = samples.to(dtype=torch.float16)
         b, f, c, h, w = samples.shape
         samples = rearrange(samples, 'b f c h w -> (b f) c h w')
-        samples = vae.decode(samples / 0.18215).sample
+        samples = vae.decode(samples / 0.18215)
         samples = rearrange(samples, '(b f) c h w -> b f c h w', b=b)
         # Save and display images:
 
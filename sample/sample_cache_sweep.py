@@ -0,0 +1,128 @@
+"""
+Speed/quality trade-off of the EnDora block cache (EnDora.enable_block_cache).
+
+Samples the same noise with full computation and with the deep block pairs
+reused for interval - 1 steps out of interval, and reports for every setting
+the sampling time, the speedup and the PSNR of the decoded videos against the
+fully computed ones. With --save_video_path the videos of every setting are
+written to <save_video_path>/<setting>/ so that FVD can be computed on them
+with the usual evaluation tooling.
+"""
+import os
+import sys
+try:
+    import utils
+
+    from diffusion import create_diffusion
+    from download import find_model
+except:
+    sys.path.append(os.path.split(sys.path[0])[0])
+
+    import utils
+
+    from diffusion import create_diffusion
+    from download import find_model
+
+import time
+import torch
+import argparse
+import imageio
+
+from einops import rearrange
+from models import get_models
+from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
+from omegaconf import OmegaConf
+
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+
+def psnr(x, y):
+    """PSNR of videos in [-1, 1], averaged over the batch."""
+    mse = ((x - y) / 2).pow(2).flatten(1).mean(dim=1)
+    return (10 * torch.log10(1 / mse.clamp(min=1e-10))).mean().item()
+
+
+def sample_videos(args, model, diffusion, vae, noise, device):
+    model_kwargs = dict(y=None, use_fp16=args.use_fp16)
+    if getattr(model, 'block_cache', None) is not None:
+        model.block_cache.reset()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    latents = diffusion.ddim_sample_loop(
+        model.forward, noise.shape, noise, clip_denoised=False, model_kwargs=model_kwargs, progress=False, device=device
+    )
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.time() - start_time
+    b = latents.shape[0]
+    latents = rearrange(latents, 'b f c h w -> (b f) c h w')
+    videos = vae.decode(latents / 0.18215)
+    return rearrange(videos, '(b f) c h w -> b f c h w', b=b).float(), elapsed
+
+
+def main(args, intervals, start_blocks, num_videos):
+    torch.set_grad_enabled(False)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    latent_size = args.image_size // 8
+    args.latent_size = latent_size
+    model = get_models(args).to(device)
+    if not hasattr(model, 'enable_block_cache'):
+        raise ValueError(f"{type(model).__name__} of model {args.model} has no block cache to sweep")
+    model.load_state_dict(find_model(args.ckpt), strict=False)
+    model.eval()  # important!
+    diffusion = create_diffusion(str(args.num_sampling_steps))
+    vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-ema").to(device)
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
+    dtype = torch.float16 if args.use_fp16 else torch.float32
+    if args.use_fp16:
+        vae.to(dtype=torch.float16)
+        model.to(dtype=torch.float16)
+
+    generator = torch.Generator(device=device).manual_seed(getattr(args, 'seed', None) or 0)
+    noise = torch.randn(num_videos, args.num_frames, 4, latent_size, latent_size,
+                        generator=generator, device=device, dtype=dtype)
+
+    settings = [('full', None, 1)] + [('start{}-every{}'.format(start, interval), start, interval)
+                                      for start in start_blocks for interval in intervals if interval > 1]
+    reference, reference_time = None, None
+    print(f"{'setting':>18} {'time (s)':>9} {'speedup':>8} {'reused':>7} {'PSNR (dB)':>10}")
+    for name, start, interval in settings:
+        if start is None:
+            model.disable_block_cache()
+        else:
+            model.enable_block_cache(start, interval, args.block_cache_full_steps)
+        # warmup with the same setting, so that the timings do not include cudnn autotuning
+        sample_videos(args, model, diffusion, vae, noise[:1], device)
+        videos, elapsed = sample_videos(args, model, diffusion, vae, noise, device)
+        reused = model.block_cache.num_reused if start is not None else 0
+        if reference is None:
+            reference, reference_time = videos, elapsed
+        print(f"{name:>18} {elapsed:9.2f} {reference_time / elapsed:8.2f} {reused:7d} "
+              f"{psnr(videos, reference) if start is not None else float('inf'):10.2f}")
+
+        if args.save_video_path:
+            os.makedirs(os.path.join(args.save_video_path, name), exist_ok=True)
+            for i, video in enumerate(videos):
+                video = ((video * 0.5 + 0.5) * 255).add_(0.5).clamp_(0, 255).to(dtype=torch.uint8).cpu().permute(0, 2, 3, 1).contiguous()
+                imageio.mimwrite(os.path.join(args.save_video_path, name, f'{i:04d}.mp4'), video, fps=8, quality=9)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./configs/col/col_sample.yaml")
+    parser.add_argument("--ckpt", type=str, default="")
+    parser.add_argument("--save_video_path", type=str, default="")
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 4, 5])
+    parser.add_argument("--start-blocks", dest="start_blocks", type=int, nargs="+", default=[4, 7, 10])
+    parser.add_argument("--full-steps", dest="full_steps", type=int, default=0)
+    parser.add_argument("--num-videos", dest="num_videos", type=int, default=4)
+    args = parser.parse_args()
+    omega_conf = OmegaConf.load(args.config)
+    omega_conf.ckpt = args.ckpt
+    omega_conf.save_video_path = args.save_video_path
+    omega_conf.block_cache_full_steps = args.full_steps
+    main(omega_conf, args.intervals, args.start_blocks, args.num_videos)
@@ -4,7 +4,13 @@
 # LICENSE file in the root directory of this source tree.
 
 """
-Sample new images from a pre-trained EnDora.
+Sample mask-conditioned videos from a pre-trained EnDora (extras == 3).
+
+The mask videos of a manifest (mask_manifest: a list file or a directory) are
+decoded by DataLoader workers, encoded by the VAE (or read from the
+mask_latent_cache_path of extract_mask_latents.py) and sampled
+per_proc_batch_size at a time; with torchrun the manifest is sharded over the
+ranks. Each output is saved as sample_<mask video name>.mp4.
 """
 import os
 import sys
@@ -21,13 +27,16 @@ except:
     from diffusion import create_diffusion
     from download import find_model
 
+import time
 import torch
 import argparse
 import torchvision
+import torch.distributed as dist
 
 from einops import rearrange
-from models import get_models
+from models import get_models, load_model_state
 from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
 import imageio
 from omegaconf import OmegaConf
 
@@ -38,6 +47,9 @@ torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
 
 from datasets import video_transforms
+from datasets.col_datasets import DecordInit
+from datasets.latent_datasets import MaskLatents
+from async_writer import AsyncSampleWriter
 from torchvision import transforms
 from PIL import Image
 
@@ -67,12 +79,71 @@ def load_model(device, pretrained_path):
 
     return model
 
+class MaskVideoDataset(torch.utils.data.Dataset):
+    """
+    The mask videos of a manifest, decoded in the loader workers: a text file with
+    one video path per line (relative paths are resolved against the manifest's
+    directory, '#' starts a comment) or a directory of .mp4 files. Only the
+    num_frames sampled frames of each video are decoded. With ``mask_latents``
+    (datasets.latent_datasets.MaskLatents) the videos are not decoded at all and
+    their cached VAE latents are returned instead.
+    """
+    def __init__(self, manifest, num_frames, frame_interval, transform, mask_latents=None):
+        if os.path.isdir(manifest):
+            self.paths = sorted(glob.glob(os.path.join(manifest, '*.mp4')))
+        else:
+            root = os.path.dirname(os.path.abspath(manifest))
+            with open(manifest, 'r') as f:
+                lines = [line.split('#')[0].strip() for line in f]
+            self.paths = [os.path.join(root, line) for line in lines if line]
+        self.num_frames = num_frames
+        self.temporal_sample = video_transforms.TemporalRandomCrop(num_frames * frame_interval)
+        self.transform = transform
+        self.v_decoder = DecordInit()
+        self.mask_latents = mask_latents
+        if mask_latents is not None:
+            self.keys = [os.path.relpath(path, mask_latents.data_path) for path in self.paths]
+            missing = [key for key in self.keys if key not in mask_latents]
+            assert not missing, f'{len(missing)} mask videos are not in the mask latent cache, e.g. {missing[:3]}'
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        path = self.paths[index]
+        name = os.path.splitext(os.path.basename(path))[0]
+        if self.mask_latents is not None:
+            start_frame_ind, end_frame_ind = self.temporal_sample(self.mask_latents.num_frames(self.keys[index]))
+            frame_indice = np.linspace(start_frame_ind, end_frame_ind - 1, self.num_frames, dtype=int)
+            latents = self.mask_latents.video(self.keys[index], frame_indice, flip=random.random() < 0.5)
+            return {'mask_latent': latents, 'index': index, 'name': name}
+        v_reader = self.v_decoder(path)
+        total_frames = len(v_reader)
+        start_frame_ind, end_frame_ind = self.temporal_sample(total_frames)
+        assert end_frame_ind - start_frame_ind >= self.num_frames, f'{path} is too short'
+        frame_indice = np.linspace(start_frame_ind, end_frame_ind - 1, self.num_frames, dtype=int)
+        video = torch.from_numpy(v_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        del v_reader
+        return {'video_mask': self.transform(video), 'index': index, 'name': name}
+
+
 def main(args):
     # Setup PyTorch:
-    # torch.manual_seed(args.seed)
     torch.set_grad_enabled(False)
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    # device = "cpu"
+    # Shard the mask videos over the ranks like sample_ddp.py (torchrun), single process otherwise:
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        dist.init_process_group("nccl")
+        rank = dist.get_rank()
+    else:
+        rank = 0
+    if torch.cuda.is_available():
+        device = torch.device("cuda", rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+    if getattr(args, 'seed', None):
+        torch.manual_seed(args.seed * world_size + rank)
 
     transform_col = transforms.Compose([
         video_transforms.ToTensorVideo(),  # TCHW
@@ -81,11 +152,6 @@ def main(args):
         transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
     ])
 
-    image_tranform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)
-    ])
-
     if args.ckpt is None:
         print('ckpt Path Not available')
         exit(-1)
@@ -107,60 +173,65 @@ def main(args):
     state_dict = find_model(ckpt_path)
     model.load_state_dict(state_dict, strict=False)
     '''
-    states = torch.load(args.ckpt)
-    model.load_state_dict(states['ema'])
+    states = torch.load(args.ckpt, map_location="cpu")
+    # checkpoints only hold the DINO prior heads of their training mode; sampling uses none of them
+    load_model_state(model, states['ema'])
+    del states
 
     model.eval()  # important!
-    diffusion = create_diffusion(str(args.num_sampling_steps))
+    # DPM-Solver++ selects its num_sampling_steps timesteps from the full 1000-step process
+    diffusion = create_diffusion("" if args.sample_method == 'dpm-solver++' else str(args.num_sampling_steps))
     vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-ema").to(device)
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
+    vae.requires_grad_(False)
 
     if args.use_fp16:
         print('WARNING: using half percision for inferencing!')
         vae.to(dtype=torch.float16)
         model.to(dtype=torch.float16)
 
-    # Labels to condition the model with (feel free to change):
-
-    # Create sampling noise:
-    for idx in range (1, 17):
+    # Mask videos: decoded and transformed by the loader workers ahead of the GPU, this rank's share only
+    mask_latents = MaskLatents(args.mask_latent_cache_path) if getattr(args, 'mask_latent_cache_path', None) else None
+    dataset = MaskVideoDataset(getattr(args, 'mask_manifest', '/home/work/polypgen/CVC-ClinicDB/mask_video/'),
+                               args.num_frames, args.frame_interval, transform_col, mask_latents=mask_latents)
+    shard = torch.utils.data.Subset(dataset, range(rank, len(dataset), world_size))
+    loader = torch.utils.data.DataLoader(
+        shard,
+        batch_size=getattr(args, 'per_proc_batch_size', 1),
+        shuffle=False,
+        num_workers=getattr(args, 'num_workers', 4),
+        pin_memory=True,
+        drop_last=False,
+    )
+    if rank == 0:
+        print(f"{len(dataset)} mask videos, {len(shard)} on each of the {world_size} ranks")
+    os.makedirs(args.save_video_path, exist_ok=True)
+    writer = AsyncSampleWriter(args.save_video_path, ['mp4'], num_workers=getattr(args, 'writer_workers', 4), rank=rank)
+
+    num_videos, start_time = 0, time.time()
+    for batch in loader:
+        c = batch['mask_latent' if mask_latents is not None else 'video_mask'].to(device, non_blocking=True)
+        n = c.shape[0]
         if args.use_fp16:
-            z = torch.randn(1, args.num_frames, 4, latent_size, latent_size, dtype=torch.float16, device=device) # b c f h w
+            c = c.to(dtype=torch.float16)
+            z = torch.randn(n, args.num_frames, 4, latent_size, latent_size, dtype=torch.float16, device=device) # b f c h w
         else:
-            z = torch.randn(1, args.num_frames, 4, latent_size, latent_size, device=device)
-
-        vframes_m, aframes_m, info_m = torchvision.io.read_video(
-            filename='/home/work/polypgen/CVC-ClinicDB/mask_video/' + str(idx).zfill(5) + '.mp4',
-            pts_unit='sec', output_format='TCHW')
-        total_frames = len(vframes_m)
-
-        temporal_sample = video_transforms.TemporalRandomCrop(args.num_frames * args.frame_interval)
-        start_frame_ind, end_frame_ind = temporal_sample(total_frames)
-        assert end_frame_ind - start_frame_ind >= args.num_frames
-        frame_indice = np.linspace(start_frame_ind, end_frame_ind - 1, args.num_frames, dtype=int)
-
-        # Sampling mask video frames
-        video_m = vframes_m[frame_indice]
-        # videotransformer data proprecess
-        video_m = transform_col(video_m)  # T C H W
+            z = torch.randn(n, args.num_frames, 4, latent_size, latent_size, device=device)
 
-        c = video_m.contiguous().cuda()
-
-        vae.requires_grad_(False)
-
-        # c = rearrange(c, 'b f c h w -> (b f) c h w').contiguous()
-        c = vae.encode(c).latent_dist.sample().mul_(0.18215)
-        c = rearrange(c, '(b f) c h w -> b f c h w', b=1).contiguous()
+        if mask_latents is None:
+            # one VAE call for the masks of the whole batch
+            c = rearrange(c, 'b f c h w -> (b f) c h w').contiguous()
+            c = vae.encode(c).mul_(0.18215)
+            c = rearrange(c, '(b f) c h w -> b f c h w', b=n).contiguous()
 
         # Setup classifier-free guidance:
-        # z = torch.cat([z, c], 0)
         if using_cfg:
-            print('using cfg')
-            z = torch.cat([z, c], 0)
-            y = torch.randint(0, args.num_classes, (1,), device=device)
-            y_null = torch.tensor([101] * 1, device=device)
-            y = torch.cat([y, y_null], dim=0)
-            model_kwargs = dict(y=y, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16)
-            sample_fn = model.forward_with_cfg
+            y = torch.randint(0, args.num_classes, (n,), device=device)
+            y_null = torch.tensor([101] * n, device=device)
+            # only the conditional trajectory is sampled, the null-class batch is built in the model call
+            model_kwargs = dict(y=y, y_null=y_null, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16,
+                                guidance_interval=getattr(args, 'guidance_interval', None))
+            sample_fn = model.forward_with_guidance
         else:
             sample_fn = model.forward
             model_kwargs = dict(y=None, use_fp16=args.use_fp16)
@@ -170,31 +241,36 @@ def main(args):
         # Sample images:
         if args.sample_method == 'ddim':
             samples = diffusion.ddim_sample_loop(
-                sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True, device=device
+                sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=rank == 0, device=device
             )
         elif args.sample_method == 'ddpm':
             samples = diffusion.p_sample_loop(
-                sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True, device=device
+                sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=rank == 0, device=device
+            )
+        elif args.sample_method == 'dpm-solver++':
+            samples = diffusion.dpm_solver_sample_loop(
+                sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=rank == 0, device=device,
+                num_steps=args.num_sampling_steps, order=getattr(args, 'solver_order', 2),
+                skip_type=getattr(args, 'skip_type', 'time_uniform')
             )
 
-        print(samples.shape)
         if args.use_fp16:
             samples = samples.to(dtype=torch.float16)
         b, f, c, h, w = samples.shape
         samples = rearrange(samples, 'b f c h w -> (b f) c h w')
-        samples = vae.decode(samples / 0.18215).sample
+        samples = vae.decode(samples / 0.18215)
         samples = rearrange(samples, '(b f) c h w -> b f c h w', b=b)
-        # Save and display images:
-
-        if not os.path.exists(args.save_video_path):
-            os.makedirs(args.save_video_path)
 
-        print(samples.shape, "!!!")
-        video_ = ((samples[0] * 0.5 + 0.5) * 255).add_(0.5).clamp_(0, 255).to(dtype=torch.uint8).cpu().permute(0, 2, 3, 1).contiguous()
-        video_save_path = os.path.join(args.save_video_path, 'sample_' + str(idx).zfill(2) + '.mp4')
-        print(video_save_path, video_.shape)
-        imageio.mimwrite(video_save_path, video_, fps=8, quality=9)
-        print('save path {}'.format(args.save_video_path))
+        # Save the videos as sample_<mask video name>.mp4 while the next batch is sampled
+        writer.submit(samples, batch['index'].tolist(), names=['sample_' + name for name in batch['name']])
+        num_videos += n
+    writer.close()
+    elapsed = time.time() - start_time
+    print(f"rank {rank}: {num_videos} videos in {elapsed:.1f}s ({num_videos / max(elapsed, 1e-6):.3f} videos/s), "
+          f"saved to {args.save_video_path}")
+    if world_size > 1:
+        dist.barrier()
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
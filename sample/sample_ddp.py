@@ -12,6 +12,7 @@ For a simple single-GPU/CPU sampling script, see sample.py.
 """
 import io
 import os
+import socket
 # os.environ['CUDA_VISIBLE_DEVICES']='3'
 os.environ['RANK'] = '0'                    
 # os.environ['WORLD_SIZE'] = '4'               
@@ -25,6 +26,7 @@ import torch.distributed as dist
 from download import find_model
 from diffusion import create_diffusion
 from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
 from tqdm import tqdm
 import os
 from PIL import Image
@@ -32,9 +34,12 @@ import numpy as np
 import math
 import argparse
 import imageio
+from functools import partial
 from omegaconf import OmegaConf
 from models import get_models
 from einops import rearrange
+from async_writer import AsyncSampleWriter, create_npz_from_shards
+from job_manager import SamplingJob, new_run_id
 
 
 def create_npz_from_sample_folder(sample_dir, num=50_000):
@@ -91,10 +96,18 @@ def main(args):
     state_dict = find_model(ckpt_path)
     model.load_state_dict(state_dict, strict=False)
     model.eval()  # important!
-    diffusion = create_diffusion(str(args.num_sampling_steps))
+    if getattr(args, 'block_cache_interval', 1) > 1:  # reuse the deep blocks across steps, see sample_cache_sweep.py
+        if not hasattr(model, 'enable_block_cache'):
+            raise ValueError(f"block_cache_interval > 1 needs a model with a block cache (EnDora), "
+                             f"{type(model).__name__} of model {args.model} has none")
+        model.enable_block_cache(args.block_cache_start, args.block_cache_interval,
+                                 getattr(args, 'block_cache_full_steps', 0))
+    # DPM-Solver++ selects its num_sampling_steps timesteps from the full 1000-step process
+    diffusion = create_diffusion("" if args.sample_method == 'dpm-solver++' else str(args.num_sampling_steps))
     # vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-{args.vae}").to(device)
     # vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae").to(device)
     vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-ema").to(device)
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
     # modified by piang
     # vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="sd-vae-ft-ema").to(device)
     
@@ -121,39 +134,51 @@ def main(args):
         print(f"Saving .mp4 samples at {sample_folder_dir}")
     dist.barrier()
 
-    # Figure out how many samples we need to generate on each GPU and how many iterations we need to run:
+    # Work units of per_proc_batch_size videos with their own seeds, claimed by the ranks as they
+    # become free; a restarted job skips the units already done (see job_manager.py):
     n = args.per_proc_batch_size
-    global_batch_size = n * dist.get_world_size()
-    # To make things evenly-divisible, we'll sample a bit more than we need and then discard the extra samples:
-    total_samples = int(math.ceil(args.num_fvd_samples / global_batch_size) * global_batch_size)
+    make_job = partial(SamplingJob, sample_folder_dir, args.num_fvd_samples, n, base_seed=args.seed or 0,
+                       ckpt_path=args.ckpt, config=OmegaConf.to_container(args, resolve=True),
+                       lease_timeout=getattr(args, 'job_lease_timeout', 300))
+    # leases of earlier runs are taken over at once, the ranks of this run share its id
+    run_id = [new_run_id() if rank == 0 else None]
+    dist.broadcast_object_list(run_id, src=0)
+    make_job = partial(make_job, run_id=run_id[0])
+    job = make_job() if rank == 0 else None  # rank 0 writes the manifest (and hashes the checkpoint) first
+    dist.barrier()
+    job = job or make_job()
     if rank == 0:
-        print(f"Total number of images that will be sampled: {total_samples}")
-    assert total_samples % dist.get_world_size() == 0, "total_samples must be divisible by world_size"
-    samples_needed_this_gpu = int(total_samples // dist.get_world_size())
-    assert samples_needed_this_gpu % n == 0, "samples_needed_this_gpu must be divisible by the per-GPU batch size"
-    iterations = int(samples_needed_this_gpu // n)
-    pbar = range(iterations)
-    pbar = tqdm(pbar) if rank == 0 else pbar
-    total = 0
-    for _ in pbar:
+        print(f"Total number of videos that will be sampled: {args.num_fvd_samples}, "
+              f"{len(job.units) - job.num_done()}/{len(job.units)} units of {n} left")
+    # videos are encoded on a process pool while the GPU keeps sampling, see async_writer.py
+    output_formats = list(getattr(args, 'output_formats', ['mp4']))
+    writer = AsyncSampleWriter(sample_folder_dir, output_formats, num_workers=getattr(args, 'writer_workers', 4),
+                               max_pending=getattr(args, 'writer_max_pending', 4), rank=rank)
+
+    def sample_unit(unit):
+        torch.manual_seed(unit.seed)  # the unit gives the same videos on any rank and after restarts
+        n = len(unit.indices)
         # Sample inputs:
         if args.use_fp16:
             z = torch.randn(n, args.num_frames, 4, latent_size, latent_size, dtype=torch.float16, device=device)
         else:
             z = torch.randn(n, args.num_frames, 4, latent_size, latent_size, device=device)
-        
+
         # Setup classifier-free guidance:
         if using_cfg:
-            z = torch.cat([z, z], 0)
             y = torch.randint(0, args.num_classes, (n,), device=device)
             y_null = torch.tensor([101] * n, device=device)
-            y = torch.cat([y, y_null], dim=0)
-            model_kwargs = dict(y=y, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16)
-            sample_fn = model.forward_with_cfg
+            # only the conditional trajectory is sampled, the null-class batch is built in the model call
+            model_kwargs = dict(y=y, y_null=y_null, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16,
+                                guidance_interval=getattr(args, 'guidance_interval', None))
+            sample_fn = model.forward_with_guidance
         else:
             model_kwargs = dict(y=None, use_fp16=args.use_fp16)
             sample_fn = model.forward
 
+        if getattr(model, 'block_cache', None) is not None:
+            model.block_cache.reset()  # new trajectory
+
         # Sample images:
         if args.sample_method == 'ddim':
             samples = diffusion.ddim_sample_loop(
@@ -163,34 +188,48 @@ def main(args):
             samples = diffusion.p_sample_loop(
                 sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=False, device=device
             )
+        elif args.sample_method == 'dpm-solver++':
+            samples = diffusion.dpm_solver_sample_loop(
+                sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=False, device=device,
+                num_steps=args.num_sampling_steps, order=getattr(args, 'solver_order', 2),
+                skip_type=getattr(args, 'skip_type', 'time_uniform')
+            )
 
 
-        if using_cfg:
-            samples, _ = samples.chunk(2, dim=0)  # Remove null class samples
-
         if args.use_fp16:
             samples = samples.to(dtype=torch.float16)
 
         b, f, c, h, w = samples.shape
         samples = rearrange(samples, 'b f c h w -> (b f) c h w')
-        samples = vae.decode(samples / 0.18215).sample
+        samples = vae.decode(samples / 0.18215)
         samples = rearrange(samples, '(b f) c h w -> b f c h w', b=b)
 
-        # Save samples to disk as individual .png files
-        for i, sample in enumerate(samples):
-            sample = ((sample * 0.5 + 0.5) * 255).add_(0.5).clamp_(0, 255).to(dtype=torch.uint8).cpu().permute(0, 2, 3, 1).contiguous()
-            index = i * dist.get_world_size() + rank + total
-            # Image.fromarray(sample).save(f"{sample_folder_dir}/{index:04d}.png")
-            sample_save_path = f"{sample_folder_dir}/{index:04d}.mp4"
-            imageio.mimwrite(sample_save_path, sample, fps=8, quality=9)
-        total += global_batch_size
-
-    # Make sure all processes have finished saving their samples before attempting to convert to .npz
+        # Save samples to disk (asynchronously), the unit is marked done once they are written
+        writer.submit(samples, unit.indices, on_complete=partial(job.complete, unit, rank=rank))
+
+    # Units still missing after a pass (their lease is this rank's own or went stale) are claimed
+    # again once; a job that stays incomplete fails loudly instead of leaving holes in the samples.
+    worker = f"{socket.gethostname()}-rank{rank}"
+    for attempt in range(2):
+        pbar = job.claim_units(worker, start=rank * len(job.units) // dist.get_world_size())
+        for unit in tqdm(pbar) if rank == 0 else pbar:
+            sample_unit(unit)
+        writer.close()
+        dist.barrier()
+        if job.is_complete():
+            break
+        writer = AsyncSampleWriter(sample_folder_dir, output_formats, num_workers=getattr(args, 'writer_workers', 4),
+                                   max_pending=getattr(args, 'writer_max_pending', 4), rank=rank)
+    missing = job.missing_units()
+    if missing:
+        raise RuntimeError(f"{len(missing)}/{len(job.units)} work units are not done, e.g. {missing[:3]}; "
+                           f"run the job again to sample them")
+
+    # every unit is done: all processes have finished saving their samples
+    if rank == 0 and 'npy' in output_formats and getattr(args, 'save_npz', False):
+        create_npz_from_shards(sample_folder_dir, args.num_fvd_samples)
+        print("Done.")
     dist.barrier()
-    # if rank == 0:
-    #     create_npz_from_sample_folder(sample_folder_dir, args.num_fvd_samples)
-    #     print("Done.")
-    # dist.barrier()
     dist.destroy_process_group()
 
 
@@ -4,7 +4,10 @@
 # LICENSE file in the root directory of this source tree.
 
 """
-Sample new images from a pre-trained EnDora.
+Sample long videos from a pre-trained EnDora with a sliding window over the
+frames: each window of num_frames is conditioned on the last window_overlap
+latents of the previous one, and the frames are written to a single video as
+they are decoded.
 """
 import os
 import sys
@@ -27,6 +30,7 @@ import argparse
 from einops import rearrange
 from models import get_models
 from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
 import imageio
 from omegaconf import OmegaConf
 
@@ -61,68 +65,99 @@ def main(args):
     model.load_state_dict(state_dict, strict=False)
 
     model.eval()  # important!
-    diffusion = create_diffusion(str(args.num_sampling_steps))
+    # DPM-Solver++ selects its num_sampling_steps timesteps from the full 1000-step process
+    diffusion = create_diffusion("" if args.sample_method == 'dpm-solver++' else str(args.num_sampling_steps))
     vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-ema").to(device)
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
 
     if args.use_fp16:
         print('WARNING: using half percision for inferencing!')
         vae.to(dtype=torch.float16)
         model.to(dtype=torch.float16)
 
-    # Labels to condition the model with (feel free to change):
-
-    # Create sampling noise:
-    for cases in range (0, 4):
-        z_prev = None
-        for idx in range (0, 16):
-            if args.use_fp16:
-                z = torch.randn(1, args.num_frames, 4, latent_size, latent_size, dtype=torch.float16, device=device) # b c f h w
-            else:
-                z = torch.randn(1, args.num_frames, 4, latent_size, latent_size, device=device)
-
-            if idx > 0:
-                z = (z + z_prev) / 2.
-
-            if using_cfg:
-                y = torch.randint(0, args.num_classes, (1,), device=device)
-                y_null = torch.tensor([101] * 1, device=device)
-                y = torch.cat([y, y_null], dim=0)
-                model_kwargs = dict(y=y, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16)
-                sample_fn = model.forward_with_cfg
-            else:
-                sample_fn = model.forward
-                model_kwargs = dict(y=None, use_fp16=args.use_fp16)
-
-            # Sample images:
-            if args.sample_method == 'ddim':
-                samples = diffusion.ddim_sample_loop(
-                    sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True, device=device
-                )
-            elif args.sample_method == 'ddpm':
-                samples = diffusion.p_sample_loop(
-                    sample_fn, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True, device=device
-                )
-
-            print(samples.shape)
-            if args.use_fp16:
-                samples = samples.to(dtype=torch.float16)
-            b, f, c, h, w = samples.shape
-            samples = rearrange(samples, 'b f c h w -> (b f) c h w')
-            samples = vae.decode(samples / 0.18215).sample
-            samples = rearrange(samples, '(b f) c h w -> b f c h w', b=b)
-
-            # Save and display images:
-            if not os.path.exists(args.save_video_path):
-                os.makedirs(args.save_video_path)
-
-            print(samples.shape, "!!!")
-            video_ = ((samples[0] * 0.5 + 0.5) * 255).add_(0.5).clamp_(0, 255).to(dtype=torch.uint8).cpu().permute(0, 2, 3, 1).contiguous()
-            video_save_path = os.path.join(args.save_video_path, 'sample_' + str(cases) + "_" + str(idx).zfill(2) + '.mp4')
-            print(video_save_path, video_.shape)
-            imageio.mimwrite(video_save_path, video_, fps=8, quality=9)
-            print('save path {}'.format(args.save_video_path))
-
-            z_prev = z.clone()
+    # One continuous video per case, written frame by frame while the next window is sampled:
+    if not os.path.exists(args.save_video_path):
+        os.makedirs(args.save_video_path)
+    num_windows = getattr(args, 'num_windows', 16)
+    overlap = getattr(args, 'window_overlap', args.num_frames // 4)
+    for cases in range(0, getattr(args, 'num_long_videos', 4)):
+        if using_cfg:
+            y = torch.randint(0, args.num_classes, (1,), device=device)
+            y_null = torch.tensor([101] * 1, device=device)
+            # only the conditional trajectory is sampled, the null-class batch is built in the model call
+            model_kwargs = dict(y=y, y_null=y_null, cfg_scale=args.cfg_scale, use_fp16=args.use_fp16,
+                                guidance_interval=getattr(args, 'guidance_interval', None))
+            sample_fn = model.forward_with_guidance
+        else:
+            sample_fn = model.forward
+            model_kwargs = dict(y=None, use_fp16=args.use_fp16)
+
+        video_save_path = os.path.join(args.save_video_path, 'sample_' + str(cases) + '.mp4')
+        num_frames = 0
+        with imageio.get_writer(video_save_path, fps=8, quality=9) as writer:
+            for frames in stream_long_video(args, diffusion, vae, sample_fn, model_kwargs, latent_size,
+                                            num_windows, overlap, device):
+                for frame in frames:
+                    writer.append_data(frame)
+                num_frames += len(frames)
+        print('save path {} ({} frames)'.format(video_save_path, num_frames))
+
+
+def sample_window(args, diffusion, sample_fn, z, model_kwargs, denoised_fn, device):
+    if args.sample_method == 'ddim':
+        return diffusion.ddim_sample_loop(
+            sample_fn, z.shape, z, clip_denoised=False, denoised_fn=denoised_fn, model_kwargs=model_kwargs,
+            progress=True, device=device
+        )
+    elif args.sample_method == 'ddpm':
+        return diffusion.p_sample_loop(
+            sample_fn, z.shape, z, clip_denoised=False, denoised_fn=denoised_fn, model_kwargs=model_kwargs,
+            progress=True, device=device
+        )
+    elif args.sample_method == 'dpm-solver++':
+        return diffusion.dpm_solver_sample_loop(
+            sample_fn, z.shape, z, clip_denoised=False, denoised_fn=denoised_fn, model_kwargs=model_kwargs,
+            progress=True, device=device, num_steps=args.num_sampling_steps,
+            order=getattr(args, 'solver_order', 2), skip_type=getattr(args, 'skip_type', 'time_uniform')
+        )
+    raise NotImplementedError(args.sample_method)
+
+
+def stream_long_video(args, diffusion, vae, sample_fn, model_kwargs, latent_size, num_windows, overlap, device):
+    """
+    Generator of the (f, H, W, 3) uint8 frames of a long video, one window at a time.
+
+    Every window of num_frames latent frames after the first starts with the last
+    ``overlap`` latents of the previous window: they are noised to the first timestep
+    (q_sample) and, at every denoising step, their x_0 prediction is replaced by the
+    cached latents, so the num_frames - overlap new frames are sampled conditioned on
+    them. Only the new frames are decoded and only the overlap latents are kept, so
+    memory does not grow with the length of the video.
+    """
+    assert 0 <= overlap < args.num_frames, "window_overlap must be smaller than num_frames"
+    dtype = torch.float16 if args.use_fp16 else torch.float32
+    context = None
+    for window in range(num_windows):
+        z = torch.randn(1, args.num_frames, 4, latent_size, latent_size, dtype=dtype, device=device) # b f c h w
+        denoised_fn = None
+        if context is not None and overlap > 0:
+            t = torch.full((1,), diffusion.num_timesteps - 1, dtype=torch.long, device=device)
+            z[:, :overlap] = diffusion.q_sample(context, t, noise=z[:, :overlap]).to(dtype)
+
+            def denoised_fn(x_start, context=context):
+                return torch.cat([context.to(x_start.dtype), x_start[:, overlap:]], dim=1)
+
+        samples = sample_window(args, diffusion, sample_fn, z, model_kwargs, denoised_fn, device)
+        if args.use_fp16:
+            samples = samples.to(dtype=torch.float16)
+        new_samples = samples if context is None else samples[:, overlap:]
+        context = samples[:, args.num_frames - overlap:].clone() if overlap > 0 else samples[:, :0]
+
+        b, f, c, h, w = new_samples.shape
+        frames = vae.decode(rearrange(new_samples, 'b f c h w -> (b f) c h w') / 0.18215)
+        frames = rearrange(frames, '(b f) c h w -> b f c h w', b=b)
+        yield ((frames[0] * 0.5 + 0.5) * 255).add_(0.5).clamp_(0, 255).to(dtype=torch.uint8).cpu().permute(0, 2, 3, 1).contiguous().numpy()
+
 
 if __name__ == "__main__":
 
@@ -34,14 +34,16 @@ from models import get_models
 from datasets import get_dataset
 from models.clip import TextEmbedder
 from diffusion import create_diffusion
+from diffusion.timestep_sampler import create_named_schedule_sampler, LossAwareSampler
 from omegaconf import OmegaConf
 from torch.utils.data import DataLoader
 from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
 from diffusers.optimization import get_scheduler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.distributed import DistributedSampler
-from utils import (clip_grad_norm_, create_logger, update_ema, 
-                   requires_grad, cleanup, create_tensorboard, 
+from utils import (clip_grad_norm_, get_grad_norm, create_logger, EMA, 
+                   requires_grad, unused_parameters, cleanup, create_tensorboard, 
                    write_tensorboard, setup_distributed, get_experiment_dir)
 
 
@@ -93,11 +95,13 @@ def main(args, port):
     assert args.image_size % 8 == 0, "Image size must be divisible by 8 (for the VAE encoder)."
     sample_size = args.image_size // 8
     args.latent_size = sample_size
-    model = get_models(args)
+    model = get_models(args, prior_mode="off")  # only builds the prior heads this run uses
     # Note that parameter initialization is done within the EnDora constructor
     ema = deepcopy(model).to(device)  # Create an EMA of the model for use after training
     requires_grad(ema, False)
     diffusion = create_diffusion(timestep_respacing="")  # default: 1000 steps, linear noise schedule
+    # timestep distribution, e.g. loss-second-moment importance sampling (uniform by default)
+    schedule_sampler = create_named_schedule_sampler(getattr(args, 'schedule_sampler', 'uniform'), diffusion)
     # vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-ema").to(device)
     if args.extras == 78:
         vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae").to(device)
@@ -108,6 +112,8 @@ def main(args, port):
     # # use pretrained model?
     if args.pretrained:
         checkpoint = torch.load(args.pretrained, map_location=lambda storage, loc: storage)
+        if "schedule_sampler" in checkpoint:  # loss history of a resumed run
+            schedule_sampler.load_state_dict(checkpoint["schedule_sampler"])
         if "ema" in checkpoint:  # supports checkpoints from train.py
             logger.info('Using ema ckpt!')
             checkpoint = checkpoint["ema"]
@@ -164,7 +170,7 @@ def main(args, port):
         logger.info("WARNING: Only train {} parametes!".format(trainable_modules))
 
     # set distributed training
-    model = DDP(model.to(device), device_ids=[local_rank], find_unused_parameters=True)
+    model = DDP(model.to(device), device_ids=[local_rank], find_unused_parameters=False, gradient_as_bucket_view=True)
     
     if args.extras == 78:
         text_encoder = TextEmbedder(args.pretrained_model_path, dropout_prob=0.1).to(device)
@@ -173,6 +179,7 @@ def main(args, port):
     opt = torch.optim.AdamW(model.parameters(), lr=1e-4, weight_decay=0)
 
     # Freeze vae and text_encoder
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
     vae.requires_grad_(False)
 
     # Setup data:
@@ -206,7 +213,10 @@ def main(args, port):
     )
 
     # Prepare models for training:
-    update_ema(ema, model.module, decay=0)  # Ensure EMA is initialized with synced weights
+    ema_updater = EMA(ema, model.module, decay=getattr(args, 'ema_decay', 0.9999),
+                      update_every=getattr(args, 'ema_update_every', 1),
+                      warmup_steps=getattr(args, 'ema_warmup_steps', 0))
+    ema_updater.sync()  # Ensure EMA is initialized with synced weights
     model.train()  # important! This enables embedding dropout for classifier-free guidance
     ema.eval()  # EMA model should always be in eval mode
 
@@ -214,6 +224,7 @@ def main(args, port):
     train_steps = 0
     log_steps = 0
     running_loss = 0
+    check_unused = True  # DDP runs without find_unused_parameters, checked after the first backward
     first_epoch = 0
     start_time = time()
 
@@ -259,7 +270,7 @@ def main(args, port):
                 # Map input images to latent space + normalize latents:
                 b, _, _, _, _ = x.shape
                 x = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
-                x = vae.encode(x).latent_dist.sample().mul_(0.18215)
+                x = vae.encode(x).mul_(0.18215)
                 x = rearrange(x, '(b f) c h w -> b f c h w', b=b).contiguous()
 
             if args.extras == 78: # text-to-video
@@ -274,23 +285,30 @@ def main(args, port):
 
             model_kwargs["attentions"] = None
 
-            t = torch.randint(0, diffusion.num_timesteps, (x.shape[0],), device=device)
+            t, weights = schedule_sampler.sample(x.shape[0], device)
             loss_dict = diffusion.training_losses(model, x, t, model_kwargs)
-            loss = loss_dict["loss"].mean()
+            if isinstance(schedule_sampler, LossAwareSampler):
+                schedule_sampler.update_with_local_losses(t, loss_dict["loss"].detach(), same_batch_sizes=True)
+            loss = (loss_dict["loss"] * weights).mean()
             loss.backward()
+            if check_unused:
+                unused = unused_parameters(model.module)
+                assert not unused, f"Parameters without gradient, build them only when needed: {unused}"
+                check_unused = False
 
             if train_steps < args.start_clip_iter: # if train_steps >= start_clip_iter, will clip gradient
-                gradient_norm = clip_grad_norm_(model.module.parameters(), args.clip_max_norm, clip_grad=False)
+                if (train_steps + 1) % args.log_every == 0:  # the norm is only needed for the log line
+                    gradient_norm = get_grad_norm(model.module.parameters())
             else:
                 gradient_norm = clip_grad_norm_(model.module.parameters(), args.clip_max_norm, clip_grad=True)
 
             opt.step()
             lr_scheduler.step()
             opt.zero_grad()
-            update_ema(ema, model.module)
+            ema_updater.step()
 
             # Log loss values:
-            running_loss += loss.item()
+            running_loss += loss.detach()  # no host sync until the next log step
             log_steps += 1
             train_steps += 1
             if train_steps % args.log_every == 0:
@@ -299,7 +317,7 @@ def main(args, port):
                 end_time = time()
                 steps_per_sec = log_steps / (end_time - start_time)
                 # Reduce loss history over all processes:
-                avg_loss = torch.tensor(running_loss / log_steps, device=device)
+                avg_loss = running_loss / log_steps
                 dist.all_reduce(avg_loss, op=dist.ReduceOp.SUM)
                 avg_loss = avg_loss.item() / dist.get_world_size()
                 # logger.info(f"(step={train_steps:07d}) Train Loss: {avg_loss:.4f}, Train Steps/Sec: {steps_per_sec:.2f}")
@@ -317,6 +335,8 @@ def main(args, port):
                     checkpoint = {
                         # "model": model.module.state_dict(),
                         "ema": ema.state_dict(),
+                        "ema_state": ema_updater.state_dict(),
+                        "schedule_sampler": schedule_sampler.state_dict(),
                         # "opt": opt.state_dict(),
                         # "args": args
                     }
@@ -15,23 +15,28 @@ os.environ['MASTER_ADDR'] = '127.0.0.1'
 import math
 import argparse
 
+from contextlib import nullcontext
+
 import torch.distributed as dist
 from glob import glob
 from time import time
 from copy import deepcopy
 from einops import rearrange
-from models import get_models
-from datasets import get_dataset
+from models import get_models, load_model_state
+from datasets import get_dataset, get_batch_transform, get_collate_fn
 from diffusion import create_diffusion
+from diffusion.timestep_sampler import create_named_schedule_sampler, LossAwareSampler
+from diffusion.prr_loss import select_layer_weights
 from omegaconf import OmegaConf
 from torch.utils.data import DataLoader
 from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
 from transformers import CLIPProcessor, CLIPModel
 from diffusers.optimization import get_scheduler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.distributed import DistributedSampler
-from utils import (clip_grad_norm_, create_logger, update_ema,
-                   requires_grad, cleanup, create_tensorboard,
+from utils import (clip_grad_norm_, get_grad_norm, create_logger, EMA,
+                   get_autocast_dtype, autocast_forward, requires_grad, unused_parameters, cleanup, create_tensorboard,
                    write_tensorboard, setup_distributed, get_experiment_dir)
 import models.vision_transformer as vits
 
@@ -64,6 +69,45 @@ def load_model(device, pretrained_path):
     return model
 
 
+def micro_step_group(step, num_batches, accum_steps):
+    """Return (micro-steps of the update of loader step ``step``, whether ``step`` ends that update).
+
+    The last update of an epoch may hold fewer than accum_steps micro-batches.
+    """
+    num_micro_steps = min(accum_steps, num_batches - step // accum_steps * accum_steps)
+    sync_step = (step + 1) % accum_steps == 0 or step + 1 == num_batches
+    return num_micro_steps, sync_step
+
+
+def check_gradient_accumulation(batch_size=8):
+    """CPU check: one micro-step of batch_size samples and batch_size micro-steps of one sample
+    (the loop of main: loss / num_micro_steps, autocast on the forward only) give the same gradients."""
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(16, 64), torch.nn.GELU(), torch.nn.Linear(64, 16))
+    x, target = torch.randn(batch_size, 16), torch.randn(batch_size, 16)
+
+    def gradients(num_batches, amp_dtype=None):
+        model.zero_grad(set_to_none=True)
+        model_forward = autocast_forward(model, amp_dtype, device_type='cpu')
+        for step, (xb, tb) in enumerate(zip(x.chunk(num_batches), target.chunk(num_batches))):
+            num_micro_steps, sync_step = micro_step_group(step, num_batches, num_batches)
+            output = model_forward(xb)
+            assert output.dtype == torch.float32
+            loss = ((output - tb) ** 2).mean()
+            (loss / num_micro_steps).backward()
+        assert sync_step
+        return [p.grad.clone() for p in model.parameters()]
+
+    for amp_dtype, atol in [(None, 1e-6), (torch.bfloat16, 1e-2)]:
+        full, accumulated = gradients(1, amp_dtype), gradients(batch_size, amp_dtype)
+        assert all(torch.allclose(a, b, atol=atol) for a, b in zip(full, accumulated)), amp_dtype
+        print(f"1x{batch_size} and {batch_size}x1 micro-steps give the same gradients (autocast: {amp_dtype})")
+
+    groups = [micro_step_group(step, 5, 2) for step in range(5)]
+    assert groups == [(2, False), (2, True), (2, False), (2, True), (1, True)], groups
+    print("5 batches with 2 accumulation steps: updates of 2, 2 and 1 micro-steps")
+
+
 def main(args, port, pretrained_weights, mode, prr_weight):
     assert torch.cuda.is_available(), "Training currently requires at least one GPU."
     os.environ['MASTER_PORT'] = str(port)
@@ -98,12 +142,19 @@ def main(args, port, pretrained_weights, mode, prr_weight):
     assert args.image_size % 8 == 0, "Image size must be divisible by 8 (for the VAE encoder)."
     sample_size = args.image_size // 8
     args.latent_size = sample_size
-    model = get_models(args)
+    model = get_models(args, prior_mode=mode)  # only builds the prior heads this run uses
     # Note that parameter initialization is done within the EnDora constructor
     ema = deepcopy(model).to(device)  # Create an EMA of the model for use after training
-    dino = load_model(device=device, pretrained_path=pretrained_weights)
+    # DINO priors are read from the dataset when they were precomputed (extract_dino_features.py)
+    dino = None if getattr(args, 'dino_cache_path', None) else load_model(device=device, pretrained_path=pretrained_weights)
     requires_grad(ema, False)
-    diffusion = create_diffusion(timestep_respacing="")  # default: 1000 steps, linear noise schedule
+    diffusion = create_diffusion(  # default: 1000 steps, linear noise schedule
+        timestep_respacing="",
+        prr_reduction=getattr(args, 'prr_reduction', 'global'),
+        prr_layer_weights=select_layer_weights(getattr(args, 'prr_layer_weights', None), mode),
+    )
+    # timestep distribution, e.g. loss-second-moment importance sampling (uniform by default)
+    schedule_sampler = create_named_schedule_sampler(getattr(args, 'schedule_sampler', 'uniform'), diffusion)
     if args.extras == 78:
         vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae").to(device)
     else:
@@ -157,17 +208,19 @@ def main(args, port, pretrained_weights, mode, prr_weight):
         logger.info("WARNING: Only train {} parametes!".format(trainable_modules))
 
     # set distributed training
-    model = DDP(model.to(device), device_ids=[local_rank], find_unused_parameters=True)
+    model = DDP(model.to(device), device_ids=[local_rank], find_unused_parameters=False, gradient_as_bucket_view=True)
 
     logger.info(f"Model Parameters: {sum(p.numel() for p in model.parameters()):,}")
     opt = torch.optim.AdamW(model.parameters(), lr=1e-4, weight_decay=0)
 
     # Freeze vae and text_encoder
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
     vae.requires_grad_(False)
     s_vae_m.requires_grad_(False)
 
     # Setup data:
     dataset = get_dataset(args)
+    batch_transform = get_batch_transform(args)  # None unless gpu_transforms
 
     sampler = DistributedSampler(
         dataset,
@@ -183,7 +236,8 @@ def main(args, port, pretrained_weights, mode, prr_weight):
         sampler=sampler,
         num_workers=args.num_workers,
         pin_memory=True,
-        drop_last=True
+        drop_last=True,
+        collate_fn=get_collate_fn(args)
     )
     logger.info(f"Dataset contains {len(dataset):,} videos ({args.data_path})")
 
@@ -191,24 +245,46 @@ def main(args, port, pretrained_weights, mode, prr_weight):
     lr_scheduler = get_scheduler(
         name="constant",
         optimizer=opt,
-        num_warmup_steps=args.lr_warmup_steps * args.gradient_accumulation_steps,
-        num_training_steps=args.max_train_steps * args.gradient_accumulation_steps,
+        num_warmup_steps=args.lr_warmup_steps,  # stepped once per optimizer update
+        num_training_steps=args.max_train_steps,
     )
 
     # Prepare models for training:
-    update_ema(ema, model.module, decay=0)  # Ensure EMA is initialized with synced weights
+    ema_updater = EMA(ema, model.module, decay=getattr(args, 'ema_decay', 0.9999),
+                      update_every=getattr(args, 'ema_update_every', 1),
+                      warmup_steps=getattr(args, 'ema_warmup_steps', 0))
+    ema_updater.sync()  # Ensure EMA is initialized with synced weights
     model.train()  # important! This enables embedding dropout for classifier-free guidance
     ema.eval()  # EMA model should always be in eval mode
 
+    # Gradient accumulation and mixed precision (fp32 master weights, bf16/fp16 autocast):
+    accum_steps = max(1, int(getattr(args, 'gradient_accumulation_steps', 1)))
+    amp_dtype = get_autocast_dtype(getattr(args, 'mixed_precision', False))
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)  # bf16 needs no loss scaling
+    model_forward = autocast_forward(model, amp_dtype)  # the loss math stays in fp32
+    sampler_ts, sampler_losses = [], []  # loss-aware sampler inputs of the current update
+    logger.info(f"Gradient accumulation steps: {accum_steps}, autocast dtype: {amp_dtype}")
+
+    # MaskDiT-style token dropping: the blocks only see (1 - token_mask_ratio) of the spatial
+    # tokens until the last unmask_finetune_steps steps, which train at full token count.
+    token_mask_ratio = float(getattr(args, 'token_mask_ratio', 0.))
+    token_mask_end_step = args.max_train_steps - int(getattr(args, 'unmask_finetune_steps', args.max_train_steps // 10))
+    if token_mask_ratio > 0:
+        assert hasattr(model.module, 'random_token_mask'), \
+            f"token_mask_ratio > 0 needs a model with random_token_mask() (the EnDora of models/EnDora_img.py), " \
+            f"{type(model.module).__name__} of model {args.model} does not support token dropping"
+        logger.info(f"Token mask ratio {token_mask_ratio} until step {token_mask_end_step}, unmasked afterwards")
+
     # Variables for monitoring/logging purposes:
     train_steps = 0
     log_steps = 0
     running_loss = 0
+    check_unused = True  # DDP runs without find_unused_parameters, checked after the first backward
     first_epoch = 0
     start_time = time()
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
-    num_update_steps_per_epoch = math.ceil(len(loader))
+    num_update_steps_per_epoch = math.ceil(len(loader) / accum_steps)
     # Afterwards we recalculate our number of training epochs
     num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
 
@@ -217,7 +293,12 @@ def main(args, port, pretrained_weights, mode, prr_weight):
         # Get the most recent checkpoint
         logger.info(f"Resuming from checkpoint")
         states = torch.load(args.resume_from_checkpoint)
-        model.module.load_state_dict(states['ema'])
+        load_model_state(model.module, states['ema'])  # the checkpoint may hold other prior heads
+        load_model_state(ema, states['ema'])
+        if 'ema_state' in states:
+            ema_updater.load_state_dict(states['ema_state'])
+        if 'schedule_sampler' in states:
+            schedule_sampler.load_state_dict(states['schedule_sampler'])
         del states
         train_steps = 20000
 
@@ -227,22 +308,31 @@ def main(args, port, pretrained_weights, mode, prr_weight):
         sampler.set_epoch(epoch)
         for step, video_data in enumerate(loader):
 
-            x = video_data['video'].to(device, non_blocking=True)
+            if 'video' not in video_data:
+                x = None
+            elif batch_transform is not None:  # uint8 clips, transformed on the device
+                x = batch_transform(video_data['video'], device)
+            else:
+                x = video_data['video'].to(device, non_blocking=True)
             if args.extras == 3:
-                c = video_data['video_mask'].to(device, non_blocking=True)
-
-            img = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
-            patch_size = 8
-            # modified by piang
-            w, h = (
-                img.shape[-2] - img.shape[-2] % patch_size,
-                img.shape[-1] - img.shape[-1] % patch_size,
-            )
-            img = img[:, :, :w, :h]
+                # mask latents precomputed by extract_mask_latents.py, or mask pixels
+                c = video_data['mask_latent' if 'mask_latent' in video_data else 'video_mask'].to(device, non_blocking=True)
 
             special_list = [2, 5, 8, 11]
-            attentions = dino.get_special_layers(img.to(device), special_list)
-            attentions = [item[:, 1:, :] for item in attentions]
+            if 'attentions' in video_data:  # precomputed DINO priors, (b, f, L, N, D)
+                attentions = video_data['attentions'].to(device, non_blocking=True).float()
+                attentions = list(rearrange(attentions, 'b f l n d -> l (b f) n d').unbind(0))
+            else:
+                img = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
+                patch_size = 8
+                # modified by piang
+                w, h = (
+                    img.shape[-2] - img.shape[-2] % patch_size,
+                    img.shape[-1] - img.shape[-1] % patch_size,
+                )
+                img = img[:, :, :w, :h]
+                attentions = dino.get_special_layers(img.to(device), special_list)
+                attentions = [item[:, 1:, :] for item in attentions]
 
             video_name = video_data['video_name']
             with torch.no_grad():
@@ -251,14 +341,18 @@ def main(args, port, pretrained_weights, mode, prr_weight):
                 # x = torch.concatenate([x, c], dim=1)
 
                 # Map input images to latent space + normalize latents:
-                b, _, _, _, _ = x.shape
-                x = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
-                x = vae.encode(x).latent_dist.sample().mul_(0.18215)
-                x = rearrange(x, '(b f) c h w -> b f c h w', b=b).contiguous()
-
-                if args.extras == 3:
+                if 'latent' in video_data:  # latents sampled from the precomputed posterior
+                    x = video_data['latent'].to(device, non_blocking=True)
+                    b = x.shape[0]
+                else:
+                    b, _, _, _, _ = x.shape
+                    x = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
+                    x = vae.encode(x).mul_(0.18215)
+                    x = rearrange(x, '(b f) c h w -> b f c h w', b=b).contiguous()
+
+                if args.extras == 3 and 'mask_latent' not in video_data:
                     c = rearrange(c, 'b f c h w -> (b f) c h w').contiguous()
-                    c = vae.encode(c).latent_dist.sample().mul_(0.18215)
+                    c = vae.encode(c).mul_(0.18215)
                     c = rearrange(c, '(b f) c h w -> b f c h w', b=b).contiguous()
 
             if args.extras == 2:
@@ -271,29 +365,53 @@ def main(args, port, pretrained_weights, mode, prr_weight):
             model_kwargs["mode"] = mode
             if args.extras == 3:
                 model_kwargs["y_image"] = c
-
-            t = torch.randint(0, diffusion.num_timesteps, (x.shape[0],), device=device)
-            loss_dict = diffusion.training_losses(model, x, t, model_kwargs)
-            loss_mse = loss_dict["loss"].mean()
-            loss_prr = loss_dict["prr"]
-            if loss_prr != -1:
-                loss = loss_mse + prr_weight * loss_prr
-            else:
-                loss = loss_mse
-            loss.backward()
-
+            if token_mask_ratio > 0 and train_steps < token_mask_end_step:
+                model_kwargs["ids_keep"], model_kwargs["loss_mask"] = model.module.random_token_mask(
+                    x.shape[0], token_mask_ratio, device)
+
+            num_micro_steps, sync_step = micro_step_group(step, len(loader), accum_steps)
+            # gradients are only all-reduced by DDP on the last micro-step of an update
+            with nullcontext() if sync_step else model.no_sync():
+                t, weights = schedule_sampler.sample(x.shape[0], device)
+                loss_dict = diffusion.training_losses(model_forward, x, t, model_kwargs)
+                if isinstance(schedule_sampler, LossAwareSampler):
+                    sampler_ts.append(t)
+                    sampler_losses.append(loss_dict["loss"].detach())
+                loss_mse = (loss_dict["loss"] * weights).mean()
+                if "prr" in loss_dict:  # no priors: no PRR term
+                    loss = loss_mse + prr_weight * loss_dict["prr"].mean()
+                else:
+                    loss = loss_mse
+                scaler.scale(loss / num_micro_steps).backward()
+
+            if check_unused:
+                unused = unused_parameters(model.module)
+                assert not unused, f"Parameters without gradient, build them only when needed: {unused}"
+                check_unused = False
+
+            running_loss += loss.detach() / num_micro_steps  # no host sync until the next log step
+            if not sync_step:
+                continue
+
+            if sampler_ts:  # one sampler update per optimizer update, with the losses of all its micro-steps
+                schedule_sampler.update_with_local_losses(torch.cat(sampler_ts), torch.cat(sampler_losses),
+                                                          same_batch_sizes=True)
+                sampler_ts, sampler_losses = [], []
+
+            scaler.unscale_(opt)  # no-op unless fp16
             if train_steps < args.start_clip_iter:  # if train_steps >= start_clip_iter, will clip gradient
-                gradient_norm = clip_grad_norm_(model.module.parameters(), args.clip_max_norm, clip_grad=False)
+                if (train_steps + 1) % args.log_every == 0:  # the norm is only needed for the log line
+                    gradient_norm = get_grad_norm(model.module.parameters())
             else:
                 gradient_norm = clip_grad_norm_(model.module.parameters(), args.clip_max_norm, clip_grad=True)
 
-            opt.step()
+            scaler.step(opt)  # skips the update if fp16 gradients overflowed
+            scaler.update()
+            opt.zero_grad(set_to_none=True)
             lr_scheduler.step()
-            opt.zero_grad()
-            update_ema(ema, model.module)
+            ema_updater.step()
 
             # Log loss values:
-            running_loss += loss.item()
             log_steps += 1
             train_steps += 1
             if train_steps % args.log_every == 0:
@@ -302,11 +420,11 @@ def main(args, port, pretrained_weights, mode, prr_weight):
                 end_time = time()
                 steps_per_sec = log_steps / (end_time - start_time)
                 # Reduce loss history over all processes:
-                avg_loss = torch.tensor(running_loss / log_steps, device=device)
+                avg_loss = running_loss / log_steps
                 dist.all_reduce(avg_loss, op=dist.ReduceOp.SUM)
                 avg_loss = avg_loss.item() / dist.get_world_size()
                 logger.info(
-                    f"(step={train_steps:07d}/epoch={epoch:04d}) Total L: {avg_loss:.4f}, MSE L: {loss_dict['mse'].mean():.4f}, VB L: {loss_dict['vb'].mean():.4f}, PRR L: {loss_dict['prr'].data:.4f},"
+                    f"(step={train_steps:07d}/epoch={epoch:04d}) Total L: {avg_loss:.4f}, MSE L: {loss_dict['mse'].mean():.4f}, VB L: {loss_dict['vb'].mean():.4f}, PRR L: {loss_dict['prr'].mean() if 'prr' in loss_dict else 0.:.4f},"
                     f" Gradient Norm: {gradient_norm:.4f}, Train Steps/Sec: {steps_per_sec:.2f}")
 
                 # Reset monitoring variables:
@@ -318,7 +436,9 @@ def main(args, port, pretrained_weights, mode, prr_weight):
             if train_steps % args.ckpt_every == 0 and train_steps > 0:
                 if rank == 0:
                     checkpoint = {
-                        "ema": ema.state_dict()
+                        "ema": ema.state_dict(),
+                        "ema_state": ema_updater.state_dict(),
+                        "schedule_sampler": schedule_sampler.state_dict()
                     }
 
                     checkpoint_path = f"{checkpoint_dir}/{train_steps:07d}.pt"
@@ -341,5 +461,10 @@ if __name__ == "__main__":
     parser.add_argument('--pretrained_weights', type=str, default="/path/to/pretrained/dino-model")
     parser.add_argument("--mode", type=str, default="type_cnn", choices=["type0", "type1", "type2", "type_cnn"])
     parser.add_argument("--prr_weight", type=float, default=0.1)
+    parser.add_argument("--check_grad_accum", action="store_true",
+                        help="only run the CPU gradient accumulation check")
     args = parser.parse_args()
-    main(OmegaConf.load(args.config), args.port, args.pretrained_weights, args.mode, args.prr_weight)
+    if args.check_grad_accum:
+        check_gradient_accumulation()
+    else:
+        main(OmegaConf.load(args.config), args.port, args.pretrained_weights, args.mode, args.prr_weight)
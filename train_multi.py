@@ -26,17 +26,20 @@ from time import time
 from copy import deepcopy
 from einops import rearrange
 from models import get_models
-from datasets import get_dataset
+from datasets import get_dataset, get_batch_transform, get_collate_fn
 from models.clip import TextEmbedder
 from diffusion import create_diffusion
+from diffusion.timestep_sampler import create_named_schedule_sampler, LossAwareSampler
+from diffusion.prr_loss import select_layer_weights
 from omegaconf import OmegaConf
 from torch.utils.data import DataLoader
 from diffusers.models import AutoencoderKL
+from models.vae import get_chunked_vae
 from diffusers.optimization import get_scheduler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.distributed import DistributedSampler
-from utils import (clip_grad_norm_, create_logger, update_ema, 
-                   requires_grad, cleanup, create_tensorboard, 
+from utils import (clip_grad_norm_, get_grad_norm, create_logger, EMA, 
+                   requires_grad, unused_parameters, cleanup, create_tensorboard, 
                    write_tensorboard, setup_distributed, get_experiment_dir)
 import models.vision_transformer as vits
 
@@ -108,12 +111,19 @@ def main(args, port, pretrained_weights, mode, prr_weight):
     assert args.image_size % 8 == 0, "Image size must be divisible by 8 (for the VAE encoder)."
     sample_size = args.image_size // 8
     args.latent_size = sample_size
-    model = get_models(args)
+    model = get_models(args, prior_mode=mode)  # only builds the prior heads this run uses
     # Note that parameter initialization is done within the EnDora constructor
     ema = deepcopy(model).to(device)  # Create an EMA of the model for use after training
-    dino = load_model(device=device, pretrained_path=pretrained_weights)
+    # DINO priors are read from the dataset when they were precomputed (extract_dino_features.py)
+    dino = None if getattr(args, 'dino_cache_path', None) else load_model(device=device, pretrained_path=pretrained_weights)
     requires_grad(ema, False)
-    diffusion = create_diffusion(timestep_respacing="")  # default: 1000 steps, linear noise schedule
+    diffusion = create_diffusion(  # default: 1000 steps, linear noise schedule
+        timestep_respacing="",
+        prr_reduction=getattr(args, 'prr_reduction', 'global'),
+        prr_layer_weights=select_layer_weights(getattr(args, 'prr_layer_weights', None), mode),
+    )
+    # timestep distribution, e.g. loss-second-moment importance sampling (uniform by default)
+    schedule_sampler = create_named_schedule_sampler(getattr(args, 'schedule_sampler', 'uniform'), diffusion)
     # vae = AutoencoderKL.from_pretrained(f"stabilityai/sd-vae-ft-ema").to(device)
     if args.extras == 78:
         vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae").to(device)
@@ -124,6 +134,8 @@ def main(args, port, pretrained_weights, mode, prr_weight):
     # # use pretrained model?
     if args.pretrained:
         checkpoint = torch.load(args.pretrained, map_location=lambda storage, loc: storage)
+        if "schedule_sampler" in checkpoint:  # loss history of a resumed run
+            schedule_sampler.load_state_dict(checkpoint["schedule_sampler"])
         if "ema" in checkpoint:  # supports checkpoints from train.py
             logger.info('Using ema ckpt!')
             checkpoint = checkpoint["ema"]
@@ -168,7 +180,7 @@ def main(args, port, pretrained_weights, mode, prr_weight):
         logger.info("WARNING: Only train {} parametes!".format(trainable_modules))
 
     # set distributed training
-    model = DDP(model.to(device), device_ids=[local_rank], find_unused_parameters=True)
+    model = DDP(model.to(device), device_ids=[local_rank], find_unused_parameters=False, gradient_as_bucket_view=True)
     
     if args.extras == 78:
         text_encoder = TextEmbedder(args.pretrained_model_path, dropout_prob=0.1).to(device)
@@ -177,10 +189,12 @@ def main(args, port, pretrained_weights, mode, prr_weight):
     opt = torch.optim.AdamW(model.parameters(), lr=1e-4, weight_decay=0)
 
     # Freeze vae and text_encoder
+    vae = get_chunked_vae(vae, args)  # frame micro-batches / tiles, see models/vae.py
     vae.requires_grad_(False)
 
     # Setup data:
     dataset = get_dataset(args)
+    batch_transform = get_batch_transform(args)  # None unless gpu_transforms
         
     sampler = DistributedSampler(
         dataset,
@@ -196,7 +210,8 @@ def main(args, port, pretrained_weights, mode, prr_weight):
         sampler=sampler,
         num_workers=args.num_workers,
         pin_memory=True,
-        drop_last=True
+        drop_last=True,
+        collate_fn=get_collate_fn(args)
     )
     # logger.info(f"Dataset contains {len(dataset):,} videos ({args.webvideo_data_path})")
     logger.info(f"Dataset contains {len(dataset):,} videos ({args.data_path})")
@@ -210,7 +225,10 @@ def main(args, port, pretrained_weights, mode, prr_weight):
     )
 
     # Prepare models for training:
-    update_ema(ema, model.module, decay=0)  # Ensure EMA is initialized with synced weights
+    ema_updater = EMA(ema, model.module, decay=getattr(args, 'ema_decay', 0.9999),
+                      update_every=getattr(args, 'ema_update_every', 1),
+                      warmup_steps=getattr(args, 'ema_warmup_steps', 0))
+    ema_updater.sync()  # Ensure EMA is initialized with synced weights
     model.train()  # important! This enables embedding dropout for classifier-free guidance
     ema.eval()  # EMA model should always be in eval mode
 
@@ -218,6 +236,7 @@ def main(args, port, pretrained_weights, mode, prr_weight):
     train_steps = 0
     log_steps = 0
     running_loss = 0
+    check_unused = True  # DDP runs without find_unused_parameters, checked after the first backward
     first_epoch = 0
     start_time = time()
 
@@ -249,23 +268,31 @@ def main(args, port, pretrained_weights, mode, prr_weight):
             if args.resume_from_checkpoint and epoch == first_epoch and step < resume_step:
                 continue
 
-            x = video_data['video'].to(device, non_blocking=True)
-            batch_size = x.shape[0]
-            img = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
-            patch_size = 8
-            # modified by piang
-            w, h = (
-                img.shape[-2] - img.shape[-2] % patch_size,
-                img.shape[-1] - img.shape[-1] % patch_size,
-            )
-            img = img[:, :, :w, :h]
-
-            w_featmap = img.shape[-2] // patch_size
-            h_featmap = img.shape[-1] // patch_size
-            
+            if 'video' not in video_data:
+                x = None
+            elif batch_transform is not None:  # uint8 clips, transformed on the device
+                x = batch_transform(video_data['video'], device)
+            else:
+                x = video_data['video'].to(device, non_blocking=True)
+            batch_size = len(video_data['video_name'])
             special_list = [2, 5, 8, 11]
-            attentions = dino.get_special_layers(img.to(device), special_list)
-            attentions = [item[:, 1:, :] for item in attentions]
+            if 'attentions' in video_data:  # precomputed DINO priors, (b, f, L, N, D)
+                attentions = video_data['attentions'].to(device, non_blocking=True).float()
+                attentions = list(rearrange(attentions, 'b f l n d -> l (b f) n d').unbind(0))
+            else:
+                img = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
+                patch_size = 8
+                # modified by piang
+                w, h = (
+                    img.shape[-2] - img.shape[-2] % patch_size,
+                    img.shape[-1] - img.shape[-1] % patch_size,
+                )
+                img = img[:, :, :w, :h]
+
+                w_featmap = img.shape[-2] // patch_size
+                h_featmap = img.shape[-1] // patch_size
+                attentions = dino.get_special_layers(img.to(device), special_list)
+                attentions = [item[:, 1:, :] for item in attentions]
 
             video_name = video_data['video_name']
             if args.dataset == "ucf101_img":
@@ -278,10 +305,14 @@ def main(args, port, pretrained_weights, mode, prr_weight):
             # y = y.to(device) # y is text prompt; no need put in gpu
             with torch.no_grad():
                 # Map input images to latent space + normalize latents:
-                b, _, _, _, _ = x.shape
-                x = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
-                x = vae.encode(x).latent_dist.sample().mul_(0.18215)
-                x = rearrange(x, '(b f) c h w -> b f c h w', b=b).contiguous()
+                if 'latent' in video_data:  # latents sampled from the precomputed posterior
+                    x = video_data['latent'].to(device, non_blocking=True)
+                    b = x.shape[0]
+                else:
+                    b, _, _, _, _ = x.shape
+                    x = rearrange(x, 'b f c h w -> (b f) c h w').contiguous()
+                    x = vae.encode(x).mul_(0.18215)
+                    x = rearrange(x, '(b f) c h w -> b f c h w', b=b).contiguous()
 
             if args.extras == 78: # text-to-video
                 raise 'T2V training are Not supported at this moment!'
@@ -297,29 +328,34 @@ def main(args, port, pretrained_weights, mode, prr_weight):
             model_kwargs["special_list"] = special_list
             model_kwargs["mode"] = mode
 
-            t = torch.randint(0, diffusion.num_timesteps, (x.shape[0],), device=device)
+            t, weights = schedule_sampler.sample(x.shape[0], device)
             loss_dict = diffusion.training_losses(model, x, t, model_kwargs)
-            loss_mse = loss_dict["loss"].mean()
-            loss_prr = loss_dict["prr"]
-            # print(loss_mse, loss_prr)
-            if loss_prr != -1:
-                loss = loss_mse + prr_weight * loss_prr
+            if isinstance(schedule_sampler, LossAwareSampler):
+                schedule_sampler.update_with_local_losses(t, loss_dict["loss"].detach(), same_batch_sizes=True)
+            loss_mse = (loss_dict["loss"] * weights).mean()
+            if "prr" in loss_dict:  # no priors: no PRR term
+                loss = loss_mse + prr_weight * loss_dict["prr"].mean()
             else:
                 loss = loss_mse
             loss.backward()
+            if check_unused:
+                unused = unused_parameters(model.module)
+                assert not unused, f"Parameters without gradient, build them only when needed: {unused}"
+                check_unused = False
 
             if train_steps < args.start_clip_iter: # if train_steps >= start_clip_iter, will clip gradient
-                gradient_norm = clip_grad_norm_(model.module.parameters(), args.clip_max_norm, clip_grad=False)
+                if (train_steps + 1) % args.log_every == 0:  # the norm is only needed for the log line
+                    gradient_norm = get_grad_norm(model.module.parameters())
             else:
                 gradient_norm = clip_grad_norm_(model.module.parameters(), args.clip_max_norm, clip_grad=True)
 
             opt.step()
             lr_scheduler.step()
             opt.zero_grad()
-            update_ema(ema, model.module)
+            ema_updater.step()
 
             # Log loss values:
-            running_loss += loss.item()
+            running_loss += loss.detach()  # no host sync until the next log step
             log_steps += 1
             train_steps += 1
             if train_steps % args.log_every == 0:
@@ -328,7 +364,7 @@ def main(args, port, pretrained_weights, mode, prr_weight):
                 end_time = time()
                 steps_per_sec = log_steps / (end_time - start_time)
                 # Reduce loss history over all processes:
-                avg_loss = torch.tensor(running_loss / log_steps, device=device)
+                avg_loss = running_loss / log_steps
                 dist.all_reduce(avg_loss, op=dist.ReduceOp.SUM)
                 avg_loss = avg_loss.item() / dist.get_world_size()
                 # logger.info(f"(step={train_steps:07d}) Train Loss: {avg_loss:.4f}, Train Steps/Sec: {steps_per_sec:.2f}")
@@ -346,6 +382,8 @@ def main(args, port, pretrained_weights, mode, prr_weight):
                     checkpoint = {
                         # "model": model.module.state_dict(),
                         "ema": ema.state_dict(),
+                        "ema_state": ema_updater.state_dict(),
+                        "schedule_sampler": schedule_sampler.state_dict(),
                         # "opt": opt.state_dict(),
                         # "args": args
                     }
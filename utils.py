@@ -33,53 +33,89 @@ _tensor_or_tensors = Union[torch.Tensor, Iterable[torch.Tensor]]
 #                             Training Clip Gradients                           #
 #################################################################################
 
+def _grouped_grads(parameters):
+    if isinstance(parameters, torch.Tensor):
+        parameters = [parameters]
+    grouped = OrderedDict()
+    for p in parameters:
+        if p.grad is not None:
+            grouped.setdefault((p.grad.device, p.grad.dtype), []).append(p.grad.detach())
+    return grouped
+
+
+def _total_norm(grouped, norm_type, process_group=None, sharded=False):
+    """Norm of all the gradients in ``grouped`` (a dict of lists of same device/dtype tensors).
+
+    Each group is reduced with a single multi-tensor kernel (``torch._foreach_norm``)
+    when available. The result stays on the device, nothing is synchronized with
+    the host. With ``sharded`` the gradients are only the local shard of the
+    parameters (FSDP / ZeRO), so the partial norms are all-reduced over
+    ``process_group``. Plain DDP gradients are already identical on every rank
+    after backward and must not be reduced again.
+    """
+    device = next(iter(grouped))[0]
+    if norm_type == inf:
+        norms = [g.abs().max() for grads in grouped.values() for g in grads]
+        total_norm = torch.stack([norm.to(device) for norm in norms]).max().float()
+        if sharded:
+            dist.all_reduce(total_norm, op=dist.ReduceOp.MAX, group=process_group)
+        return total_norm
+
+    norms = []
+    for (grad_device, _), grads in grouped.items():
+        if hasattr(torch, '_foreach_norm') and grad_device.type != 'cpu':
+            norms.extend(torch._foreach_norm(grads, norm_type))
+        else:
+            norms.extend(torch.norm(g, norm_type) for g in grads)
+    total_norm = torch.stack([norm.to(device) for norm in norms]).float()
+    if sharded:
+        # combine the shards as sum(|g|^p) before taking the p-th root
+        total_norm = total_norm.pow(norm_type).sum()
+        dist.all_reduce(total_norm, op=dist.ReduceOp.SUM, group=process_group)
+        return total_norm.pow(1. / norm_type)
+    return torch.norm(total_norm, norm_type)
+
+
 def get_grad_norm(
-        parameters: _tensor_or_tensors, norm_type: float = 2.0) -> torch.Tensor:
+        parameters: _tensor_or_tensors, norm_type: float = 2.0,
+        process_group=None, sharded: bool = False) -> torch.Tensor:
     r"""
-    Copy from torch.nn.utils.clip_grad_norm_
-
-    Clips gradient norm of an iterable of parameters.
+    Total gradient norm of an iterable of parameters, without clipping.
 
     The norm is computed over all gradients together, as if they were
-    concatenated into a single vector. Gradients are modified in-place.
+    concatenated into a single vector.
 
     Args:
         parameters (Iterable[Tensor] or Tensor): an iterable of Tensors or a
-            single Tensor that will have gradients normalized
-        max_norm (float or int): max norm of the gradients
+            single Tensor whose gradients are measured
         norm_type (float or int): type of the used p-norm. Can be ``'inf'`` for
             infinity norm.
-        error_if_nonfinite (bool): if True, an error is thrown if the total
-            norm of the gradients from :attr:`parameters` is ``nan``,
-            ``inf``, or ``-inf``. Default: False (will switch to True in the future)
+        process_group: group over which the norm of ``sharded`` gradients is
+            reduced. Default: the world group.
+        sharded (bool): if True, each rank only holds a shard of the
+            gradients and the norm is all-reduced across ``process_group``.
 
     Returns:
-        Total norm of the parameter gradients (viewed as a single vector).
+        Total norm of the parameter gradients (viewed as a single vector), as a
+        device tensor (call ``.item()`` only when the value is needed).
     """
-    if isinstance(parameters, torch.Tensor):
-        parameters = [parameters]
-    grads = [p.grad for p in parameters if p.grad is not None]
-    norm_type = float(norm_type)
-    if len(grads) == 0:
+    grouped = _grouped_grads(parameters)
+    if len(grouped) == 0:
         return torch.tensor(0.)
-    device = grads[0].device
-    if norm_type == inf:
-        norms = [g.detach().abs().max().to(device) for g in grads]
-        total_norm = norms[0] if len(norms) == 1 else torch.max(torch.stack(norms))
-    else:
-        total_norm = torch.norm(torch.stack([torch.norm(g.detach(), norm_type).to(device) for g in grads]), norm_type)
-    return total_norm
+    return _total_norm(grouped, float(norm_type), process_group, sharded)
 
 def clip_grad_norm_(
         parameters: _tensor_or_tensors, max_norm: float, norm_type: float = 2.0,
-        error_if_nonfinite: bool = False, clip_grad = True) -> torch.Tensor:
+        error_if_nonfinite: bool = False, clip_grad = True,
+        process_group=None, sharded: bool = False) -> torch.Tensor:
     r"""
     Copy from torch.nn.utils.clip_grad_norm_
 
     Clips gradient norm of an iterable of parameters.
 
     The norm is computed over all gradients together, as if they were
-    concatenated into a single vector. Gradients are modified in-place.
+    concatenated into a single vector. Gradients are modified in-place with
+    one ``torch._foreach_mul_`` per device and dtype.
 
     Args:
         parameters (Iterable[Tensor] or Tensor): an iterable of Tensors or a
@@ -90,24 +126,19 @@ def clip_grad_norm_(
         error_if_nonfinite (bool): if True, an error is thrown if the total
             norm of the gradients from :attr:`parameters` is ``nan``,
             ``inf``, or ``-inf``. Default: False (will switch to True in the future)
+        clip_grad (bool): if False, only the norm is computed (same as
+            :func:`get_grad_norm`).
+        process_group, sharded: see :func:`get_grad_norm`.
 
     Returns:
         Total norm of the parameter gradients (viewed as a single vector).
     """
-    if isinstance(parameters, torch.Tensor):
-        parameters = [parameters]
-    grads = [p.grad for p in parameters if p.grad is not None]
+    grouped = _grouped_grads(parameters)
     max_norm = float(max_norm)
     norm_type = float(norm_type)
-    if len(grads) == 0:
+    if len(grouped) == 0:
         return torch.tensor(0.)
-    device = grads[0].device
-    if norm_type == inf:
-        norms = [g.detach().abs().max().to(device) for g in grads]
-        total_norm = norms[0] if len(norms) == 1 else torch.max(torch.stack(norms))
-    else:
-        total_norm = torch.norm(torch.stack([torch.norm(g.detach(), norm_type).to(device) for g in grads]), norm_type)
-    # print(total_norm)
+    total_norm = _total_norm(grouped, norm_type, process_group, sharded)
 
     if clip_grad:
         if error_if_nonfinite and torch.logical_or(total_norm.isnan(), total_norm.isinf()):
@@ -121,12 +152,52 @@ def clip_grad_norm_(
         # avoids a `if clip_coef < 1:` conditional which can require a CPU <=> device synchronization
         # when the gradients do not reside in CPU memory.
         clip_coef_clamped = torch.clamp(clip_coef, max=1.0)
-        for g in grads:
-            g.detach().mul_(clip_coef_clamped.to(g.device))
-        # gradient_cliped = torch.norm(torch.stack([torch.norm(g.detach(), norm_type).to(device) for g in grads]), norm_type)
-        # print(gradient_cliped)
+        for (grad_device, grad_dtype), grads in grouped.items():
+            coef = clip_coef_clamped.to(device=grad_device, dtype=grad_dtype)
+            if hasattr(torch, '_foreach_mul_') and grad_device.type != 'cpu':
+                torch._foreach_mul_(grads, coef)
+            else:
+                for g in grads:
+                    g.mul_(coef)
     return total_norm
 
+def get_autocast_dtype(mixed_precision):
+    """Map the ``mixed_precision`` config value to the autocast dtype (None: fp32 training).
+
+    ``True`` and ``'bf16'`` select bfloat16, ``'fp16'`` selects float16, which
+    needs a ``torch.cuda.amp.GradScaler``. The weights and the optimizer state
+    stay in fp32 in both cases.
+    """
+    if mixed_precision in (None, False, 'no', 'fp32'):
+        return None
+    if mixed_precision in (True, 'bf16'):
+        return torch.bfloat16
+    if mixed_precision == 'fp16':
+        return torch.float16
+    raise ValueError(f'Unknown mixed_precision: {mixed_precision}')
+
+def _to_float32(output):
+    if torch.is_tensor(output):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, (tuple, list)):
+        return type(output)(_to_float32(item) for item in output)
+    return output
+
+def autocast_forward(model, dtype, device_type='cuda'):
+    """Wrap ``model`` so only its forward runs under autocast (``dtype`` None: no autocast).
+
+    Floating point outputs (also inside tuples/lists, e.g. priors and features)
+    are cast back to fp32, so the loss math of the diffusion runs in full precision.
+    """
+    if dtype is None:
+        return model
+
+    def forward(*args, **kwargs):
+        with torch.autocast(device_type=device_type, dtype=dtype):
+            output = model(*args, **kwargs)
+        return _to_float32(output)
+    return forward
+
 def get_experiment_dir(root_dir, args):
     # if args.pretrained is not None and 'EnDora-XL-2-256x256.pt' not in args.pretrained:
     #     root_dir += '-WOPRE'
@@ -202,6 +273,79 @@ def update_ema(ema_model, model, decay=0.9999):
         # TODO: Consider applying only to params that require_grad to avoid small numerical changes of pos_embed
         ema_params[name].mul_(decay).add_(param.data, alpha=1 - decay)
 
+
+class EMA(object):
+    """
+    Keep ``ema_model`` as an exponential moving average of ``model``.
+
+    The (ema, model) parameter pairs are collected once, restricted to the
+    parameters that require grad; frozen ones such as the fixed sin-cos
+    ``pos_embed``/``temp_embed`` are only copied by ``sync()``. Every update is
+    two multi-tensor (foreach) kernels.
+
+    Args:
+        decay: EMA decay per optimizer step.
+        update_every: update every N calls of ``step()`` with ``decay ** N``,
+            which keeps the same averaging horizon.
+        warmup_steps: if > 0, use ``min(decay, (1 + n) / (warmup_steps + n))``
+            after n updates, so early weights are not over-weighted.
+    """
+
+    def __init__(self, ema_model, model, decay=0.9999, update_every=1, warmup_steps=0):
+        self.ema_model = ema_model
+        self.model = model
+        self.decay = decay
+        self.update_every = update_every
+        self.warmup_steps = warmup_steps
+        self.num_steps = 0
+
+        ema_params = dict(ema_model.named_parameters())
+        self.ema_params, self.model_params = [], []
+        for name, param in model.named_parameters():
+            if param.requires_grad:
+                self.ema_params.append(ema_params[name])
+                self.model_params.append(param)
+
+    def get_decay(self):
+        decay = self.decay
+        if self.warmup_steps > 0:
+            num_updates = self.num_steps // self.update_every
+            decay = min(decay, (1 + num_updates) / (self.warmup_steps + num_updates))
+        return decay ** self.update_every
+
+    @torch.no_grad()
+    def sync(self):
+        """
+        Copy every parameter and buffer of the model into the EMA model.
+        """
+        self.ema_model.load_state_dict(self.model.state_dict())
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Call after every optimizer step.
+        """
+        self.num_steps += 1
+        if self.num_steps % self.update_every != 0 or len(self.ema_params) == 0:
+            return
+        decay = self.get_decay()
+        torch._foreach_mul_(self.ema_params, decay)
+        torch._foreach_add_(self.ema_params, self.model_params, alpha=1 - decay)
+
+    def state_dict(self):
+        return {
+            "decay": self.decay,
+            "update_every": self.update_every,
+            "warmup_steps": self.warmup_steps,
+            "num_steps": self.num_steps,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.decay = state_dict["decay"]
+        self.update_every = state_dict["update_every"]
+        self.warmup_steps = state_dict["warmup_steps"]
+        self.num_steps = state_dict["num_steps"]
+
 def requires_grad(model, flag=True):
     """
     Set requires_grad flag for all parameters in a model.
@@ -209,6 +353,12 @@ def requires_grad(model, flag=True):
     for p in model.parameters():
         p.requires_grad = flag
 
+def unused_parameters(model):
+    """
+    Names of the trainable parameters of a model that received no gradient in the last backward.
+    """
+    return [name for name, p in model.named_parameters() if p.requires_grad and p.grad is None]
+
 def cleanup():
     """
     End DDP training.